@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import time
+
+GLOBAL = "*"
+
+
+class LatestMsgCache:
+    # Latest text message, kept globally (key GLOBAL) and per receiver.
+    # The POST handlers write through on commit; the TTL bounds how stale an
+    # entry can get when rows are inserted by another process. Keys come from
+    # query parameters, so the least recently used go first past max_size.
+
+    def __init__(self, ttl=5.0, max_size=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # Returns (id, text_msg), (0, None) for a cached "no messages", or None
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] > self.clock():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+        if entry is not None:
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, msg_id, text_msg):
+        now = self.clock()
+        entry = self.entries.get(key)
+        # A read that started before a concurrent write must not replace
+        # the newer row the write just stored
+        if entry is not None and entry[2] > now and entry[0] > msg_id:
+            return
+        self.entries[key] = (msg_id, text_msg, now + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "entries": len(self.entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+        }
+
+
+class IdempotencyCache:
+    # Idempotency keys of requests this process already committed, so a
+    # retry is answered without touching the database. Bounded in size
+    # (least recently used keys go first) and in age; msg_keys in the
+    # database is the backstop for whatever has been evicted or was handled
+    # by another process.
+
+    def __init__(self, max_size=10000, ttl=86400.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, key):
+        expires = self.entries.get(key)
+        if expires is not None and expires > self.clock():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+        if expires is not None:
+            del self.entries[key]
+        self.misses += 1
+        return False
+
+    def add(self, key):
+        self.entries[key] = self.clock() + self.ttl
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+        }
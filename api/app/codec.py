@@ -0,0 +1,156 @@
+from datetime import datetime, timezone
+import struct
+
+from .geo import geocell, valid_position
+
+# Ingest record formats. JSON records come from the dashboard, gateways and
+# /post-msgs/batch; the binary format is for devices on metered NB-IoT links.
+
+SMALLINT_MIN, SMALLINT_MAX = -32768, 32767
+
+
+def parse_smallint(record, field):
+    value = record.get(field)
+    if value is None:
+        return None
+    # The Pico sends readings as strings, e.g. {"msg": "23"}
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"{field} must be an integer")
+    if not SMALLINT_MIN <= value <= SMALLINT_MAX:
+        raise ValueError(f"{field} out of range")
+    return value
+
+
+def parse_position(record):
+    latitude, longitude = record.get("latitude"), record.get("longitude")
+    if latitude is None and longitude is None:
+        return None
+    if (isinstance(latitude, bool) or isinstance(longitude, bool)
+            or not isinstance(latitude, (int, float)) or not isinstance(longitude, (int, float))):
+        raise ValueError("latitude and longitude must both be numbers")
+    if not valid_position(latitude, longitude):
+        raise ValueError("invalid position")
+    return {"latitude": latitude, "longitude": longitude, "geocell": geocell(latitude, longitude)}
+
+
+def parse_msg_record(record):
+    # Every row without a position gets the same keys so the batch can go out
+    # as one executemany; rows with one are grouped apart by insert_rows
+    if not isinstance(record, dict):
+        raise ValueError("record must be a JSON object")
+    text_msg = record.get("text_msg")
+    if text_msg is not None:
+        if not isinstance(text_msg, str):
+            raise ValueError("text_msg must be a string")
+        if len(text_msg) > 255:
+            raise ValueError("text_msg longer than 255 characters")
+        # JSON escapes can smuggle in lone surrogates the database can't store
+        try:
+            text_msg.encode("utf-8")
+        except UnicodeEncodeError:
+            raise ValueError("text_msg is not valid UTF-8")
+    row = {
+        "receiver": parse_smallint(record, "receiver"),
+        "sender": parse_smallint(record, "sender"),
+        "msg": parse_smallint(record, "msg"),
+        "text_msg": text_msg,
+    }
+    position = parse_position(record)
+    if position is not None:
+        row.update(position)
+    return row
+
+
+# Binary records, little-endian, any number of them back to back:
+#
+#   u8   flags
+#   i16  receiver     if flags & FLAG_RECEIVER
+#   i16  sender       if flags & FLAG_SENDER
+#   i16  msg          if flags & FLAG_MSG (required)
+#   f32  latitude     if flags & FLAG_POSITION
+#   f32  longitude    if flags & FLAG_POSITION
+#   u32  unix time    if flags & FLAG_TIMESTAMP, seconds, UTC
+#
+# A reading with a receiver is 5 bytes. The same layout is produced by
+# encode_msg in pico/sim7080_driver.py.
+
+BINARY_CONTENT_TYPE = "application/vnd.lithings.msg"
+
+FLAG_RECEIVER = 0x01
+FLAG_SENDER = 0x02
+FLAG_MSG = 0x04
+FLAG_POSITION = 0x08
+FLAG_TIMESTAMP = 0x10
+
+_FIELDS = (
+    (FLAG_RECEIVER, "h", ("receiver",)),
+    (FLAG_SENDER, "h", ("sender",)),
+    (FLAG_MSG, "h", ("msg",)),
+    (FLAG_POSITION, "ff", ("latitude", "longitude")),
+    (FLAG_TIMESTAMP, "I", ("created_at",)),
+)
+
+# flags -> (Struct, field names), built once for all 32 combinations
+_LAYOUTS = {}
+for _flags in range(32):
+    _fmt = "<"
+    _names = []
+    for _flag, _code, _field_names in _FIELDS:
+        if _flags & _flag:
+            _fmt += _code
+            _names.extend(_field_names)
+    _LAYOUTS[_flags] = (struct.Struct(_fmt), tuple(_names))
+
+
+def encode_msg(msg, receiver=None, sender=None, latitude=None, longitude=None, timestamp=None):
+    flags = FLAG_MSG
+    values = []
+    if receiver is not None:
+        flags |= FLAG_RECEIVER
+        values.append(receiver)
+    if sender is not None:
+        flags |= FLAG_SENDER
+        values.append(sender)
+    values.append(msg)
+    if latitude is not None and longitude is not None:
+        flags |= FLAG_POSITION
+        values.extend((latitude, longitude))
+    if timestamp is not None:
+        flags |= FLAG_TIMESTAMP
+        values.append(int(timestamp))
+    layout, _ = _LAYOUTS[flags]
+    return bytes((flags,)) + layout.pack(*values)
+
+
+def decode_msgs(data):
+    # Rows ready for insert; raises ValueError on the first malformed record
+    # since the rest of the stream can't be realigned after it
+    rows = []
+    offset = 0
+    end = len(data)
+    while offset < end:
+        flags = data[offset]
+        offset += 1
+        if flags not in _LAYOUTS:
+            raise ValueError(f"unknown flags 0x{flags:02x} in record {len(rows)}")
+        if not flags & FLAG_MSG:
+            raise ValueError(f"record {len(rows)} needs msg")
+        layout, names = _LAYOUTS[flags]
+        if offset + layout.size > end:
+            raise ValueError(f"record {len(rows)} is truncated")
+        row = {"receiver": None, "sender": None, "msg": None, "text_msg": None,
+               "latitude": None, "longitude": None, "geocell": None}
+        row.update(zip(names, layout.unpack_from(data, offset)))
+        offset += layout.size
+
+        if flags & FLAG_POSITION:
+            if not valid_position(row["latitude"], row["longitude"]):
+                raise ValueError(f"record {len(rows)} has an invalid position")
+            row["geocell"] = geocell(row["latitude"], row["longitude"])
+        if flags & FLAG_TIMESTAMP:
+            # created_at is a naive UTC timestamp
+            row["created_at"] = datetime.fromtimestamp(row["created_at"], timezone.utc).replace(tzinfo=None)
+        rows.append(row)
+    return rows
@@ -0,0 +1,162 @@
+import math
+import os
+import ssl
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from .metrics import TimedSession
+from .models import metadata
+from .pool import TimedQueuePool
+
+# The engine is built on first use (or by configure_engine), not at import,
+# so importing the app needs neither DATABASE_URL nor a reachable database.
+#
+# Besides Postgres (postgresql+asyncpg://...), a SQLite file works for tests
+# and local benchmarks: sqlite+aiosqlite:///path/to/file.db. The lithings
+# schema is then a second file attached under that name, so schema-qualified
+# SQL runs unchanged. Partitioning, PG_NOTIFY and the CONCURRENTLY-built
+# indexes that SQLite can't express are Postgres only.
+
+# Please note: This is extremely unsecure
+ssl_context = ssl.create_default_context()
+ssl_context.check_hostname = False
+ssl_context.verify_mode = ssl.CERT_NONE
+
+# Sessions of the current engine. TimedSession records per-route database
+# time for /metrics.
+AsyncSessionLocal = sessionmaker(class_=TimedSession, expire_on_commit=False)
+
+_engine = None
+
+# Sessions of the optional read replica (DATABASE_READ_URL), which has a pool
+# of its own. app/replica.py decides which requests may use it.
+ReadSessionLocal = sessionmaker(class_=TimedSession, expire_on_commit=False)
+
+_read_engine = None
+
+
+def pool_options():
+    # Connection pool, see .env.sample. /pool-stats/ shows how long checkouts
+    # wait, which tells whether requests queue on the pool or on Postgres.
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "-1")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "0") == "1",
+    }
+
+
+def asyncpg_connect_args():
+    return {
+        "ssl": ssl_context,
+        # asyncpg's statement cache and SQLAlchemy's prepared statement
+        # cache, both per connection. Set both to 0 behind PgBouncer in
+        # transaction mode.
+        "statement_cache_size": int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100")),
+        "prepared_statement_cache_size": int(os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", "100")),
+    }
+
+
+def build_engine(url=None, **options):
+    # An engine for url (default: $DATABASE_URL). options override the pool
+    # settings; passing a poolclass drops them altogether.
+    url = url or os.getenv("DATABASE_URL")
+    if not url:
+        raise ValueError("DATABASE_URL is not set in the environment variables")
+    if "poolclass" not in options:
+        options = dict(pool_options(), **options)
+    if url.startswith("sqlite"):
+        return create_sqlite_engine(url, **options)
+    return create_async_engine(url, **options, connect_args=asyncpg_connect_args())
+
+
+def configure_engine(url=None, **options):
+    # Builds the app's engine and binds AsyncSessionLocal to it. Dispose of
+    # an earlier engine before replacing it.
+    global _engine
+    engine = build_engine(url, **options)
+    _engine = engine
+    AsyncSessionLocal.configure(bind=engine)
+    return engine
+
+
+def get_engine():
+    if _engine is None:
+        configure_engine()
+    return _engine
+
+
+def read_pool_options():
+    # The replica pool is sized like the primary's unless DB_READ_POOL_SIZE
+    # or DB_READ_MAX_OVERFLOW say otherwise
+    options = pool_options()
+    options["pool_size"] = int(os.getenv("DB_READ_POOL_SIZE") or options["pool_size"])
+    options["max_overflow"] = int(os.getenv("DB_READ_MAX_OVERFLOW") or options["max_overflow"])
+    return options
+
+
+def configure_read_engine(url=None, **options):
+    # Builds the replica engine for url (default: $DATABASE_READ_URL) and
+    # binds ReadSessionLocal to it
+    global _read_engine
+    url = url or os.getenv("DATABASE_READ_URL")
+    if not url:
+        raise ValueError("DATABASE_READ_URL is not set in the environment variables")
+    if "poolclass" not in options:
+        options = dict(read_pool_options(), **options)
+    engine = build_engine(url, **options)
+    _read_engine = engine
+    ReadSessionLocal.configure(bind=engine)
+    return engine
+
+
+def get_read_engine():
+    # None when no replica is configured
+    if _read_engine is None and os.getenv("DATABASE_READ_URL"):
+        configure_read_engine()
+    return _read_engine
+
+
+def dialect_name(conn):
+    # Of an AsyncConnection, AsyncSession or AsyncEngine
+    bind = getattr(conn, "bind", None) or conn
+    return bind.dialect.name
+
+
+# Functions app/geo.py uses that SQLite may lack
+SQLITE_FUNCTIONS = [
+    ("radians", 1, math.radians),
+    ("sin", 1, math.sin),
+    ("cos", 1, math.cos),
+    ("asin", 1, math.asin),
+    ("sqrt", 1, math.sqrt),
+    ("power", 2, math.pow),
+    ("least", -1, lambda *args: min(arg for arg in args if arg is not None)),
+]
+
+
+def create_sqlite_engine(url, **options):
+    engine = create_async_engine(url, **options)
+    path = engine.url.database
+    if not path or path == ":memory:":
+        # Every pooled connection would get a database of its own
+        raise ValueError("SQLite needs a file, e.g. sqlite+aiosqlite:///tmp/lithings.db")
+    schema_path = f"{os.path.splitext(path)[0]}-{metadata.schema}.db"
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"ATTACH DATABASE ? AS {metadata.schema}", (schema_path,))
+        # Concurrent requests use several connections: let readers carry on
+        # during a write and writers wait for each other instead of failing
+        cursor.execute(f"PRAGMA {metadata.schema}.journal_mode = WAL")
+        cursor.execute("PRAGMA busy_timeout = 5000")
+        cursor.close()
+        for name, arity, function in SQLITE_FUNCTIONS:
+            dbapi_connection.create_function(name, arity, function, deterministic=True)
+
+    return engine
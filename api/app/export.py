@@ -0,0 +1,175 @@
+import asyncio
+import csv
+from datetime import datetime
+import io
+import json
+
+from sqlalchemy import BigInteger, Boolean, DateTime, Float, Integer, SmallInteger, select
+
+from .models import msgs
+
+# Bulk export of msgs for offline analysis (GET /export/). Rows come from a
+# server-side cursor in batches of EXPORT_BATCH_ROWS, and each batch is
+# encoded in a worker thread, so an export of any size runs in constant
+# memory and other requests keep the event loop.
+#
+# Formats: NDJSON, CSV and Parquet, one row group per batch. Parquet needs
+# pyarrow (`pip install pyarrow`).
+
+EXPORT_BATCH_ROWS = 5000
+
+EXPORT_COLUMNS = list(msgs.c)
+COLUMN_NAMES = [column.name for column in EXPORT_COLUMNS]
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def export_query(since=None, until=None, after_id=None, up_to_id=None, receiver=None):
+    # Oldest first: [since, until) by time, (after_id, up_to_id] by id
+    query = select(*EXPORT_COLUMNS)
+    if since is not None:
+        query = query.where(msgs.c.created_at >= since)
+    if until is not None:
+        query = query.where(msgs.c.created_at < until)
+    if after_id is not None:
+        query = query.where(msgs.c.id > after_id)
+    if up_to_id is not None:
+        query = query.where(msgs.c.id <= up_to_id)
+    if receiver is not None:
+        query = query.where(msgs.c.receiver == receiver)
+    return query.order_by(msgs.c.id)
+
+
+def json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class NdjsonEncoder:
+    def header(self):
+        return b""
+
+    def encode(self, rows):
+        return "".join(
+            json.dumps(dict(zip(COLUMN_NAMES, map(json_value, row))), separators=(",", ":")) + "\n"
+            for row in rows
+        ).encode()
+
+    def close(self):
+        return b""
+
+
+class CsvEncoder:
+    # Empty fields for NULL, timestamps in ISO 8601
+
+    def _rows(self, rows):
+        out = io.StringIO()
+        csv.writer(out, lineterminator="\n").writerows(rows)
+        return out.getvalue().encode()
+
+    def header(self):
+        return self._rows([COLUMN_NAMES])
+
+    def encode(self, rows):
+        return self._rows([[json_value(value) for value in row] for row in rows])
+
+    def close(self):
+        return b""
+
+
+class _ChunkSink:
+    # Write-only file for pyarrow that hands out what was written since the
+    # last drain() instead of keeping it. tell() still counts every byte,
+    # the Parquet footer records offsets from the start of the file.
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ParquetEncoder:
+    def __init__(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        types = {
+            # Subclasses before Integer, the first match wins
+            SmallInteger: pa.int16(),
+            BigInteger: pa.int64(),
+            Integer: pa.int32(),
+            Float: pa.float64(),
+            Boolean: pa.bool_(),
+            DateTime: pa.timestamp("us"),
+        }
+        self.schema = pa.schema([
+            (column.name, next((t for sql_type, t in types.items() if isinstance(column.type, sql_type)), pa.string()))
+            for column in EXPORT_COLUMNS
+        ])
+        self.sink = _ChunkSink()
+        self.writer = pq.ParquetWriter(pa.PythonFile(self.sink, mode="w"), self.schema)
+
+    def header(self):
+        return self.sink.drain()
+
+    def encode(self, rows):
+        columns = list(zip(*rows)) if rows else [[] for _ in COLUMN_NAMES]
+        table = self.pa.Table.from_arrays(
+            [self.pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema,
+        )
+        self.writer.write_table(table)
+        return self.sink.drain()
+
+    def close(self):
+        self.writer.close()
+        return self.sink.drain()
+
+
+ENCODERS = {"ndjson": NdjsonEncoder, "csv": CsvEncoder, "parquet": ParquetEncoder}
+
+
+async def stream_export(sessions, query, fmt, on_rows=None, batch_rows=EXPORT_BATCH_ROWS):
+    # Response body of an export: bytes per batch. sessions is a
+    # sessionmaker; the generator owns its session because the request's is
+    # closed before a streaming body is sent.
+    encoder = await asyncio.to_thread(ENCODERS[fmt])
+    yield encoder.header()
+    async with sessions() as session:
+        result = await session.stream(query.execution_options(yield_per=batch_rows))
+        async for rows in result.partitions():
+            yield await asyncio.to_thread(encoder.encode, rows)
+            if on_rows is not None:
+                on_rows(len(rows))
+    yield await asyncio.to_thread(encoder.close)
@@ -0,0 +1,144 @@
+import math
+
+from sqlalchemy import and_, func, literal, or_, select
+
+from .models import msgs
+
+# Positions are indexed through a grid cell number: the globe is cut into
+# 0.01 degree cells (about 1.1 km north-south), numbered row by row from the
+# south-west corner. A bounding box then becomes one contiguous range of cell
+# numbers per row it covers, which a B-tree on geocell answers with a few
+# range scans; the exact latitude/longitude test runs on what they return.
+# Planning time grows with the number of ranges (times partitions), so past
+# MAX_CELL_RANGES the box is searched as the single range spanning its rows.
+
+CELLS_PER_DEGREE = 100
+NROWS = 180 * CELLS_PER_DEGREE
+NCOLS = 360 * CELLS_PER_DEGREE
+
+# More ranges than this and a bounding box is searched as one range
+MAX_CELL_RANGES = 128
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def valid_position(latitude, longitude):
+    return (math.isfinite(latitude) and math.isfinite(longitude)
+            and -90 <= latitude <= 90 and -180 <= longitude <= 180)
+
+
+def cell_row(latitude):
+    return min(int((latitude + 90) * CELLS_PER_DEGREE), NROWS - 1)
+
+
+def cell_col(longitude):
+    return min(int((longitude + 180) * CELLS_PER_DEGREE), NCOLS - 1)
+
+
+def geocell(latitude, longitude):
+    if latitude is None or longitude is None:
+        return None
+    return cell_row(latitude) * NCOLS + cell_col(longitude)
+
+
+def cell_ranges(south, west, north, east):
+    # [(first cell, last cell)] covering the box. west > east means the box
+    # crosses the antimeridian.
+    if west > east:
+        col_spans = [(cell_col(west), NCOLS - 1), (0, cell_col(east))]
+    else:
+        col_spans = [(cell_col(west), cell_col(east))]
+    ranges = []
+    for row in range(cell_row(south), cell_row(north) + 1):
+        for first, last in col_spans:
+            start, end = row * NCOLS + first, row * NCOLS + last
+            if ranges and ranges[-1][1] + 1 == start:
+                # Full-width rows join up
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+    if len(ranges) > MAX_CELL_RANGES:
+        return [(ranges[0][0], ranges[-1][1])]
+    return ranges
+
+
+def select_in_bbox(columns, south, west, north, east):
+    cells = or_(*(msgs.c.geocell.between(first, last)
+                  for first, last in cell_ranges(south, west, north, east)))
+    longitude = (
+        msgs.c.longitude.between(west, east) if west <= east
+        else or_(msgs.c.longitude >= west, msgs.c.longitude <= east)
+    )
+    return (
+        select(*columns)
+        .where(and_(cells, msgs.c.latitude.between(south, north), longitude))
+    )
+
+
+def distance_m(latitude, longitude):
+    # Haversine distance from the point to each row, in meters
+    lat1, lat2 = func.radians(literal(latitude)), func.radians(msgs.c.latitude)
+    half_dlat = func.radians(msgs.c.latitude - latitude) / 2
+    half_dlon = func.radians(msgs.c.longitude - longitude) / 2
+    a = func.power(func.sin(half_dlat), 2) + func.cos(lat1) * func.cos(lat2) * func.power(func.sin(half_dlon), 2)
+    return 2 * EARTH_RADIUS_M * func.asin(func.sqrt(func.least(a, 1.0)))
+
+
+POSITION_COLUMNS = (
+    msgs.c.id, msgs.c.created_at, msgs.c.receiver, msgs.c.sender, msgs.c.msg,
+    msgs.c.text_msg, msgs.c.latitude, msgs.c.longitude,
+)
+
+
+def bbox_query(south, west, north, east, since=None, limit=100):
+    # Newest first
+    query = select_in_bbox(POSITION_COLUMNS, south, west, north, east)
+    if since is not None:
+        query = query.where(msgs.c.created_at >= since)
+    return query.order_by(msgs.c.id.desc()).limit(limit)
+
+
+def nearest_query(latitude, longitude, radius, limit, since=None):
+    # Candidates in a square of `radius` degrees around the point, closest
+    # first. Returns the query and the distance in meters within which its
+    # answer is known to be complete.
+    south, north = max(latitude - radius, -90), min(latitude + radius, 90)
+    # Widen in longitude so the square is roughly as wide as it is tall
+    widest = math.cos(math.radians(min(abs(latitude) + radius, 90)))
+    half_width = radius / widest if widest > 0 else 180
+    if half_width >= 180:
+        west, east = -180, 180
+        covered_lon = math.pi / 2
+    else:
+        west = (longitude - half_width + 180) % 360 - 180
+        east = (longitude + half_width + 180) % 360 - 180
+        covered_lon = math.asin(min(1.0, math.sin(math.radians(half_width)) * widest))
+    complete_within = EARTH_RADIUS_M * min(math.radians(radius), covered_lon)
+
+    distance = distance_m(latitude, longitude).label("distance_m")
+    query = select_in_bbox((*POSITION_COLUMNS, distance), south, west, north, east)
+    if since is not None:
+        query = query.where(msgs.c.created_at >= since)
+    return query.order_by(distance, msgs.c.id.desc()).limit(limit), complete_within
+
+
+# First search square for nearest(), about 5 km each way; doubled until the
+# answer is complete
+NEAREST_START_DEGREES = 0.05
+# Widest square, about 55 km each way: its 101 rows of cells stay under
+# MAX_CELL_RANGES. Rows farther away than that are not searched for.
+NEAREST_MAX_DEGREES = 0.5
+
+
+async def nearest(db, latitude, longitude, limit, since=None):
+    radius = NEAREST_START_DEGREES
+    while True:
+        query, complete_within = nearest_query(latitude, longitude, radius, limit, since)
+        rows = (await db.execute(query)).all()
+        # Anything outside the square is farther than complete_within, so a
+        # full answer whose last row is within it is final
+        if len(rows) == limit and rows[-1].distance_m <= complete_within:
+            return rows
+        if radius >= NEAREST_MAX_DEGREES:
+            return rows
+        radius = min(radius * 2, NEAREST_MAX_DEGREES)
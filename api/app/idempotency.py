@@ -0,0 +1,90 @@
+import asyncio
+from datetime import datetime, timezone
+import logging
+import re
+
+from sqlalchemy.exc import IntegrityError
+
+from .models import msg_keys
+
+logger = logging.getLogger(__name__)
+
+# Idempotent POSTs. A device whose request timed out after the server had
+# already committed retries with the same key, and the retry is answered as
+# if it were the first request without inserting again. The key comes from
+# the Idempotency-Key header or, for JSON bodies, from "sender" and "seq".
+#
+# Keys this process committed are answered from an IdempotencyCache
+# (app/cache.py) without a database round trip. Every key is also inserted
+# into msg_keys in the same transaction as its row: a retry that reaches
+# another worker, or comes after the cache evicted its key, fails on the
+# primary key and rolls back instead of duplicating the row.
+
+KEY_HEADER = "idempotency-key"
+
+_VALID_KEY = re.compile(r"[A-Za-z0-9_.:-]{1,64}")
+
+
+def idempotency_key(headers, body=None):
+    # The request's key, None if it has none. Raises ValueError for a
+    # malformed one.
+    key = headers.get(KEY_HEADER)
+    if key is None and isinstance(body, dict):
+        sender, seq = body.get("sender"), body.get("seq")
+        if sender is not None and seq is not None:
+            # Devices count seq up per message; it must not repeat within
+            # the key TTL, e.g. start from a random value at boot
+            key = f"seq:{sender}:{seq}"
+    if key is None:
+        return None
+    if not _VALID_KEY.fullmatch(key):
+        raise ValueError("Idempotency key must be 1-64 letters, digits or _.:-")
+    return key
+
+
+async def claim_key(conn, key, msg_id):
+    # Inside the inserting transaction: False if the key was already used,
+    # in which case the caller must roll back
+    try:
+        await conn.execute(msg_keys.insert().values(key=key, msg_id=msg_id))
+    except IntegrityError:
+        return False
+    return True
+
+
+class KeyPruner:
+    # Background task: delete keys older than ttl. Every worker may run one,
+    # the DELETE is harmless to repeat.
+
+    def __init__(self, engine, ttl, period=600):
+        self.engine = engine
+        self.ttl = ttl
+        self.period = period
+        self._task = None
+
+    async def run_once(self):
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - self.ttl
+        async with self.engine.begin() as conn:
+            result = await conn.execute(msg_keys.delete().where(msg_keys.c.created_at < cutoff))
+        return result.rowcount
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Pruning idempotency keys failed")
+            await asyncio.sleep(self.period)
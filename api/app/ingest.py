@@ -0,0 +1,152 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+async def insert_rows(conn, table, rows):
+    # executemany, which SQLAlchemy sends as multi-row INSERT statements.
+    # That needs every row to have the same keys, so rows that differ (binary
+    # records carrying their own timestamp) go out as separate groups.
+    # Returns the rows with the ids they were given.
+    insert = table.insert().returning(table.c.id, sort_by_parameter_order=True)
+    groups = {}
+    for index, row in enumerate(rows):
+        groups.setdefault(tuple(row), []).append(index)
+    ids = [None] * len(rows)
+    for indexes in groups.values():
+        result = await conn.execute(insert, [rows[i] for i in indexes])
+        for i, msg_id in zip(indexes, result.scalars()):
+            ids[i] = msg_id
+    return [dict(row, id=msg_id) for row, msg_id in zip(rows, ids)]
+
+
+class IngestQueue:
+    # Write-behind buffer for the POST handlers. Rows are queued in memory and
+    # a single background task writes them in batches, so one commit covers
+    # many requests and handlers never wait on the database.
+    #
+    # Queued rows have been acknowledged, so a failed flush is retried until
+    # it succeeds, with backoff up to max_backoff seconds. Meanwhile the
+    # queue fills up and submit() turns new rows away.
+
+    def __init__(self, engine, table, max_size=10000, batch_size=500,
+                 flush_interval=0.05, max_backoff=5.0, before_commit=None, on_flush=None, assign_ids=None):
+        self.engine = engine
+        self.table = table
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.failed_flushes = 0
+        # Hooks get the batch rows, each carrying the id it was given:
+        # before_commit(conn, rows) runs inside the flush transaction,
+        # on_flush(rows) after the commit
+        self.before_commit = before_commit
+        self.on_flush = on_flush
+        # Async callable giving a batch its ids before the insert, for
+        # shards that draw them from a shared sequence (app/shards.py)
+        self.assign_ids = assign_ids
+        self.closing = False
+        self._task = None
+
+    def submit(self, row):
+        if self.closing:
+            raise IngestQueueFull("Ingest queue is shutting down")
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            raise IngestQueueFull("Ingest queue is full")
+
+    def submit_many(self, rows):
+        # All or nothing, a device retrying the request must not duplicate
+        # the part that got in
+        if self.closing:
+            raise IngestQueueFull("Ingest queue is shutting down")
+        if self.room() < len(rows):
+            raise IngestQueueFull("Ingest queue is full")
+        for row in rows:
+            self.queue.put_nowait(row)
+
+    def room(self):
+        return self.queue.maxsize - self.queue.qsize()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Refuse new rows, wait until everything already accepted is written
+        self.closing = True
+        if self._task is None:
+            return
+        await self.queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _next_batch(self):
+        # Block for the first row, then collect until the batch is full or
+        # flush_interval has passed, whichever comes first
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._flush(batch)
+            except Exception:
+                # The writer must outlive any one batch
+                logger.exception("Ingest writer failed on a batch of %d rows", len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _flush(self, batch):
+        assigned = self.assign_ids is None
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if not assigned:
+                    # Once: a retried flush reuses the ids
+                    batch = await self.assign_ids(batch)
+                    assigned = True
+                async with self.engine.begin() as conn:
+                    rows = await insert_rows(conn, self.table, batch)
+                    if self.before_commit is not None:
+                        await self.before_commit(conn, rows)
+                break
+            except asyncio.CancelledError:
+                # Only when the worker is killed before the database is back
+                logger.error("Ingest flush of %d rows cancelled, %d more still queued",
+                             len(batch), self.queue.qsize())
+                raise
+            except Exception:
+                self.failed_flushes += 1
+                logger.exception("Ingest flush of %d rows failed (attempt %d), retrying", len(batch), attempt)
+                await asyncio.sleep(min(0.1 * 2 ** min(attempt, 10), self.max_backoff))
+        if self.on_flush is not None:
+            self.on_flush(rows)
@@ -0,0 +1,38 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from sqlalchemy import text
+
+# Postgres advisory locks that keep one-off work to a single process when
+# several workers (or hosts) share the database. Session-level locks, so the
+# connection should be in AUTOCOMMIT; a crashed holder releases its lock when
+# the connection closes.
+
+MIGRATIONS_LOCK = 742_001
+PARTITION_MAINTENANCE_LOCK = 742_002
+ROLLUP_MERGE_LOCK = 742_003
+
+
+@asynccontextmanager
+async def advisory_lock(conn, key, poll_interval=0.5):
+    # Waits until the lock is free. Polls with pg_try_advisory_lock rather
+    # than blocking in pg_advisory_lock: a statement waiting for the lock
+    # holds a snapshot, and CREATE INDEX CONCURRENTLY run by the holder
+    # waits for every older snapshot, so the two would wait on each other.
+    while not await conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": key}):
+        await asyncio.sleep(poll_interval)
+    try:
+        yield
+    finally:
+        await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+
+
+@asynccontextmanager
+async def try_advisory_lock(conn, key):
+    # Yields False right away if another session holds the lock
+    acquired = await conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": key})
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
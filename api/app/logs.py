@@ -0,0 +1,78 @@
+from datetime import datetime, timezone
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Request handlers only put records on a bounded queue; a listener thread
+# formats them as JSON lines and writes stdout. When stdout backs up the
+# queue fills and records are dropped, never the request.
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        # Fields passed with extra={...}
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread, not here
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handler = None
+
+
+def start_logging(level="INFO", queue_size=10000):
+    global _listener, _handler
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    _handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _listener = logging.handlers.QueueListener(_handler.queue, stream, respect_handler_level=True)
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _listener.start()
+
+
+def stop_logging():
+    global _listener, _handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_handler)
+    # Flushes what's queued before returning
+    _listener.stop()
+    _listener = None
+    _handler = None
+
+
+def dropped_records():
+    return _handler.dropped if _handler is not None else 0
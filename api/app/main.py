@@ -1,65 +1,219 @@
 from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+import html
 import json
-import ssl
+import logging
+import math
+import time
+from typing import Optional
 
 from dotenv import load_dotenv
 import os
-from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi import FastAPI, HTTPException, Request, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-from sqlalchemy import (
-    Table, Column, Integer, String, MetaData, select,
-    DateTime, SmallInteger, Boolean, Float, text, func
-)
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from sqlalchemy import or_, select, text, func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .cache import GLOBAL, IdempotencyCache, LatestMsgCache
+from .codec import BINARY_CONTENT_TYPE, SMALLINT_MAX, SMALLINT_MIN, decode_msgs, parse_msg_record
+from .db import AsyncSessionLocal, ReadSessionLocal, dialect_name, get_engine, get_read_engine
+from .export import FORMATS, export_query, parquet_available, stream_export
+from .geo import bbox_query, nearest
+from .idempotency import KeyPruner, claim_key, idempotency_key
+from .ingest import IngestQueue, IngestQueueFull, insert_rows
+from .logs import dropped_records, start_logging, stop_logging
+from .metrics import MetricsMiddleware, count_rows, registry
+from .migrations import migrate
+from .models import metadata, msgs
+from .partitions import INTERVALS, PartitionMaintainer, recent_window
+from .pubsub import NOTIFY_CHANNEL, MissedMsgs, MsgBroker, PgNotifyListener
+from .ratelimit import ConcurrencyLimiter, RateLimiter, RedisRateLimiter
+from .replica import WRITTEN_ID_HEADER, ReplicaMonitor
+from .rollups import MAX_HOURLY_BUCKETS, RollupMerger, stats_queries, update_rollups
+from .shards import ShardedIngestQueue, ShardSet
 
-# Please note: This is extremely unsecure
-ssl_context = ssl.create_default_context()
-ssl_context.check_hostname = False
-ssl_context.verify_mode = ssl.CERT_NONE
+logger = logging.getLogger(__name__)
 
 load_dotenv()  
 
-# Database configuration
-DATABASE_URL = os.getenv("DATABASE_URL")
+# The database engine is created on startup from DATABASE_URL and the DB_*
+# pool settings (see app/db.py and .env.sample), not at import
 
-# Ensure the DATABASE_URL is set
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL is not set in the environment variables")
+# Ingest mode: "sync" commits every POST before answering, "queue" hands rows
+# to a background writer that inserts them in batches (see app/ingest.py)
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "50"))
 
-engine = create_async_engine(
-    DATABASE_URL,
-    connect_args={"ssl": ssl_context}
-)
-AsyncSessionLocal = sessionmaker(class_=AsyncSession, expire_on_commit=False, bind=engine)
-
-metadata = MetaData(schema="lithings")
-
-msgs = Table(
-    "msgs",
-    metadata,
-    Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("created_at", DateTime(timezone=False), nullable=False, server_default=text("CURRENT_TIMESTAMP")),
-    Column("sender", SmallInteger(), nullable=True),
-    Column("receiver", SmallInteger(), nullable=True),
-    Column("msg", SmallInteger(), nullable=True),
-    Column("text_msg", String(255), nullable=True),
-    Column("latitude", Float(), nullable=True),
-    Column("longitude", Float(), nullable=True),
-    Column("delivered", Boolean(), nullable=True),
-    Column("seen", Boolean(), nullable=True),
-)
+if INGEST_MODE not in ("sync", "queue"):
+    raise ValueError(f"Unknown INGEST_MODE: {INGEST_MODE}")
+
+ingest_queue = None
+
+# JSON log lines on stdout, written by a background thread (see app/logs.py)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Seconds a cached /latest-text-msg/ answer may be served without asking the
+# database. Writes through this process update the cache immediately; the TTL
+# only matters for rows inserted by other workers or by hand.
+LATEST_CACHE_TTL = float(os.getenv("LATEST_CACHE_TTL", "5"))
+
+latest_cache = LatestMsgCache(ttl=LATEST_CACHE_TTL)
+# Newest id of any row, globally and per receiver: the ETag of the lists
+high_water = LatestMsgCache(ttl=LATEST_CACHE_TTL)
+
+# New text messages are pushed to /wait-text-msg/ and /text-msgs/stream
+# through an in-process broker. With PG_NOTIFY=1 every insert also sends a
+# Postgres NOTIFY and the broker is fed from LISTEN instead, so clients of
+# any worker see messages posted to any other worker.
+PG_NOTIFY = os.getenv("PG_NOTIFY", "0") == "1"
+LONG_POLL_MAX_SECONDS = 60
+SSE_KEEPALIVE_SECONDS = 15
+# Rows per database read when a stream replays what a client missed
+SSE_REPLAY_PAGE = 1000
+
+broker = MsgBroker()
+notify_listeners = []
+
+# Idempotency keys on /post-msg/ and /post-text-msg/ (see app/idempotency.py)
+# are remembered for IDEMPOTENCY_TTL_SECONDS; the newest
+# IDEMPOTENCY_CACHE_SIZE are answered from memory. In queue mode the cache
+# is the only check.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+
+idempotency_cache = IdempotencyCache(max_size=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL_SECONDS)
+key_pruners = []
+
+# Optional partitioning of msgs by created_at, "daily" or "monthly" (see
+# app/partitions.py). Partitions are created MSGS_PARTITIONS_AHEAD periods in
+# advance; with MSGS_RETENTION_DAYS set, older ones are dropped whole.
+MSGS_PARTITIONING = os.getenv("MSGS_PARTITIONING") or None
+MSGS_PARTITIONS_AHEAD = int(os.getenv("MSGS_PARTITIONS_AHEAD", "3"))
+MSGS_RETENTION_DAYS = int(os.getenv("MSGS_RETENTION_DAYS", "0"))
+
+if MSGS_PARTITIONING is not None and MSGS_PARTITIONING not in INTERVALS:
+    raise ValueError(f"Unknown MSGS_PARTITIONING: {MSGS_PARTITIONING}")
+
+partition_maintainers = []
+
+# Inserts append their counts to msgs_rollup_deltas, folded into the rollup
+# tables every ROLLUP_MERGE_SECONDS (see app/rollups.py)
+ROLLUP_MERGE_SECONDS = float(os.getenv("ROLLUP_MERGE_SECONDS", "5"))
+
+rollup_mergers = []
+
+# Optional read replica, DATABASE_READ_URL (see app/replica.py). Reads fall
+# back to the primary while it lags more than REPLICA_MAX_LAG_SECONDS, and
+# for a client's read whose min_id the replica hasn't replayed yet.
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+
+replica_monitor = None
+
+# Optional sharding of msgs by receiver, DATABASE_SHARDS="a=url,b=url" (see
+# app/shards.py). Every shard is migrated and maintained like the main
+# database, which keeps handing out the ids. Not combined with a replica.
+shards = None
+
+# Admission control (see app/ratelimit.py). Posts are limited to
+# RATE_LIMIT_PER_SECOND per client address, with bursts of
+# RATE_LIMIT_BURST; 0 turns it off. Not per sender: that is whatever the
+# body claims.
+# With RATE_LIMIT_REDIS_URL the buckets are shared by all workers. At most
+# DB_CONCURRENCY_LIMIT DB-bound requests run at once per worker (0: no cap).
+# Either way the answer is a 429 with Retry-After, before any database work.
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL") or None
+DB_CONCURRENCY_LIMIT = int(os.getenv("DB_CONCURRENCY_LIMIT", "0"))
+
+rate_limiter = None
+if RATE_LIMIT_PER_SECOND > 0:
+    if RATE_LIMIT_REDIS_URL:
+        rate_limiter = RedisRateLimiter(RATE_LIMIT_REDIS_URL, RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+    else:
+        rate_limiter = RateLimiter(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+db_limiter = ConcurrencyLimiter(DB_CONCURRENCY_LIMIT) if DB_CONCURRENCY_LIMIT > 0 else None
+
+# Keyset pagination: list endpoints never return more than PAGE_SIZE_MAX rows
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 1000
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async def create_tables():
-        async with engine.begin() as conn:
-            await conn.run_sync(metadata.create_all)
-        async with engine.begin() as conn:
-            await conn.run_sync(metadata.create_all)
-    await create_tables()
-    yield
+    start_logging(LOG_LEVEL)
+    engine = get_engine()
+
+    global ingest_queue, notify_listeners, partition_maintainers, key_pruners, rollup_mergers, replica_monitor, shards
+    shards = ShardSet.from_env()
+    read_engine = get_read_engine()
+    if shards is not None and read_engine is not None:
+        raise ValueError("DATABASE_READ_URL can't be combined with DATABASE_SHARDS")
+    engines = shards.engines() if shards is not None else [engine]
+    if PG_NOTIFY and any(dialect_name(db_engine) != "postgresql" for db_engine in engines):
+        raise ValueError("PG_NOTIFY needs a Postgres DATABASE_URL")
+    for db_engine in engines:
+        await migrate(db_engine, MSGS_PARTITIONING)
+
+    if read_engine is not None:
+        replica_monitor = ReplicaMonitor(read_engine, max_lag=REPLICA_MAX_LAG_SECONDS)
+        replica_monitor.start()
+    key_pruners = [KeyPruner(db_engine, timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)) for db_engine in engines]
+    rollup_mergers = [RollupMerger(db_engine, ROLLUP_MERGE_SECONDS) for db_engine in engines]
+    if MSGS_PARTITIONING:
+        partition_maintainers = [
+            PartitionMaintainer(
+                db_engine,
+                MSGS_PARTITIONING,
+                ahead=MSGS_PARTITIONS_AHEAD,
+                retention=timedelta(days=MSGS_RETENTION_DAYS) if MSGS_RETENTION_DAYS else None,
+            )
+            for db_engine in engines
+        ]
+    if PG_NOTIFY:
+        notify_listeners = [
+            PgNotifyListener(db_engine, on_new_text_msg, on_reconnect=on_listen_reconnect) for db_engine in engines
+        ]
+    for task in (*key_pruners, *rollup_mergers, *partition_maintainers, *notify_listeners):
+        task.start()
+    if INGEST_MODE == "queue":
+        options = dict(
+            max_size=INGEST_QUEUE_SIZE,
+            batch_size=INGEST_BATCH_SIZE,
+            flush_interval=INGEST_FLUSH_MS / 1000,
+            before_commit=before_commit,
+            on_flush=announce_rows,
+        )
+        if shards is not None:
+            # A queue and a writer per shard
+            ingest_queue = ShardedIngestQueue(shards, msgs, **options)
+        else:
+            ingest_queue = IngestQueue(engine, msgs, **options)
+        ingest_queue.start()
+    try:
+        yield
+    finally:
+        if ingest_queue is not None:
+            # Write out everything already acknowledged before exiting
+            await ingest_queue.stop()
+            ingest_queue = None
+        for task in (*notify_listeners, *partition_maintainers, *rollup_mergers, *key_pruners):
+            await task.stop()
+        notify_listeners, partition_maintainers, rollup_mergers, key_pruners = [], [], [], []
+        if rate_limiter is not None:
+            await rate_limiter.close()
+        if replica_monitor is not None:
+            await replica_monitor.stop()
+            replica_monitor = None
+            await read_engine.dispose()
+        if shards is not None:
+            await shards.dispose()
+            shards = None
+        await engine.dispose()
+        stop_logging()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -70,100 +224,996 @@ app.add_middleware(
 #    allow_credentials=True, (enable when origins are specified)
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    # Read by htmx when /all-messages/rows replaces the whole table
+    expose_headers=["HX-Retarget", "HX-Reswap", WRITTEN_ID_HEADER],
 )
+# Added last so it wraps CORS too
+app.add_middleware(MetricsMiddleware)
+
+def request_receiver(request):
+    # The receiver query parameter, for routing to its shard before the
+    # handler's own validation runs
+    try:
+        return int(request.query_params["receiver"])
+    except (KeyError, ValueError):
+        return None
 
-async def get_db():
-    async with AsyncSessionLocal() as session:
+def receiver_sessions(receiver):
+    # Sessionmaker of the database holding the receiver's rows; without a
+    # receiver, of every shard at once
+    if shards is None:
+        return AsyncSessionLocal
+    return shards.sessions_for(receiver)
+
+async def get_db(request: Request):
+    async with receiver_sessions(request_receiver(request))() as session:
         yield session
 
-@app.get("/latest-text-msg/")
-async def get_latest_text_msg(db: AsyncSession = Depends(get_db)):
-    query = select(msgs.c.text_msg).order_by(msgs.c.id.desc()).limit(1)
-    result = await db.execute(query)
-    latest_text_msg = result.scalar_one_or_none()
+async def db_slot():
+    # Route dependency of the DB-bound handlers: turn requests away while
+    # DB_CONCURRENCY_LIMIT are already running
+    if db_limiter is None:
+        yield
+        return
+    if not db_limiter.try_acquire():
+        raise HTTPException(status_code=429, detail="Too many requests in progress", headers={"Retry-After": "1"})
+    try:
+        yield
+    finally:
+        db_limiter.release()
+
+async def limited(body):
+    # Streaming bodies run after the route's dependencies have exited and
+    # given db_slot back, so they hold a slot of their own while they read.
+    # Admission was decided by db_slot; here the body waits for its turn.
+    try:
+        if db_limiter is None:
+            async for chunk in body:
+                yield chunk
+            return
+        await db_limiter.acquire()
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            db_limiter.release()
+    finally:
+        await body.aclose()
+
+async def check_rate(request):
+    if rate_limiter is None:
+        return
+    # Behind a proxy, run with --proxy-headers/forwarded_allow_ips so this
+    # is the device's address
+    wait = await rate_limiter.acquire(f"ip:{request.client.host if request.client else '-'}")
+    if wait > 0:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded",
+                            headers={"Retry-After": str(math.ceil(wait))})
+
+def request_min_id(request):
+    # Read-your-writes token: the Written-Id of the client's last post
+    try:
+        return int(request.query_params["min_id"])
+    except (KeyError, ValueError):
+        return None
+
+async def get_read_db(request: Request, db: AsyncSession = Depends(get_db)):
+    # For read-only handlers
+    async with read_session(request, db) as session:
+        yield session
+
+@asynccontextmanager
+async def read_session(request, db):
+    # A replica session when the replica is usable, otherwise db, the
+    # primary's (which opens no connection unless used)
+    if replica_monitor is None or not replica_monitor.available:
+        if replica_monitor is not None:
+            replica_monitor.record(False)
+        yield db
+        return
+    async with ReadSessionLocal() as session:
+        try:
+            # Check out now, so a replica that went down since the last
+            # check costs a fallback rather than a 500
+            await session.connection()
+            usable = True
+        except (SQLAlchemyError, OSError) as e:
+            replica_monitor.mark_down(e)
+            usable = False
+        min_id = request_min_id(request)
+        if usable and min_id is not None:
+            # Behind the client's own write: this read goes to the primary
+            usable = await newest_id(session) >= min_id
+        replica_monitor.record(usable)
+        yield session if usable else db
+
+def reads_replica(db):
+    # Never with shards, which don't combine with a replica
+    read_engine = get_read_engine()
+    return shards is None and read_engine is not None and db.bind is read_engine
+
+def session_factory(db):
+    # Sessionmaker for work that outlives the request's session, matching
+    # the database db reads from
+    if shards is not None:
+        return shards.session_factory(db)
+    if reads_replica(db):
+        return ReadSessionLocal
+    return AsyncSessionLocal
+
+def remember_write(response, rows):
+    # Read-your-writes token, for the client to pass back as min_id
+    response.headers[WRITTEN_ID_HEADER] = str(max(row["id"] for row in rows))
+    return response
+
+def remember_latest(msg_id, receiver, text_msg):
+    latest_cache.put(GLOBAL, msg_id, text_msg)
+    if receiver is not None:
+        latest_cache.put(receiver, msg_id, text_msg)
+
+def text_msg_events(rows):
+    return [
+        {"id": row["id"], "receiver": row["receiver"], "text_msg": row["text_msg"]}
+        for row in rows
+        if row["text_msg"] is not None
+    ]
+
+def on_new_text_msg(msg):
+    remember_latest(msg["id"], msg["receiver"], msg["text_msg"])
+    broker.publish(msg)
+
+def on_listen_reconnect():
+    # Other workers' inserts while LISTEN was down never arrived: forget
+    # what they would have updated, and have waiters read the database
+    latest_cache.clear()
+    high_water.clear()
+    broker.resync()
+
+async def notify_text_msgs(conn, rows):
+    # Runs inside the inserting transaction, Postgres delivers on commit
+    payloads = [json.dumps(msg) for msg in text_msg_events(rows)]
+    if PG_NOTIFY and payloads:
+        await conn.execute(
+            text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"),
+            {"channel": NOTIFY_CHANNEL, "payloads": payloads},
+        )
+
+async def before_commit(conn, rows):
+    # Everything that must commit together with the inserted rows
+    await notify_text_msgs(conn, rows)
+    await update_rollups(conn, rows)
+
+def announce_rows(rows):
+    # Called after commit with rows that carry their ids. With PG_NOTIFY the
+    # listener publishes text messages, to this worker as well as the others.
+    for row in rows:
+        high_water.put(GLOBAL, row["id"], None)
+        if row["receiver"] is not None:
+            high_water.put(row["receiver"], row["id"], None)
+    for msg in text_msg_events(rows):
+        remember_latest(msg["id"], msg["receiver"], msg["text_msg"])
+        if not PG_NOTIFY:
+            broker.publish(msg)
+
+def scoped(query, receiver=None, sender=None, since=None):
+    if receiver is not None:
+        query = query.where(msgs.c.receiver == receiver)
+    if sender is not None:
+        query = query.where(msgs.c.sender == sender)
+    # A created_at bound is what lets Postgres skip partitions
+    if since is not None:
+        query = query.where(msgs.c.created_at >= since)
+    return query
+
+def recent_cutoff():
+    # Evaluated by Postgres, so the partitions are pruned at executor start
+    return func.localtimestamp() - recent_window(MSGS_PARTITIONING)
+
+def latest_text_query(receiver=None, sender=None, since=None):
+    # Served by msgs_text_id_idx / msgs_text_receiver_id_idx (app/migrations.py)
+    query = select(msgs.c.id, msgs.c.text_msg).where(msgs.c.text_msg.isnot(None))
+    return scoped(query, receiver, sender, since).order_by(msgs.c.id.desc()).limit(1)
+
+async def lookup_latest(db, receiver, sender=None):
+    # (id, text_msg) of the newest text message, (0, None) if there is none
+    cached = cached_latest(receiver, sender)
+    if cached is None:
+        cached = await query_latest(db, receiver, sender)
+    return cached
+
+def cached_latest(receiver, sender=None):
+    # Only the global and per-receiver answers are cached
+    if sender is not None:
+        return None
+    return latest_cache.get(GLOBAL if receiver is None else receiver)
+
+async def query_latest(db, receiver, sender=None):
+    row = None
+    if MSGS_PARTITIONING:
+        # Look in the newest partitions first, so the cost doesn't grow
+        # with the number of partitions kept
+        result = await db.execute(latest_text_query(receiver, sender, recent_cutoff()))
+        row = result.first()
+    if row is None:
+        result = await db.execute(latest_text_query(receiver, sender))
+        row = result.first()
+    latest = (row.id, row.text_msg) if row else (0, None)
+    if sender is None:
+        latest_cache.put(GLOBAL if receiver is None else receiver, *latest)
+    return latest
+
+async def newest_id(db, receiver=None):
+    # Ordered rather than max(id), so shards' answers can be merged
+    return await db.scalar(scoped(select(msgs.c.id), receiver).order_by(msgs.c.id.desc()).limit(1)) or 0
+
+async def lookup_high_water(db, receiver):
+    # Newest id of any row for the receiver (or globally), 0 for none. The
+    # cache follows the primary, a replica is asked itself: the ETag has to
+    # describe the rows the body is read from.
+    if reads_replica(db):
+        return await newest_id(db, receiver)
+    key = GLOBAL if receiver is None else receiver
+    cached = high_water.get(key)
+    if cached is None:
+        hwm = await newest_id(db, receiver)
+        high_water.put(key, hwm, None)
+        return hwm
+    return cached[0]
+
+def etag_matches(request, etag):
+    # Weak comparison. Devices can't put quotes inside an AT+SHAHEAD value,
+    # so bare tags are accepted too.
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    bare = etag.strip('"')
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/").strip('"') == bare:
+            return True
+    return False
+
+def not_modified(etag):
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+@app.get("/latest-text-msg/", dependencies=[Depends(db_slot)])
+async def get_latest_text_msg(
+    request: Request,
+    response: Response,
+    receiver: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    sender: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    db: AsyncSession = Depends(get_db),
+):
+    # A cache hit answers a matching If-None-Match without touching the
+    # database, or checking out a replica session; a miss reads like any
+    # other read-only handler
+    latest = cached_latest(receiver, sender)
+    if latest is None:
+        async with read_session(request, db) as session:
+            latest = await query_latest(session, receiver, sender)
+    msg_id, latest_text_msg = latest
+    etag = f'"{msg_id}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
     if latest_text_msg is None:
         return {"text_msg": "No messages found"}
-    return {"text_msg": latest_text_msg}
+    # The id lets devices, which can't read response headers, send If-None-Match
+    return {"text_msg": latest_text_msg, "id": msg_id}
+
+@app.get("/wait-text-msg/")
+async def wait_text_msg(
+    after_id: int = 0,
+    receiver: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    timeout: float = Query(25, ge=0, le=LONG_POLL_MAX_SECONDS),
+    db: AsyncSession = Depends(get_db),
+):
+    epoch = broker.epoch
+    msg_id, latest_text_msg = await lookup_latest(db, receiver)
+    # Don't keep a pooled connection while the request is parked
+    await db.close()
+    if msg_id > after_id:
+        return {"id": msg_id, "text_msg": latest_text_msg}
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            found = await broker.wait(after_id, receiver, max(deadline - time.monotonic(), 0), epoch)
+            break
+        except MissedMsgs:
+            epoch, floor = broker.epoch, broker.evicted_id
+            found = await missed_text_msgs(receiver, after_id)
+            if found:
+                break
+            after_id = max(after_id, floor)
+    if not found:
+        return Response(status_code=204)
+    return {"id": found[-1]["id"], "text_msg": found[-1]["text_msg"]}
+
+def sse_event(msg):
+    return f"id: {msg['id']}\ndata: {json.dumps(msg)}\n\n"
+
+async def missed_text_msgs(receiver, after_id, limit=PAGE_SIZE_MAX):
+    # Text messages after after_id from the database, oldest first, for
+    # cursors the broker can't serve
+    query = select(msgs.c.id, msgs.c.receiver, msgs.c.text_msg).where(
+        msgs.c.id > after_id, msgs.c.text_msg.isnot(None)
+    )
+    if receiver is not None:
+        query = query.where(msgs.c.receiver == receiver)
+    async with receiver_sessions(receiver)() as session:
+        result = await session.execute(query.order_by(msgs.c.id).limit(limit))
+        return [dict(row._mapping) for row in result]
 
-@app.get("/all-text-msgs/")
-async def get_all_text_msgs(db: AsyncSession = Depends(get_db)):
-    query = select(msgs.c.text_msg).order_by(msgs.c.id.desc())
+async def sse_text_msgs(receiver, last_event_id):
+    yield "retry: 5000\n\n"
+
+    epoch = broker.epoch
+    if last_event_id is not None:
+        # Reconnecting client: replay what it missed
+        after_id = last_event_id
+        missed = await missed_text_msgs(receiver, after_id, SSE_REPLAY_PAGE)
+    else:
+        async with receiver_sessions(receiver)() as session:
+            after_id, _ = await lookup_latest(session, receiver)
+        missed = []
+
+    floor = 0
+    while True:
+        for msg in missed:
+            yield sse_event(msg)
+            after_id = msg["id"]
+        if len(missed) == SSE_REPLAY_PAGE:
+            # More backlog than a page: the broker takes over only once the
+            # database has been read to the end
+            missed = await missed_text_msgs(receiver, after_id, SSE_REPLAY_PAGE)
+            continue
+        after_id = max(after_id, floor)
+        try:
+            found = await broker.wait(after_id, receiver, SSE_KEEPALIVE_SECONDS, epoch)
+        except MissedMsgs:
+            # Fell behind the broker's history, or LISTEN reconnected:
+            # continue from the database. Everything up to floor was
+            # committed before it left the history, so a complete read
+            # covers it.
+            epoch, floor = broker.epoch, broker.evicted_id
+            missed = await missed_text_msgs(receiver, after_id, SSE_REPLAY_PAGE)
+            continue
+        missed = []
+        if not found:
+            yield ": keepalive\n\n"
+        for msg in found:
+            yield sse_event(msg)
+            after_id = msg["id"]
+
+@app.get("/text-msgs/stream")
+async def stream_text_msgs(request: Request, receiver: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX)):
+    last_event_id = request.headers.get("last-event-id")
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    return StreamingResponse(
+        sse_text_msgs(receiver, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/cache-stats/")
+async def get_cache_stats():
+    return latest_cache.stats()
+
+@app.get("/pool-stats/")
+async def get_pool_stats():
+    return get_engine().pool.stats()
+
+@app.get("/shard-stats/")
+async def get_shard_stats():
+    if shards is None:
+        return {"configured": False}
+    return {"configured": True, "pools": shards.stats()}
+
+@app.get("/replica-stats/")
+async def get_replica_stats():
+    if replica_monitor is None:
+        return {"configured": False}
+    return dict(replica_monitor.stats(), configured=True, pool=get_read_engine().pool.stats())
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text exposition format, per worker process
+    pool = get_engine().pool.stats()
+    cache = latest_cache.stats()
+    keys = idempotency_cache.stats()
+    gauges = [
+        ("db_pool_checked_out", "Connections in use", pool["checked_out"]),
+        ("db_pool_idle", "Idle connections in the pool", pool["idle"]),
+        ("db_pool_overflow", "Connections open beyond pool_size", pool["overflow"]),
+    ]
+    counters = [
+        ("db_pool_timeouts_total", "Checkouts that gave up after pool_timeout", pool["timeouts"]),
+        ("latest_cache_hits_total", "Latest-message lookups served from memory", cache["hits"]),
+        ("latest_cache_misses_total", "Latest-message lookups that queried the database", cache["misses"]),
+        ("idempotent_replays_total", "Retried posts answered from the idempotency cache", keys["hits"]),
+        ("log_records_dropped_total", "Log records dropped because the log queue was full", dropped_records()),
+    ]
+    if db_limiter is not None:
+        gauges.append(("db_requests_in_flight", "DB-bound requests running", db_limiter.in_flight))
+        counters.append(("db_concurrency_rejected_total", "Requests turned away by DB_CONCURRENCY_LIMIT", db_limiter.rejected))
+    if rate_limiter is not None:
+        counters.append(("rate_limited_total", "Posts turned away by the rate limit", rate_limiter.stats()["rejected"]))
+    if replica_monitor is not None:
+        replica = replica_monitor.stats()
+        gauges += [
+            ("db_replica_available", "1 while reads may go to the replica", int(replica["available"])),
+            ("db_replica_lag_seconds", "Replay lag of the replica at the last check", replica["lag_seconds"] or 0),
+        ]
+        counters += [
+            ("db_replica_reads_total", "Read requests served by the replica", replica["replica_reads"]),
+            ("db_primary_reads_total", "Read requests sent to the primary while a replica is configured", replica["primary_reads"]),
+        ]
+    return PlainTextResponse(
+        registry.render(gauges, counters),
+        media_type="text/plain; version=0.0.4",
+    )
+
+def paginate(query, before_id, limit):
+    # Fetch one extra row so we know whether an older page exists
+    if before_id is not None:
+        query = query.where(msgs.c.id < before_id)
+    return query.order_by(msgs.c.id.desc()).limit(limit + 1)
+
+def next_cursor(rows, limit):
+    if len(rows) > limit:
+        return rows[limit - 1].id
+    return None
+
+def text_msgs_query(receiver=None, sender=None, before_id=None, limit=PAGE_SIZE_DEFAULT, since=None):
+    query = select(msgs.c.id, msgs.c.text_msg).where(msgs.c.text_msg.isnot(None))
+    return paginate(scoped(query, receiver, sender, since), before_id, limit)
+
+def msgs_query(receiver=None, sender=None, before_id=None, limit=PAGE_SIZE_DEFAULT, since=None):
+    query = select(msgs.c.id, msgs.c.msg).where(msgs.c.msg.isnot(None))
+    return paginate(scoped(query, receiver, sender, since), before_id, limit)
+
+@app.get("/all-text-msgs/", dependencies=[Depends(db_slot)])
+async def get_all_text_msgs(
+    request: Request,
+    response: Response,
+    receiver: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    sender: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    before_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # Any page can only change when a newer row for the receiver arrives
+    etag = f'"{await lookup_high_water(db, receiver)}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+    query = text_msgs_query(receiver, sender, before_id, limit, since)
     result = await db.execute(query)
-    all_text_msgs = result.scalars().all()
+    rows = result.all()
+    all_text_msgs = [row.text_msg for row in rows[:limit]]
+    count_rows(len(all_text_msgs))
     if not all_text_msgs:
-        return {"text_msgs": "No messages found"}
-    return {"text_msgs": all_text_msgs}
+        return {"text_msgs": "No messages found", "next_cursor": None}
+    return {"text_msgs": all_text_msgs, "next_cursor": next_cursor(rows, limit)}
 
-@app.get("/all-msgs/")
-async def get_all_text_msgs(db: AsyncSession = Depends(get_db)):
-    query = select(msgs.c.msg).order_by(msgs.c.id.desc())
+@app.get("/all-msgs/", dependencies=[Depends(db_slot)])
+async def get_all_msgs(
+    request: Request,
+    response: Response,
+    receiver: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    sender: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    before_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_read_db),
+):
+    etag = f'"{await lookup_high_water(db, receiver)}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+    query = msgs_query(receiver, sender, before_id, limit, since)
     result = await db.execute(query)
-    all_msgs = result.scalars().all()
+    rows = result.all()
+    all_msgs = [row.msg for row in rows[:limit]]
+    count_rows(len(all_msgs))
     if not all_msgs:
-        return {"msgs": "No messages found"}
-    return {"msgs": all_msgs}
+        return {"msgs": "No messages found", "next_cursor": None}
+    return {"msgs": all_msgs, "next_cursor": next_cursor(rows, limit)}
+
+def inbox_query(receiver, after_id=0, limit=PAGE_SIZE_DEFAULT):
+    # Served by msgs_undelivered_idx (app/migrations.py). Oldest first, one
+    # extra row tells whether more is pending.
+    query = select(
+        msgs.c.id, msgs.c.created_at, msgs.c.sender, msgs.c.msg, msgs.c.text_msg
+    ).where(
+        msgs.c.receiver == receiver,
+        msgs.c.delivered.isnot(True),
+        msgs.c.id > after_id,
+    )
+    return query.order_by(msgs.c.id).limit(limit + 1)
+
+def inbox_row(row):
+    # Devices parse this with little memory, so empty fields are left out
+    entry = {"id": row.id, "created_at": row.created_at.isoformat(timespec="seconds")}
+    for key in ("sender", "msg", "text_msg"):
+        if row._mapping[key] is not None:
+            entry[key] = row._mapping[key]
+    return entry
+
+@app.get("/inbox/", dependencies=[Depends(db_slot)])
+async def get_inbox(
+    receiver: int = Query(..., ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    after_id: int = 0,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_db),
+):
+    # Everything addressed to the receiver that it hasn't acknowledged yet.
+    # Rows stay in the inbox until POST /inbox/ack; after_id is the client's
+    # cursor within one drain, next_cursor is set when more is pending.
+    rows = (await db.execute(inbox_query(receiver, after_id, limit))).all()
+    count_rows(min(len(rows), limit))
+    return {
+        "msgs": [inbox_row(row) for row in rows[:limit]],
+        "next_cursor": rows[limit - 1].id if len(rows) > limit else None,
+    }
 
-@app.post("/post-msg/")
-async def insert_or_update_msg(request: Request, db: AsyncSession = Depends(get_db)):
+def ack_ids(body):
+    # The id condition of an ack: an explicit list, or the range
+    # (after_id, up_to_id]
+    ids = body.get("ids")
+    up_to_id = body.get("up_to_id")
+    if (ids is None) == (up_to_id is None):
+        raise HTTPException(status_code=400, detail="Expected either ids or up_to_id")
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise HTTPException(status_code=400, detail="ids must be a list of integers")
+        if len(ids) > PAGE_SIZE_MAX:
+            raise HTTPException(status_code=413, detail=f"At most {PAGE_SIZE_MAX} ids per ack")
+        return msgs.c.id.in_(ids)
+    after_id = body.get("after_id", 0)
+    for value in (up_to_id, after_id):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise HTTPException(status_code=400, detail="up_to_id and after_id must be integers")
+    return msgs.c.id.between(after_id + 1, up_to_id)
+
+@app.post("/inbox/ack", dependencies=[Depends(db_slot)])
+async def ack_inbox(request: Request, db: AsyncSession = Depends(get_db)):
+    # Marks messages of one receiver delivered, and seen with "seen": true,
+    # in a single UPDATE. Acknowledging twice is harmless.
     try:
-        # Attempt to parse the request body as JSON
-        parsed_body = await request.json()
-    except json.JSONDecodeError:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
         raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Expected a JSON object")
+    receiver = body.get("receiver")
+    if not isinstance(receiver, int) or isinstance(receiver, bool):
+        raise HTTPException(status_code=400, detail="receiver must be an integer")
+    if not SMALLINT_MIN <= receiver <= SMALLINT_MAX:
+        raise HTTPException(status_code=400, detail="receiver out of range")
+    selected = ack_ids(body)
 
-    receiver = parsed_body.get("receiver")
-    msg = parsed_body.get("msg")
+    if body.get("seen"):
+        values = {"delivered": True, "seen": True}
+        pending = or_(msgs.c.delivered.isnot(True), msgs.c.seen.isnot(True))
+    else:
+        values = {"delivered": True}
+        pending = msgs.c.delivered.isnot(True)
+    update = msgs.update().where(msgs.c.receiver == receiver, selected, pending).values(**values)
+    if shards is not None:
+        # Routed by the receiver in the body, the query string has none
+        async with shards.shard_for(receiver).sessions() as session:
+            return await apply_ack(session, update)
+    return await apply_ack(db, update)
+
+async def apply_ack(db, update):
+    try:
+        result = await db.execute(update)
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "ok", "acknowledged": result.rowcount}
+
+def utc_naive(moment):
+    # created_at and the rollup buckets are naive UTC
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+@app.get("/stats/", dependencies=[Depends(db_slot)])
+async def get_stats(
+    receiver: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    resolution: Optional[str] = Query(None, pattern="^(hour|day)$"),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # Reading counts per receiver and bucket, and how often each value was
+    # seen, from the rollup tables (app/rollups.py). Defaults to the last day.
+    until = utc_naive(until) if until else datetime.now(timezone.utc).replace(tzinfo=None)
+    since = utc_naive(since) if since else until - timedelta(days=1)
+    if since >= until:
+        raise HTTPException(status_code=400, detail="since must be before until")
+    if resolution is None:
+        resolution = "hour" if until - since <= timedelta(days=7) else "day"
+    if resolution == "hour" and until - since > timedelta(hours=MAX_HOURLY_BUCKETS):
+        raise HTTPException(status_code=400, detail=f"At most {MAX_HOURLY_BUCKETS} hourly buckets")
 
-    print(f"Message receiver: {receiver}, msg: {msg}")
+    buckets_query, distribution_query = stats_queries(resolution, since, until, receiver)
+    buckets = sum_counts((await db.execute(buckets_query)).all(), "start", "receiver")
+    distribution = sum_counts((await db.execute(distribution_query)).all(), "msg")
+    count_rows(len(buckets) + len(distribution))
+    return {
+        "resolution": resolution,
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "receiver": receiver,
+        "total": sum(distribution.values()),
+        "buckets": [
+            {"start": start.isoformat(), "receiver": bucket_receiver, "count": count}
+            for (start, bucket_receiver), count in buckets.items()
+        ],
+        "distribution": [{"msg": msg, "count": count} for (msg,), count in distribution.items()],
+    }
 
+def sum_counts(rows, *columns):
+    # {group: count}, in the order of the rows. With shards, each counts its
+    # own rows and the same group can come back from several.
+    counts = {}
+    for row in rows:
+        group = tuple(row._mapping[column] for column in columns)
+        counts[group] = counts.get(group, 0) + row.count
+    return counts
+
+def recent_since(since, minutes):
+    # The later of an absolute and a relative ("last N minutes") bound
+    bounds = []
+    if since is not None:
+        bounds.append(utc_naive(since))
+    if minutes is not None:
+        bounds.append(datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(minutes=minutes))
+    return max(bounds) if bounds else None
+
+def position_row(row):
+    return {
+        "id": row.id,
+        "created_at": row.created_at.isoformat(),
+        "receiver": row.receiver,
+        "sender": row.sender,
+        "msg": row.msg,
+        "text_msg": row.text_msg,
+        "latitude": row.latitude,
+        "longitude": row.longitude,
+    }
+
+@app.get("/export/", dependencies=[Depends(db_slot)])
+async def export_msgs(
+    fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv|parquet)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+    up_to_id: Optional[int] = None,
+    receiver: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # Every column of the selected rows, oldest first, streamed (see
+    # app/export.py)
+    if fmt == "parquet" and not parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export needs pyarrow")
+    query = export_query(
+        utc_naive(since) if since else None,
+        utc_naive(until) if until else None,
+        after_id, up_to_id, receiver,
+    )
+    return StreamingResponse(
+        limited(stream_export(session_factory(db), query, fmt, on_rows=count_rows)),
+        media_type=FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="msgs.{fmt}"'},
+    )
+
+@app.get("/msgs-in-bbox/", dependencies=[Depends(db_slot)])
+async def get_msgs_in_bbox(
+    south: float = Query(..., ge=-90, le=90),
+    west: float = Query(..., ge=-180, le=180),
+    north: float = Query(..., ge=-90, le=90),
+    east: float = Query(..., ge=-180, le=180),
+    since: Optional[datetime] = None,
+    minutes: Optional[int] = Query(None, ge=1),
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # Newest messages with a position inside the box; west > east crosses
+    # the antimeridian. Served by msgs_geocell_created_at_idx (app/geo.py).
+    if south > north:
+        raise HTTPException(status_code=400, detail="south must not be north of north")
+    query = bbox_query(south, west, north, east, recent_since(since, minutes), limit)
+    rows = (await db.execute(query)).all()
+    count_rows(len(rows))
+    return {"msgs": [position_row(row) for row in rows]}
+
+@app.get("/nearest-msgs/", dependencies=[Depends(db_slot)])
+async def get_nearest_msgs(
+    latitude: float = Query(..., ge=-90, le=90),
+    longitude: float = Query(..., ge=-180, le=180),
+    since: Optional[datetime] = None,
+    minutes: Optional[int] = Query(None, ge=1),
+    limit: int = Query(10, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # The `limit` messages closest to the point, nearest first, within about
+    # 55 km (NEAREST_MAX_DEGREES in app/geo.py)
+    rows = await nearest(db, latitude, longitude, limit, recent_since(since, minutes))
+    count_rows(len(rows))
+    return {"msgs": [dict(position_row(row), distance_m=round(row.distance_m, 1)) for row in rows]}
+
+def parse_record(record):
     try:
-        # Insert or update the latest value in the "tels" table
-        result = await db.execute(msgs.insert().values(receiver=receiver, msg=msg))
+        return parse_msg_record(record)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def request_key(request, body=None):
+    try:
+        return idempotency_key(request.headers, body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Answer to a retried request whose key was already committed
+REPLAYED_HEADERS = {"Idempotent-Replayed": "true"}
+
+def replayed(status):
+    if status == 204:
+        return Response(status_code=204, headers=REPLAYED_HEADERS)
+    return JSONResponse({"status": status}, headers=REPLAYED_HEADERS)
+
+async def commit_rows(db, rows, key=None):
+    # Inserts rows in one transaction together with their idempotency key.
+    # Returns the rows with their ids, or None if the key had already been
+    # used and nothing was inserted.
+    if shards is not None:
+        return await commit_sharded_rows(rows, key)
+    try:
+        rows = await insert_rows(db, msgs, rows)
+        if key is not None and not await claim_key(db, key, rows[0]["id"]):
+            await db.rollback()
+            idempotency_cache.add(key)
+            return None
+        await before_commit(db, rows)
         await db.commit()
     except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
+    if key is not None:
+        idempotency_cache.add(key)
+    announce_rows(rows)
+    return rows
+
+async def commit_sharded_rows(rows, key=None):
+    # One transaction per shard, each claiming the key on its own shard. A
+    # retry after a failure part way skips the shards whose claim is already
+    # committed and inserts only the rest; it counts as replayed once every
+    # shard had the key.
+    try:
+        groups = list(shards.group(await shards.assign_ids(rows)).items())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    committed = []
+    for shard, group in groups:
+        async with shard.sessions() as session:
+            try:
+                group = await insert_rows(session, msgs, group)
+                if key is not None and not await claim_key(session, key, group[0]["id"]):
+                    await session.rollback()
+                    continue
+                await before_commit(session, group)
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                announce_rows(committed)
+                raise HTTPException(status_code=500, detail=str(e))
+        committed += group
+    if key is not None:
+        idempotency_cache.add(key)
+    announce_rows(committed)
+    return committed or None
+
+def enqueue_msg(record, key=None):
+    # Queue mode: validate up front, one bad row must not fail a whole batch
+    row = parse_record(record)
+    try:
+        ingest_queue.submit(row)
+    except IngestQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    if key is not None:
+        idempotency_cache.add(key)
+    return {"status": "queued"}
+
+def decode_binary_body(body):
+    try:
+        rows = decode_msgs(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(rows) > BATCH_MAX_RECORDS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_RECORDS} records per batch")
+    return rows
+
+async def insert_binary_msgs(rows, db, key=None):
+    # Devices on metered links get an empty 204 instead of a JSON body
+    if ingest_queue is not None:
+        try:
+            ingest_queue.submit_many(rows)
+        except IngestQueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+        if key is not None:
+            idempotency_cache.add(key)
+        return Response(status_code=204)
+
+    rows = await commit_rows(db, rows, key)
+    if rows is None:
+        return replayed(204)
+    return remember_write(Response(status_code=204), rows)
+
+@app.post("/post-msg/", dependencies=[Depends(db_slot)])
+async def insert_or_update_msg(request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    if request.headers.get("content-type", "").startswith(BINARY_CONTENT_TYPE):
+        rows = decode_binary_body(await request.body())
+        await check_rate(request)
+        key = request_key(request)
+        if key is not None and idempotency_cache.seen(key):
+            return replayed(204)
+        return await insert_binary_msgs(rows, db, key)
+
+    try:
+        # Attempt to parse the request body as JSON
+        parsed_body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+    receiver = parsed_body.get("receiver")
+    msg = parsed_body.get("msg")
+
+    logger.debug("msg received", extra={"receiver": receiver, "value": msg})
+    await check_rate(request)
+
+    # A retry of a request that already got in is answered right away
+    key = request_key(request, parsed_body)
+    if key is not None and idempotency_cache.seen(key):
+        return replayed("queued" if ingest_queue is not None else "ok")
+
+    record = {
+        "receiver": receiver,
+        "sender": parsed_body.get("sender"),
+        "msg": msg,
+        "latitude": parsed_body.get("latitude"),
+        "longitude": parsed_body.get("longitude"),
+    }
+    if ingest_queue is not None:
+        return enqueue_msg(record, key)
+
+    row = parse_record(record)
+    # Insert or update the latest value in the "tels" table
+    rows = await commit_rows(db, [row], key)
+    if rows is None:
+        return replayed("ok")
+    remember_write(response, rows)
     return {"status": "ok"}
 
 
-@app.post("/post-text-msg/")
-async def insert_or_update_text_msg(request: Request, db: AsyncSession = Depends(get_db)):
+@app.post("/post-text-msg/", dependencies=[Depends(db_slot)])
+async def insert_or_update_text_msg(request: Request, response: Response, db: AsyncSession = Depends(get_db)):
     try:
         parsed_body = await request.json()
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, UnicodeDecodeError):
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
     receiver = parsed_body.get("receiver")
     text_msg = parsed_body.get("text_msg")
 
-    print(f"Message receiver: {receiver}, text_msg: {text_msg}")
+    logger.debug("text msg received", extra={"receiver": receiver, "text_msg": text_msg})
+    await check_rate(request)
 
-    try:
-        result = await db.execute(msgs.insert().values(receiver=receiver, text_msg=text_msg))
-        await db.commit()
-    except Exception as e:
-        await db.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
+    key = request_key(request, parsed_body)
+    if key is not None and idempotency_cache.seen(key):
+        return replayed("queued" if ingest_queue is not None else "ok")
+
+    record = {
+        "receiver": receiver,
+        "sender": parsed_body.get("sender"),
+        "text_msg": text_msg,
+        "latitude": parsed_body.get("latitude"),
+        "longitude": parsed_body.get("longitude"),
+    }
+    if ingest_queue is not None:
+        return enqueue_msg(record, key)
+
+    row = parse_record(record)
+    rows = await commit_rows(db, [row], key)
+    if rows is None:
+        return replayed("ok")
+    remember_write(response, rows)
     return {"status": "ok"}
 
 
-@app.get("/all-messages/", response_class=HTMLResponse)
-async def get_all_messages(db: AsyncSession = Depends(get_db)):
-    query = select(
-        msgs.c.id,
-        msgs.c.msg,
-        msgs.c.text_msg,
-        msgs.c.created_at,
-        msgs.c.receiver
-    ).order_by(msgs.c.created_at.desc())
-    
-    result = await db.execute(query)
-    all_messages = result.fetchall()
-    
-    if not all_messages:
-        return "<p>No messages found</p>"
-    
-    html_table = """
+# Upper bound for a single /post-msgs/batch request
+BATCH_MAX_RECORDS = 5000
+
+def load_batch(body, content_type):
+    # Returns one entry per record: the decoded JSON value, or a ValueError
+    # for NDJSON lines that don't parse
+    if "ndjson" in content_type:
+        records = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                records.append(ValueError("Invalid JSON"))
+        return records
+
+    records = json.loads(body)
+    if not isinstance(records, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of records")
+    return records
+
+@app.post("/post-msgs/batch", dependencies=[Depends(db_slot)])
+async def insert_msgs_batch(request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+
+    if content_type.startswith(BINARY_CONTENT_TYPE):
+        # A malformed binary record can't be skipped, so it fails the request
+        rows = decode_binary_body(body)
+        statuses = [{"index": index, "status": "ok"} for index in range(len(rows))]
+    else:
+        try:
+            records = load_batch(body, content_type)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            raise HTTPException(status_code=400, detail="Invalid JSON")
+
+        if len(records) > BATCH_MAX_RECORDS:
+            raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_RECORDS} records per batch")
+
+        rows = []
+        statuses = []
+        for index, record in enumerate(records):
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                row = parse_msg_record(record)
+                if row["msg"] is None and row["text_msg"] is None:
+                    raise ValueError("record needs msg or text_msg")
+                rows.append(row)
+                statuses.append({"index": index, "status": "ok"})
+            except ValueError as e:
+                statuses.append({"index": index, "status": "error", "detail": str(e)})
+
+    await check_rate(request)
+    started = time.perf_counter()
+    if rows:
+        rows = await commit_rows(db, rows)
+        remember_write(response, rows)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "status": "ok",
+        "inserted": len(rows),
+        "rejected": len(statuses) - len(rows),
+        "elapsed_ms": round(elapsed * 1000, 3),
+        "rows_per_second": round(len(rows) / elapsed) if rows and elapsed > 0 else 0,
+        "records": statuses,
+    }
+
+
+MESSAGES_TABLE_HEAD = """
     <table>
         <thead>
             <tr>
@@ -174,22 +1224,155 @@ async def get_all_messages(db: AsyncSession = Depends(get_db)):
                 <th>Timestamp</th>
             </tr>
         </thead>
-        <tbody>
+        <tbody id="messages-body">
     """
-    
-    for row in all_messages:
-        html_table += f"""
+
+MESSAGES_TABLE_FOOT = """
+        </tbody>
+    </table>
+    """
+
+# Rows fetched from the server-side cursor and flushed to the client at a time
+STREAM_CHUNK_ROWS = 100
+
+MESSAGE_TABLE_COLUMNS = (msgs.c.id, msgs.c.msg, msgs.c.text_msg, msgs.c.created_at, msgs.c.receiver)
+
+# The first page of the table asks /all-messages/rows for newer rows this
+# often. One refresh renders at most DELTA_ROWS_MAX rows; a dashboard further
+# behind gets the whole first page again.
+DASHBOARD_REFRESH_SECONDS = 5
+DELTA_ROWS_MAX = 100
+
+def render_message_row(row):
+    msg = row.msg if row.msg is not None else ''
+    text_msg = html.escape(row.text_msg) if row.text_msg is not None else ''
+    created_at = row.created_at.strftime('%Y-%m-%d %H:%M:%S') if row.created_at else ''
+    return f"""
             <tr>
                 <td>{row.id}</td>
                 <td>{row.receiver}</td>
-                <td>{row.msg if row.msg is not None else ''}</td>
-                <td>{row.text_msg if row.text_msg is not None else ''}</td>
-                <td>{row.created_at.strftime('%Y-%m-%d %H:%M:%S') if row.created_at else ''}</td>            </tr>
+                <td>{msg}</td>
+                <td>{text_msg}</td>
+                <td>{created_at}</td>            </tr>
         """
-    
-    html_table += """
-        </tbody>
-    </table>
+
+def render_poller(rows_url):
+    # Sits under the first page and prepends new rows to it. The newest id
+    # shown is read from the first cell of the table at each refresh.
+    return f"""
+    <div hx-get="{html.escape(str(rows_url))}"
+         hx-trigger="every {DASHBOARD_REFRESH_SECONDS}s"
+         hx-target="#messages-body"
+         hx-swap="afterbegin"
+         hx-vals='js:{{after_id: parseInt(document.querySelector("#messages-body td").textContent, 10)}}'>
+    </div>
     """
-    
-    return html_table
\ No newline at end of file
+
+async def stream_messages_table(page_url, query, limit, sessions=AsyncSessionLocal, rows_url=None):
+    # Dependencies with yield are closed before a streaming body is sent,
+    # so the generator owns its session. With rows_url, the table keeps
+    # itself up to date (render_poller).
+    async with sessions() as session:
+        result = await session.stream(query)
+        rendered = 0
+        cursor = None
+        async for partition in result.partitions(STREAM_CHUNK_ROWS):
+            chunk = [MESSAGES_TABLE_HEAD] if rendered == 0 else []
+            for row in partition:
+                if rendered == limit:
+                    # The extra row fetched by paginate(): an older page exists
+                    cursor = last_id
+                    break
+                chunk.append(render_message_row(row))
+                last_id = row.id
+                rendered += 1
+            yield "".join(chunk)
+    count_rows(rendered)
+
+    if rendered == 0:
+        yield "<p>No messages found</p>"
+        return
+
+    yield MESSAGES_TABLE_FOOT
+
+    if rows_url is not None:
+        yield render_poller(rows_url)
+
+    if cursor is not None:
+        # Absolute URL, the dashboard is served from a different origin
+        older_url = html.escape(str(page_url.include_query_params(before_id=cursor)))
+        yield f"""
+    <button hx-get="{older_url}"
+            hx-target="#messages-table"
+            hx-swap="innerHTML"
+            data-next-cursor="{cursor}">
+        Older messages
+    </button>
+    """
+
+@app.get("/all-messages/", response_class=HTMLResponse, dependencies=[Depends(db_slot)])
+async def get_all_messages(
+    request: Request,
+    receiver: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    sender: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    before_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_read_db),
+):
+    etag = f'"{await lookup_high_water(db, receiver)}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    query = paginate(scoped(select(*MESSAGE_TABLE_COLUMNS), receiver, sender, since), before_id, limit)
+    # Only the newest page grows
+    rows_url = table_url(request, "get_new_message_rows", receiver, sender, since) if before_id is None else None
+    return StreamingResponse(
+        limited(stream_messages_table(request.url, query, limit, session_factory(db), rows_url)),
+        media_type="text/html",
+        headers={"ETag": etag, "Cache-Control": "no-cache"},
+    )
+
+def table_url(request, route, receiver, sender, since):
+    # Absolute URL of an /all-messages/ route for the same rows
+    filters = {"receiver": receiver, "sender": sender, "since": since.isoformat() if since else None}
+    return request.url_for(route).include_query_params(
+        **{name: value for name, value in filters.items() if value is not None})
+
+@app.get("/all-messages/rows", response_class=HTMLResponse, dependencies=[Depends(db_slot)])
+async def get_new_message_rows(
+    request: Request,
+    after_id: int = Query(..., ge=0),
+    receiver: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    sender: Optional[int] = Query(None, ge=SMALLINT_MIN, le=SMALLINT_MAX),
+    since: Optional[datetime] = None,
+    limit: int = Query(DELTA_ROWS_MAX, ge=1, le=DELTA_ROWS_MAX),
+    db: AsyncSession = Depends(get_read_db),
+):
+    # Table rows newer than after_id, newest first, for hx-swap="afterbegin".
+    # The cost follows the number of new rows, not the size of the table.
+    # Nothing new is an empty 204, which htmx leaves alone.
+    if await lookup_high_water(db, receiver) <= after_id:
+        return Response(status_code=204)
+    query = (
+        scoped(select(*MESSAGE_TABLE_COLUMNS), receiver, sender, since)
+        .where(msgs.c.id > after_id)
+        .order_by(msgs.c.id.desc())
+        .limit(limit + 1)
+    )
+    rows = (await db.execute(query)).all()
+    if not rows:
+        return Response(status_code=204)
+    if len(rows) > limit:
+        # Too far behind to patch: replace the table with the first page
+        query = paginate(scoped(select(*MESSAGE_TABLE_COLUMNS), receiver, sender, since), None, PAGE_SIZE_DEFAULT)
+        return StreamingResponse(
+            limited(stream_messages_table(
+                table_url(request, "get_all_messages", receiver, sender, since), query, PAGE_SIZE_DEFAULT,
+                session_factory(db), table_url(request, "get_new_message_rows", receiver, sender, since),
+            )),
+            media_type="text/html",
+            headers={"HX-Retarget": "#messages-table", "HX-Reswap": "innerHTML", "Cache-Control": "no-cache"},
+        )
+    count_rows(len(rows))
+    return HTMLResponse("".join(render_message_row(row) for row in rows), headers={"Cache-Control": "no-cache"})
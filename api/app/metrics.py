@@ -0,0 +1,213 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Seconds, from 1 ms to 10 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    # Fixed-bucket histogram with Prometheus semantics (a value lands in the
+    # first bucket whose upper bound it doesn't exceed)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # [(upper bound, count of values <= bound)], ending with +Inf
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def snapshot(self):
+        return {
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): count
+                        for bound, count in self.cumulative()},
+            "sum": round(self.sum, 6),
+            "count": self.count,
+        }
+
+
+def route_of(scope):
+    # Route template, not the raw path, to keep label cardinality bounded
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+HTTP_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+
+def method_of(scope):
+    # Clients can send any verb; the rest share one label
+    method = scope["method"]
+    return method if method in HTTP_METHODS else "OTHER"
+
+
+class RequestStats:
+    __slots__ = ("scope", "db_seconds", "rows")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.db_seconds = 0.0
+        self.rows = 0
+
+
+_request_stats = ContextVar("request_stats", default=None)
+
+
+class Registry:
+    # In-process metrics, rendered in Prometheus text format by /metrics.
+    # Every worker process has its own registry; scrape them all, or sum.
+
+    def __init__(self):
+        self.requests = {}    # (method, route, status) -> Histogram
+        self.request_db = {}  # route -> Histogram of DB time per request
+        self.db_ops = {}      # (route, op) -> Histogram
+        self.rows = {}        # route -> rows returned
+
+    def observe_request(self, stats, method, status, seconds):
+        route = route_of(stats.scope)
+        key = (method, route, status)
+        histogram = self.requests.get(key)
+        if histogram is None:
+            histogram = self.requests[key] = Histogram()
+        histogram.observe(seconds)
+        if stats.db_seconds:
+            histogram = self.request_db.get(route)
+            if histogram is None:
+                histogram = self.request_db[route] = Histogram()
+            histogram.observe(stats.db_seconds)
+        if stats.rows:
+            self.rows[route] = self.rows.get(route, 0) + stats.rows
+
+    def observe_db(self, op, seconds):
+        stats = _request_stats.get()
+        route = route_of(stats.scope) if stats is not None else "background"
+        if stats is not None:
+            stats.db_seconds += seconds
+        key = (route, op)
+        histogram = self.db_ops.get(key)
+        if histogram is None:
+            histogram = self.db_ops[key] = Histogram()
+        histogram.observe(seconds)
+
+    def render(self, gauges=(), counters=()):
+        # gauges/counters: extra (name, help, value) samples, e.g. pool state
+        lines = []
+        render_histograms(lines, "http_request_duration_seconds", "Request latency by route and status",
+                          ((dict(method=m, route=r, status=s), h) for (m, r, s), h in self.requests.items()))
+        render_histograms(lines, "http_request_db_seconds", "Database time spent per request",
+                          ((dict(route=r), h) for r, h in self.request_db.items()))
+        render_histograms(lines, "db_operation_duration_seconds", "Duration of each session execute/commit",
+                          ((dict(route=r, op=o), h) for (r, o), h in self.db_ops.items()))
+        lines.append("# HELP db_rows_returned_total Rows returned to clients by route")
+        lines.append("# TYPE db_rows_returned_total counter")
+        for route, rows in self.rows.items():
+            lines.append(f"db_rows_returned_total{format_labels(dict(route=route))} {rows}")
+        for kind, samples in (("gauge", gauges), ("counter", counters)):
+            for name, help_text, value in samples:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for k, v in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_histograms(lines, name, help_text, items):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in items:
+        for bound, count in histogram.cumulative():
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{name}_bucket{format_labels(dict(labels, le=le))} {count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+
+registry = Registry()
+
+
+def count_rows(n):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.rows += n
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware (BaseHTTPMiddleware would add a task per request
+    # and buffer streaming responses)
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = _request_stats.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            registry.observe_request(stats, method_of(scope), status, time.perf_counter() - started)
+            _request_stats.reset(token)
+
+
+class TimedSession(AsyncSession):
+    # Times every execute/commit into db_operation_duration_seconds
+
+    async def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            registry.observe_db("execute", time.perf_counter() - started)
+
+    async def scalar(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().scalar(*args, **kwargs)
+        finally:
+            registry.observe_db("execute", time.perf_counter() - started)
+
+    async def stream(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().stream(*args, **kwargs)
+        finally:
+            registry.observe_db("stream", time.perf_counter() - started)
+
+    async def commit(self):
+        started = time.perf_counter()
+        try:
+            return await super().commit()
+        finally:
+            registry.observe_db("commit", time.perf_counter() - started)
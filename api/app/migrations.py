@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import re
+
+from sqlalchemy import select, text
+
+from .db import dialect_name, get_engine
+from .locks import MIGRATIONS_LOCK, advisory_lock
+from .models import metadata, msg_keys, msgs, msgs_daily, msgs_hourly, msgs_rollup_deltas, schema_migrations
+from .partitions import MSGS_INDEXES, is_partitioned, list_partitions, partition_msgs
+
+logger = logging.getLogger(__name__)
+
+# Each migration runs on an AUTOCOMMIT connection so it can build indexes
+# CONCURRENTLY. Statements must be idempotent: a migration that fails half
+# way is simply run again on the next start.
+
+
+async def index_valid(conn, name):
+    # True, False for an INVALID index, None if there is none
+    return await conn.scalar(text("""
+        SELECT i.indisvalid FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND c.relname = :name
+    """), {"schema": metadata.schema, "name": name})
+
+
+async def create_index_concurrently(conn, name, definition):
+    # A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind that
+    # IF NOT EXISTS would then accept, so look before creating
+    valid = await index_valid(conn, name)
+    if valid:
+        return
+    table, columns = definition.split(" ", 1)
+    if await is_partitioned(conn):
+        await create_partitioned_index(conn, name, table, columns, valid)
+        return
+    if valid is not None:
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY {metadata.schema}.{name}"))
+    await conn.execute(text(f"CREATE INDEX CONCURRENTLY {name} ON {definition}"))
+
+
+async def create_partitioned_index(conn, name, table, columns, valid):
+    # CONCURRENTLY doesn't work on a partitioned table: create the parent
+    # index empty, build one per partition concurrently and attach them. The
+    # parent index turns valid once every partition has one.
+    schema = metadata.schema
+    if valid is None:
+        await conn.execute(text(f"CREATE INDEX {name} ON ONLY {table} {columns}"))
+    for partition, _ in await list_partitions(conn):
+        child = f"{name}_{partition.removeprefix('msgs_')}"
+        if await index_valid(conn, child) is False:
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY {schema}.{child}"))
+        await conn.execute(text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {child} ON {schema}.{partition} {columns}"))
+        attached = await conn.scalar(text("""
+            SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = CAST(:child AS regclass))
+        """), {"child": f"{schema}.{child}"})
+        if not attached:
+            await conn.execute(text(f"ALTER INDEX {schema}.{name} ATTACH PARTITION {schema}.{child}"))
+
+
+async def create_msgs(conn):
+    await conn.run_sync(metadata.create_all, tables=[msgs])
+
+
+async def msgs_indexes(conn):
+    # Per-receiver and per-sender lists and latest lookups
+    await create_index_concurrently(
+        conn, "msgs_receiver_id_idx", "lithings.msgs (receiver, id DESC)")
+    await create_index_concurrently(
+        conn, "msgs_sender_id_idx", "lithings.msgs (sender, id DESC)")
+    # Text messages only; INCLUDE text_msg makes the latest lookups index-only
+    await create_index_concurrently(
+        conn, "msgs_text_id_idx",
+        "lithings.msgs (id DESC) INCLUDE (text_msg) WHERE text_msg IS NOT NULL")
+    await create_index_concurrently(
+        conn, "msgs_text_receiver_id_idx",
+        "lithings.msgs (receiver, id DESC) INCLUDE (text_msg) WHERE text_msg IS NOT NULL")
+    # created_at follows insertion order, a BRIN index stays tiny
+    await create_index_concurrently(
+        conn, "msgs_created_at_brin", "lithings.msgs USING brin (created_at)")
+
+
+async def create_rollups(conn):
+    await conn.run_sync(metadata.create_all, tables=[msgs_hourly, msgs_daily])
+    # Counting starts now; older rows need an explicit backfill
+    if await conn.scalar(text(f"SELECT EXISTS (SELECT 1 FROM {metadata.schema}.msgs)")):
+        logger.warning("Rollups start empty, run python -m app.rollups rebuild to backfill")
+
+
+async def msgs_geocell(conn):
+    # Adding a nullable column without a default doesn't rewrite the table
+    await conn.execute(text(f"ALTER TABLE {metadata.schema}.msgs ADD COLUMN IF NOT EXISTS geocell integer"))
+    # Same numbering as app/geo.py, for rows that got a position by hand
+    await conn.execute(text(f"""
+        UPDATE {metadata.schema}.msgs
+        SET geocell = LEAST(floor((latitude + 90) * 100)::int, 17999) * 36000
+                    + LEAST(floor((longitude + 180) * 100)::int, 35999)
+        WHERE geocell IS NULL AND latitude IS NOT NULL AND longitude IS NOT NULL
+    """))
+    # Bounding boxes and nearest searches, optionally limited to recent rows
+    await create_index_concurrently(
+        conn, "msgs_geocell_created_at_idx",
+        "lithings.msgs (geocell, created_at) WHERE geocell IS NOT NULL")
+
+
+async def msgs_inbox(conn):
+    # Only undelivered rows, so an inbox read costs what is pending rather
+    # than what the receiver ever got; acknowledged rows drop out of it
+    await create_index_concurrently(
+        conn, "msgs_undelivered_idx",
+        "lithings.msgs (receiver, id) WHERE delivered IS NOT TRUE")
+
+
+async def create_msg_keys(conn):
+    await conn.run_sync(metadata.create_all, tables=[msg_keys])
+
+
+async def create_rollup_deltas(conn):
+    await conn.run_sync(metadata.create_all, tables=[msgs_rollup_deltas])
+
+
+MIGRATIONS = [
+    ("0001_create_msgs", create_msgs),
+    ("0002_msgs_indexes", msgs_indexes),
+    ("0003_create_rollups", create_rollups),
+    ("0004_msgs_geocell", msgs_geocell),
+    ("0005_msgs_inbox", msgs_inbox),
+    ("0006_create_msg_keys", create_msg_keys),
+    ("0007_create_rollup_deltas", create_rollup_deltas),
+]
+
+
+_INCLUDE = re.compile(r" INCLUDE \([^)]*\)")
+
+
+async def create_sqlite_schema(conn):
+    # SQLite (tests, local benchmarks) starts from an empty file: the current
+    # tables and whichever msgs indexes it can express, no version history
+    await conn.run_sync(metadata.create_all)
+    for name, definition in MSGS_INDEXES.items():
+        if definition.startswith("USING"):
+            continue
+        await conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {metadata.schema}.{name} ON msgs {_INCLUDE.sub('', definition)}"))
+
+
+async def migrate(engine, partitioning=None):
+    # partitioning: None, "daily" or "monthly" (see app/partitions.py).
+    # Every worker calls this on startup; the lock makes the first one do the
+    # work while the others wait and then find nothing left to apply.
+    if dialect_name(engine) == "sqlite":
+        if partitioning:
+            raise ValueError("Partitioning needs Postgres")
+        async with engine.begin() as conn:
+            await create_sqlite_schema(conn)
+        return
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        async with advisory_lock(conn, MIGRATIONS_LOCK):
+            await conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {metadata.schema}"))
+            await conn.run_sync(metadata.create_all, tables=[schema_migrations])
+            applied = set((await conn.execute(select(schema_migrations.c.version))).scalars())
+
+            for version, step in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info("Applying migration %s", version)
+                await step(conn)
+                await conn.execute(schema_migrations.insert().values(version=version))
+
+            # Opt-in, so it is not one of MIGRATIONS; a no-op once msgs is partitioned
+            if partitioning:
+                await partition_msgs(conn, partitioning)
+
+
+if __name__ == "__main__":
+    # python -m app.migrations
+    from .main import MSGS_PARTITIONING
+
+    async def run():
+        engine = get_engine()
+        await migrate(engine, MSGS_PARTITIONING)
+        await engine.dispose()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run())
@@ -0,0 +1,83 @@
+from sqlalchemy import (
+    Table, Column, Integer, String, MetaData,
+    DateTime, SmallInteger, Boolean, Float, BigInteger, Index, text
+)
+
+metadata = MetaData(schema="lithings")
+
+msgs = Table(
+    "msgs",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("created_at", DateTime(timezone=False), nullable=False, server_default=text("CURRENT_TIMESTAMP")),
+    Column("sender", SmallInteger(), nullable=True),
+    Column("receiver", SmallInteger(), nullable=True),
+    Column("msg", SmallInteger(), nullable=True),
+    Column("text_msg", String(255), nullable=True),
+    Column("latitude", Float(), nullable=True),
+    Column("longitude", Float(), nullable=True),
+    # Grid cell of (latitude, longitude), see app/geo.py
+    Column("geocell", Integer(), nullable=True),
+    Column("delivered", Boolean(), nullable=True),
+    Column("seen", Boolean(), nullable=True),
+    # SQLite keeps a sequence for msgs, which sharding hands ids out from
+    sqlite_autoincrement=True,
+)
+
+# Versions applied by app/migrations.py
+schema_migrations = Table(
+    "schema_migrations",
+    metadata,
+    Column("version", String(64), primary_key=True),
+    Column("applied_at", DateTime(timezone=False), nullable=False, server_default=text("CURRENT_TIMESTAMP")),
+)
+
+
+# Idempotency keys of recent POSTs (app/idempotency.py). The primary key is
+# the backstop behind the in-memory cache; msgs can't carry a unique key
+# itself because on a partitioned table it would have to include created_at.
+msg_keys = Table(
+    "msg_keys",
+    metadata,
+    Column("key", String(64), primary_key=True),
+    Column("msg_id", Integer, nullable=False),
+    Column("created_at", DateTime(timezone=False), nullable=False, server_default=text("CURRENT_TIMESTAMP")),
+)
+Index("msg_keys_created_at_idx", msg_keys.c.created_at)
+
+
+def rollup_table(name, bucket):
+    # Count of msg readings per bucket, receiver and value, kept up to date by
+    # app/rollups.py. A NULL receiver is its own group, which a plain unique
+    # key can't express, hence the two partial unique indexes.
+    table = Table(
+        name,
+        metadata,
+        Column(bucket, DateTime(timezone=False), nullable=False),
+        Column("receiver", SmallInteger(), nullable=True),
+        Column("msg", SmallInteger(), nullable=False),
+        Column("count", BigInteger(), nullable=False),
+    )
+    has_receiver, no_receiver = table.c.receiver.isnot(None), table.c.receiver.is_(None)
+    Index(f"{name}_receiver_key", table.c.receiver, table.c[bucket], table.c.msg,
+          unique=True, postgresql_where=has_receiver, sqlite_where=has_receiver)
+    Index(f"{name}_no_receiver_key", table.c[bucket], table.c.msg,
+          unique=True, postgresql_where=no_receiver, sqlite_where=no_receiver)
+    Index(f"{name}_{bucket}_idx", table.c[bucket])
+    return table
+
+
+msgs_hourly = rollup_table("msgs_hourly", "hour")
+msgs_daily = rollup_table("msgs_daily", "day")
+
+# Counts added by inserts and not yet folded into msgs_hourly/msgs_daily.
+# Append-only, so concurrent inserts never wait on each other's row locks.
+msgs_rollup_deltas = Table(
+    "msgs_rollup_deltas",
+    metadata,
+    Column("hour", DateTime(timezone=False), nullable=False),
+    Column("day", DateTime(timezone=False), nullable=False),
+    Column("receiver", SmallInteger(), nullable=True),
+    Column("msg", SmallInteger(), nullable=False),
+    Column("count", Integer(), nullable=False),
+)
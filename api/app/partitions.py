@@ -0,0 +1,240 @@
+import asyncio
+from datetime import datetime, timedelta
+import logging
+import re
+
+from sqlalchemy import text
+
+from .locks import PARTITION_MAINTENANCE_LOCK, try_advisory_lock
+from .models import metadata
+
+logger = logging.getLogger(__name__)
+
+# Optional range partitioning of msgs by created_at (MSGS_PARTITIONING).
+#
+# The existing table is never copied. It is renamed to msgs_legacy and
+# attached as the partition holding everything before the cutover; the
+# CHECK constraint validated beforehand lets ATTACH skip its scan. Later
+# partitions are created ahead of time by PartitionMaintainer, which also
+# drops whole partitions once they fall out of the retention window.
+# msgs_default catches rows whose created_at has no partition, e.g. device
+# timestamps far in the future.
+
+INTERVALS = ("daily", "monthly")
+
+# Indexes created by app/migrations.py, recreated on the partitioned table
+MSGS_INDEXES = {
+    "msgs_receiver_id_idx": "(receiver, id DESC)",
+    "msgs_sender_id_idx": "(sender, id DESC)",
+    "msgs_text_id_idx": "(id DESC) INCLUDE (text_msg) WHERE text_msg IS NOT NULL",
+    "msgs_text_receiver_id_idx": "(receiver, id DESC) INCLUDE (text_msg) WHERE text_msg IS NOT NULL",
+    "msgs_created_at_brin": "USING brin (created_at)",
+    "msgs_geocell_created_at_idx": "(geocell, created_at) WHERE geocell IS NOT NULL",
+    "msgs_undelivered_idx": "(receiver, id) WHERE delivered IS NOT TRUE",
+}
+
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def period_start(moment, interval):
+    if interval == "daily":
+        return datetime(moment.year, moment.month, moment.day)
+    return datetime(moment.year, moment.month, 1)
+
+
+def next_period(start, interval):
+    if interval == "daily":
+        return start + timedelta(days=1)
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def partition_name(start, interval):
+    return "msgs_p" + start.strftime("%Y%m%d" if interval == "daily" else "%Y%m")
+
+
+def recent_window(interval):
+    # How far back a "recent" read looks before giving up on pruning
+    return timedelta(days=1) if interval == "daily" else timedelta(days=31)
+
+
+async def is_partitioned(conn, schema=metadata.schema):
+    kind = await conn.scalar(text("""
+        SELECT c.relkind::text FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND c.relname = 'msgs'
+    """), {"schema": schema})
+    return kind == "p"
+
+
+async def list_partitions(conn, schema=metadata.schema):
+    # [(name, upper bound or None)], the default partition has no bound
+    result = await conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = p.relnamespace
+        WHERE n.nspname = :schema AND p.relname = 'msgs'
+    """), {"schema": schema})
+    partitions = []
+    for name, bound in result:
+        match = _UPPER_BOUND.search(bound)
+        upper = datetime.fromisoformat(match.group(1)) if match else None
+        partitions.append((name, upper))
+    return sorted(partitions, key=lambda p: (p[1] is None, p[1] or datetime.min))
+
+
+async def partition_msgs(conn, interval, schema=metadata.schema):
+    # conn must be in AUTOCOMMIT; idempotent, a failed run is simply repeated
+    if interval not in INTERVALS:
+        raise ValueError(f"Unknown partition interval: {interval}")
+    if await is_partitioned(conn, schema):
+        return
+
+    # Everything up to the end of the current period (or the newest row, for
+    # device timestamps in the future) stays in the old table
+    newest = await conn.scalar(text(f"SELECT max(created_at) FROM {schema}.msgs"))
+    now = await conn.scalar(text("SELECT LOCALTIMESTAMP"))
+    cutover = next_period(period_start(max(now, newest or now), interval), interval)
+
+    # Build what ATTACH would otherwise build under an exclusive lock
+    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {schema}.msgs_id_created_at_key"))
+    await conn.execute(text(
+        f"CREATE UNIQUE INDEX CONCURRENTLY msgs_id_created_at_key ON {schema}.msgs (id, created_at)"))
+    await conn.execute(text(f"ALTER TABLE {schema}.msgs DROP CONSTRAINT IF EXISTS msgs_legacy_bound"))
+    await conn.execute(text(
+        f"ALTER TABLE {schema}.msgs ADD CONSTRAINT msgs_legacy_bound "
+        f"CHECK (created_at < '{cutover.isoformat()}') NOT VALID"))
+    try:
+        # Only a SHARE UPDATE EXCLUSIVE lock, inserts carry on meanwhile
+        await conn.execute(text(f"ALTER TABLE {schema}.msgs VALIDATE CONSTRAINT msgs_legacy_bound"))
+
+        # The swap itself only touches the catalog
+        async with conn.engine.begin() as tx:
+            # Give up rather than queue every request behind a long transaction
+            await tx.execute(text("SET LOCAL lock_timeout = '5s'"))
+            await tx.execute(text(f"LOCK TABLE {schema}.msgs IN ACCESS EXCLUSIVE MODE"))
+            await tx.execute(text(f"ALTER TABLE {schema}.msgs RENAME TO msgs_legacy"))
+            # A partition can't have a primary key of its own; the parent's key
+            # attaches to msgs_id_created_at_key instead
+            await tx.execute(text(f"ALTER TABLE {schema}.msgs_legacy DROP CONSTRAINT msgs_pkey"))
+            for name in MSGS_INDEXES:
+                await tx.execute(text(
+                    f"ALTER INDEX IF EXISTS {schema}.{name} RENAME TO {name.replace('msgs_', 'msgs_legacy_', 1)}"))
+            await tx.execute(text(
+                f"CREATE TABLE {schema}.msgs (LIKE {schema}.msgs_legacy INCLUDING DEFAULTS) "
+                f"PARTITION BY RANGE (created_at)"))
+            await tx.execute(text(f"ALTER TABLE {schema}.msgs ADD PRIMARY KEY (id, created_at)"))
+            for name, definition in MSGS_INDEXES.items():
+                await tx.execute(text(f"CREATE INDEX {name} ON {schema}.msgs {definition}"))
+            # Otherwise dropping msgs_legacy would take the id sequence with it
+            await tx.execute(text(f"ALTER SEQUENCE {schema}.msgs_id_seq OWNED BY {schema}.msgs.id"))
+            await tx.execute(text(
+                f"ALTER TABLE {schema}.msgs ATTACH PARTITION {schema}.msgs_legacy "
+                f"FOR VALUES FROM (MINVALUE) TO ('{cutover.isoformat()}')"))
+            await tx.execute(text(f"CREATE TABLE {schema}.msgs_default PARTITION OF {schema}.msgs DEFAULT"))
+    except Exception:
+        # Left on the unpartitioned table, the bound would reject every insert
+        # past the cutover
+        await conn.execute(text(f"ALTER TABLE {schema}.msgs DROP CONSTRAINT IF EXISTS msgs_legacy_bound"))
+        raise
+    logger.info("Partitioned msgs %s, cutover at %s", interval, cutover)
+
+
+async def create_partition(conn, start, end, name, schema=metadata.schema):
+    # Rows that already landed in msgs_default for this range move over,
+    # otherwise ATTACH would refuse the new partition
+    async with conn.engine.begin() as tx:
+        await tx.execute(text(
+            f"CREATE TABLE {schema}.{name} (LIKE {schema}.msgs INCLUDING DEFAULTS)"))
+        bounds = {"start": start, "end": end}
+        await tx.execute(text(f"""
+            WITH moved AS (
+                DELETE FROM {schema}.msgs_default
+                WHERE created_at >= :start AND created_at < :end
+                RETURNING *
+            )
+            INSERT INTO {schema}.{name} SELECT * FROM moved
+        """), bounds)
+        await tx.execute(text(
+            f"ALTER TABLE {schema}.msgs ATTACH PARTITION {schema}.{name} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"))
+
+
+async def ensure_partitions(conn, interval, ahead, schema=metadata.schema):
+    # Partitions up to `ahead` periods past the current one, returns new names
+    partitions = await list_partitions(conn, schema)
+    bounds = [upper for _, upper in partitions if upper is not None]
+    now = await conn.scalar(text("SELECT LOCALTIMESTAMP"))
+    start = max(bounds) if bounds else period_start(now, interval)
+    horizon = period_start(now, interval)
+    for _ in range(ahead + 1):
+        horizon = next_period(horizon, interval)
+
+    created = []
+    while start < horizon:
+        # A partition boundary left by another interval setting is continued
+        end = next_period(period_start(start, interval), interval)
+        name = partition_name(start, interval)
+        await create_partition(conn, start, end, name, schema)
+        created.append(name)
+        start = end
+    return created
+
+
+async def drop_expired(conn, retention, schema=metadata.schema):
+    # Drops partitions whose newest possible row is older than retention
+    cutoff = await conn.scalar(text("SELECT LOCALTIMESTAMP")) - retention
+    dropped = []
+    for name, upper in await list_partitions(conn, schema):
+        if upper is not None and upper <= cutoff:
+            await conn.execute(text(f"DROP TABLE {schema}.{name}"))
+            dropped.append(name)
+    return dropped
+
+
+class PartitionMaintainer:
+    # Background task: keep future partitions ready and drop expired ones
+
+    def __init__(self, engine, interval, ahead=3, retention=None, period=3600):
+        self.engine = engine
+        self.interval = interval
+        self.ahead = ahead
+        self.retention = retention
+        self.period = period
+        self._task = None
+
+    async def run_once(self):
+        # Every worker runs a maintainer; whichever gets the lock does the
+        # work and the others skip this round
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            async with try_advisory_lock(conn, PARTITION_MAINTENANCE_LOCK) as acquired:
+                if not acquired:
+                    return [], []
+                created = await ensure_partitions(conn, self.interval, self.ahead)
+                dropped = await drop_expired(conn, self.retention) if self.retention else []
+        if created or dropped:
+            logger.info("Partitions created: %s, dropped: %s", created, dropped)
+        return created, dropped
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Partition maintenance failed")
+            await asyncio.sleep(self.period)
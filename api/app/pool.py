@@ -0,0 +1,46 @@
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from .metrics import Histogram
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # The default async pool, plus timings of how long checkouts wait and how
+    # long new connections take, so the pool can be sized from data
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_time = Histogram()
+        self.connect_time = Histogram()
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.wait_time.observe(time.perf_counter() - started)
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            self.connect_time.observe(time.perf_counter() - started)
+
+    def stats(self):
+        return {
+            "pool_size": self.size(),
+            "max_overflow": self._max_overflow,
+            "checked_out": self.checkedout(),
+            "idle": self.checkedin(),
+            "overflow": self.overflow(),
+            "timeouts": self.timeouts,
+            "wait_seconds": self.wait_time.snapshot(),
+            "connect_seconds": self.connect_time.snapshot(),
+        }
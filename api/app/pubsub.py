@@ -0,0 +1,173 @@
+import asyncio
+from collections import deque
+import json
+import logging
+
+from sqlalchemy.pool import NullPool
+
+from .db import build_engine
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "lithings_msgs"
+
+
+class MissedMsgs(Exception):
+    # The broker can't tell what came after the cursor: it was pushed out of
+    # the history, or LISTEN reconnected. The caller reads from the database.
+    pass
+
+
+class MsgBroker:
+    # In-process fan-out of new text messages to SSE streams and long-polls.
+    # All idle waiters share one future, so a waiter costs a suspended
+    # coroutine and nothing else until something is published.
+    #
+    # Only the last `history` messages are kept. A cursor older than what was
+    # pushed out, or a wait that spans a resync(), raises MissedMsgs instead
+    # of skipping messages silently.
+
+    def __init__(self, history=256):
+        self.recent = deque(maxlen=history)
+        # Newest id pushed out of recent; ids arrive slightly out of order
+        # when several workers publish
+        self.evicted_id = 0
+        self.epoch = 0
+        self._waiter = None
+
+    def publish(self, msg):
+        # msg: {"id": ..., "receiver": ..., "text_msg": ...}
+        if len(self.recent) == self.recent.maxlen:
+            self.evicted_id = max(self.evicted_id, self.recent[0]["id"])
+        self.recent.append(msg)
+        self._wake()
+
+    def resync(self):
+        # Messages may have been lost on the way (LISTEN reconnected): every
+        # waiter refills from the database
+        self.epoch += 1
+        self._wake()
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def newer(self, after_id, receiver=None, epoch=None):
+        if after_id < self.evicted_id or (epoch is not None and epoch != self.epoch):
+            raise MissedMsgs()
+        return sorted(
+            (m for m in self.recent
+             if m["id"] > after_id and (receiver is None or m["receiver"] == receiver)),
+            key=lambda m: m["id"],
+        )
+
+    async def wait(self, after_id, receiver=None, timeout=None, epoch=None):
+        # Messages newer than after_id for receiver, or [] after timeout.
+        # epoch: self.epoch when the caller last read from the database.
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        if epoch is None:
+            epoch = self.epoch
+        while True:
+            found = self.newer(after_id, receiver, epoch)
+            if found:
+                return found
+            if self._waiter is None:
+                self._waiter = loop.create_future()
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return []
+            try:
+                # shield: a timed-out waiter must not cancel the shared future
+                await asyncio.wait_for(asyncio.shield(self._waiter), remaining)
+            except asyncio.TimeoutError:
+                return []
+
+
+class PgNotifyListener:
+    # Feeds NOTIFY payloads from other workers into on_message. Holds one
+    # connection of its own, outside the app's pool (an engine with NullPool
+    # for the same URL). Every keepalive seconds it checks that the
+    # connection still answers, and reconnects if not. Notifications sent in
+    # between are lost, so on_reconnect is called once listening again.
+
+    def __init__(self, engine, on_message, channel=NOTIFY_CHANNEL, retry_delay=5,
+                 keepalive=30, timeout=10, on_reconnect=None):
+        self.engine = engine
+        self.on_message = on_message
+        self.channel = channel
+        self.retry_delay = retry_delay
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.on_reconnect = on_reconnect
+        self.reconnects = 0
+        self._listen_engine = None
+        self._task = None
+
+    def start(self):
+        self._listen_engine = build_engine(
+            self.engine.url.render_as_string(hide_password=False), poolclass=NullPool)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._listen_engine.dispose()
+
+    def _callback(self, connection, pid, channel, payload):
+        try:
+            self.on_message(json.loads(payload))
+        except Exception:
+            logger.exception("Bad NOTIFY payload on %s: %r", channel, payload)
+
+    async def _watch(self, driver_conn, closed):
+        # Returns once the connection is closed or stops answering
+        while True:
+            try:
+                await asyncio.wait_for(closed.wait(), self.keepalive)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await asyncio.wait_for(driver_conn.execute("SELECT 1"), self.timeout)
+            except Exception as e:
+                logger.warning("LISTEN connection doesn't answer: %r", e)
+                return
+
+    async def _run(self):
+        listened = False
+        while True:
+            try:
+                async with self._listen_engine.connect() as conn:
+                    raw = await conn.get_raw_connection()
+                    driver_conn = raw.driver_connection
+                    closed = asyncio.Event()
+                    driver_conn.add_termination_listener(lambda c: closed.set())
+                    await driver_conn.add_listener(self.channel, self._callback)
+                    if listened:
+                        self.reconnects += 1
+                        if self.on_reconnect is not None:
+                            self.on_reconnect()
+                    listened = True
+                    try:
+                        await self._watch(driver_conn, closed)
+                    except asyncio.CancelledError:
+                        if not driver_conn.is_closed():
+                            await driver_conn.remove_listener(self.channel, self._callback)
+                        raise
+                    # Gone or hanging: drop it without waiting for a clean close
+                    driver_conn.terminate()
+                    await conn.invalidate()
+                logger.warning("LISTEN connection lost, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("LISTEN %s failed", self.channel)
+            await asyncio.sleep(self.retry_delay)
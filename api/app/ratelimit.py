@@ -0,0 +1,191 @@
+import asyncio
+from collections import OrderedDict, deque
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Admission control, checked before a request touches the database:
+#
+# * RateLimiter: a token bucket per client address. Every request takes a
+#   token; tokens come back at `rate` per second up to `burst`.
+# * ConcurrencyLimiter: a cap on DB-bound requests in flight in this worker,
+#   so a flood is turned away at once instead of queueing for a pooled
+#   connection until pool_timeout.
+#
+# Both answer 429 with Retry-After. Buckets live in each worker's memory, or
+# with RedisRateLimiter (`pip install redis`) in Redis, shared by all workers.
+
+
+class RateLimiter:
+    # In-process buckets. Least recently used ones past max_keys are
+    # forgotten, which refills them.
+
+    def __init__(self, rate, burst, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()  # key -> (tokens, updated)
+        self.allowed = 0
+        self.rejected = 0
+
+    def take(self, key):
+        # 0 if a token was taken, otherwise the seconds until one is back
+        now = self.clock()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            self.buckets.move_to_end(key)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            self.allowed += 1
+            return 0.0
+        self.buckets[key] = (tokens, now)
+        self.rejected += 1
+        return (1 - tokens) / self.rate
+
+    async def acquire(self, key):
+        return self.take(key)
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "rate": self.rate,
+            "burst": self.burst,
+            "keys": len(self.buckets),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+        }
+
+
+# The same bucket as RateLimiter.take, atomically in Redis and on Redis'
+# clock. Returns the wait as a string: Redis truncates Lua numbers to integers.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = burst
+if bucket[1] then
+    tokens = math.min(burst, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate)
+end
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisRateLimiter:
+    # Buckets shared by every worker. While Redis can't be reached each
+    # worker limits on its own (fallback) rather than not at all.
+
+    def __init__(self, url, rate, burst, prefix="lithings:ratelimit:", fallback=None):
+        # Optional dependency, only needed when RATE_LIMIT_REDIS_URL is set
+        import redis.asyncio
+
+        self.redis_errors = (redis.asyncio.RedisError, OSError)
+        self.client = redis.asyncio.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self.fallback = fallback or RateLimiter(rate, burst)
+        self.allowed = 0
+        self.rejected = 0
+        self.failures = 0
+        self.healthy = True
+
+    async def acquire(self, key):
+        try:
+            wait = float(await self.script(keys=[self.prefix + key], args=[self.rate, self.burst]))
+        except self.redis_errors as e:
+            self.failures += 1
+            if self.healthy:
+                logger.warning("Rate limiting per worker, Redis failed: %s", e)
+                self.healthy = False
+            return self.fallback.take(key)
+        if not self.healthy:
+            logger.info("Rate limiting through Redis again")
+            self.healthy = True
+        if wait > 0:
+            self.rejected += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    async def close(self):
+        await self.client.aclose()
+
+    def stats(self):
+        return {
+            "backend": "redis",
+            "rate": self.rate,
+            "burst": self.burst,
+            "allowed": self.allowed + self.fallback.allowed,
+            "rejected": self.rejected + self.fallback.rejected,
+            "redis_failures": self.failures,
+        }
+
+
+class ConcurrencyLimiter:
+    # Requests in flight in this worker (one event loop, so no lock needed)
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.rejected = 0
+        self.waiters = deque()
+
+    def try_acquire(self):
+        if self.in_flight >= self.limit:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        return True
+
+    async def acquire(self):
+        # Waits for a slot, for work that was admitted earlier (a streaming
+        # body) and can't be turned away any more
+        while self.in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+
+    def release(self):
+        self.in_flight -= 1
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "peak": self.peak,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+
+from sqlalchemy import text
+
+from .db import dialect_name
+
+logger = logging.getLogger(__name__)
+
+# Read/write splitting. With DATABASE_READ_URL set, read-only handlers take
+# their session from get_read_db (app/main.py), which uses the replica while
+# a ReplicaMonitor vouches for it and falls back to the primary otherwise:
+# the replica doesn't answer, or replays more than max_lag seconds behind.
+#
+# Read-your-writes: posts that insert rows answer with a Written-Id header,
+# the newest id they wrote. A client that passes it back as ?min_id= reads
+# from the primary until the replica has replayed that far.
+
+WRITTEN_ID_HEADER = "Written-Id"
+
+# Seconds the replica is behind. Zero when it has replayed everything it
+# received (an idle primary sends nothing, so the age of the last replayed
+# transaction alone would look like lag), and when the URL points at a
+# primary.
+REPLICA_LAG = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+async def replica_lag(conn):
+    if dialect_name(conn) != "postgresql":
+        return 0.0
+    return float(await conn.scalar(REPLICA_LAG))
+
+
+class ReplicaMonitor:
+    # Background task: checks the replica every period seconds. Until the
+    # first check succeeds, reads go to the primary.
+
+    def __init__(self, engine, max_lag=5.0, period=1.0, timeout=2.0):
+        self.engine = engine
+        self.max_lag = max_lag
+        self.period = period
+        self.timeout = timeout
+        self.available = False
+        self.lag = None
+        self.error = None
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self._task = None
+
+    async def check(self):
+        try:
+            # The connect too: an unreachable host would otherwise hold the
+            # check for the whole TCP timeout
+            lag = await asyncio.wait_for(self._lag(), self.timeout)
+        except Exception as e:
+            self.mark_down(e)
+            return False
+        self.lag = lag
+        self.error = None
+        available = lag <= self.max_lag
+        if available and not self.available:
+            logger.info("Reading from the replica (lag %.1f s)", lag)
+        elif self.available and not available:
+            logger.warning("Read replica lags %.1f s, reading from the primary", lag)
+        self.available = available
+        return available
+
+    async def _lag(self):
+        async with self.engine.connect() as conn:
+            return await replica_lag(conn)
+
+    def mark_down(self, error):
+        # Also called by get_read_db when a checkout fails between checks
+        if self.available:
+            logger.warning("Read replica unavailable: %s", error)
+        self.available = False
+        self.error = str(error)
+
+    def record(self, used_replica):
+        if used_replica:
+            self.replica_reads += 1
+        else:
+            self.primary_reads += 1
+
+    def stats(self):
+        return {
+            "available": self.available,
+            "lag_seconds": self.lag,
+            "max_lag_seconds": self.max_lag,
+            "error": self.error,
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+        }
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.period)
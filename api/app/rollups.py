@@ -0,0 +1,298 @@
+import argparse
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import logging
+
+from sqlalchemy import BigInteger, cast, func, select, text, union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .db import dialect_name
+from .locks import ROLLUP_MERGE_LOCK
+from .models import metadata, msgs, msgs_daily, msgs_hourly, msgs_rollup_deltas
+
+logger = logging.getLogger(__name__)
+
+# Per-hour and per-day counts of msg readings by receiver and value.
+#
+# update_rollups() runs inside every inserting transaction and appends the
+# batch's counts to msgs_rollup_deltas, so they commit (or roll back)
+# together with the rows they count. Appending takes no row locks: upserting
+# msgs_hourly/msgs_daily right there would make every concurrent insert
+# without a receiver wait on the same bucket rows until commit. A
+# RollupMerger folds the deltas into the rollup tables every few seconds,
+# and /stats/ adds the ones not merged yet. rebuild() recomputes whole days
+# from msgs, for backfills and after manual edits.
+
+SCHEMA = metadata.schema
+
+# Rows without a created_at get the server default, which is the
+# transaction's timestamp
+INSERT_DELTAS = text(f"""
+    INSERT INTO {SCHEMA}.msgs_rollup_deltas (hour, day, receiver, msg, count)
+    SELECT date_trunc('hour', created_at), date_trunc('day', created_at), receiver, msg, count(*)
+    FROM (
+        SELECT COALESCE(t.created_at, LOCALTIMESTAMP) AS created_at, t.receiver, t.msg
+        FROM unnest(
+            CAST(:created_at AS timestamp[]),
+            CAST(:receiver AS smallint[]),
+            CAST(:msg AS smallint[])
+        ) AS t(created_at, receiver, msg)
+    ) AS readings
+    GROUP BY 1, 2, 3, 4
+""")
+
+# One statement for both tables and both kinds of receiver. The DELETE only
+# sees committed deltas; groups are written in key order so a merge can't
+# deadlock with a rebuild.
+MERGE_DELTAS = text(f"""
+    WITH moved AS (
+        DELETE FROM {SCHEMA}.msgs_rollup_deltas RETURNING hour, day, receiver, msg, count
+    ),
+    hourly_receiver AS (
+        INSERT INTO {SCHEMA}.msgs_hourly (hour, receiver, msg, count)
+        SELECT hour, receiver, msg, sum(count) FROM moved
+        WHERE receiver IS NOT NULL GROUP BY 1, 2, 3 ORDER BY 2, 1, 3
+        ON CONFLICT (receiver, hour, msg) WHERE receiver IS NOT NULL
+        DO UPDATE SET count = msgs_hourly.count + EXCLUDED.count
+    ),
+    hourly_no_receiver AS (
+        INSERT INTO {SCHEMA}.msgs_hourly (hour, receiver, msg, count)
+        SELECT hour, NULL, msg, sum(count) FROM moved
+        WHERE receiver IS NULL GROUP BY 1, 3 ORDER BY 1, 3
+        ON CONFLICT (hour, msg) WHERE receiver IS NULL
+        DO UPDATE SET count = msgs_hourly.count + EXCLUDED.count
+    ),
+    daily_receiver AS (
+        INSERT INTO {SCHEMA}.msgs_daily (day, receiver, msg, count)
+        SELECT day, receiver, msg, sum(count) FROM moved
+        WHERE receiver IS NOT NULL GROUP BY 1, 2, 3 ORDER BY 2, 1, 3
+        ON CONFLICT (receiver, day, msg) WHERE receiver IS NOT NULL
+        DO UPDATE SET count = msgs_daily.count + EXCLUDED.count
+    )
+    INSERT INTO {SCHEMA}.msgs_daily (day, receiver, msg, count)
+    SELECT day, NULL, msg, sum(count) FROM moved
+    WHERE receiver IS NULL GROUP BY 1, 3 ORDER BY 1, 3
+    ON CONFLICT (day, msg) WHERE receiver IS NULL
+    DO UPDATE SET count = msgs_daily.count + EXCLUDED.count
+""")
+
+
+def truncate_hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def truncate_day(moment):
+    return datetime(moment.year, moment.month, moment.day)
+
+
+async def update_rollups(conn, rows):
+    # conn: the connection or session that inserted rows, before commit
+    readings = [row for row in rows if row.get("msg") is not None]
+    if not readings:
+        return
+    if dialect_name(conn) == "sqlite":
+        # No unnest in SQLite: count the groups here
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        counts = Counter(
+            (truncate_hour(row.get("created_at") or now), row.get("receiver"), row["msg"]) for row in readings)
+        await conn.execute(msgs_rollup_deltas.insert(), [
+            {"hour": hour, "day": truncate_day(hour), "receiver": receiver, "msg": msg, "count": count}
+            for (hour, receiver, msg), count in counts.items()
+        ])
+        return
+    await conn.execute(INSERT_DELTAS, {
+        "created_at": [row.get("created_at") for row in readings],
+        "receiver": [row.get("receiver") for row in readings],
+        "msg": [row["msg"] for row in readings],
+    })
+
+
+async def merge_deltas(conn):
+    # Inside a transaction: moves every committed delta into the rollups
+    if dialect_name(conn) == "postgresql":
+        await conn.execute(MERGE_DELTAS)
+        return
+    deltas = (await conn.execute(select(msgs_rollup_deltas))).all()
+    if not deltas:
+        return
+    await conn.execute(msgs_rollup_deltas.delete())
+    for table, bucket in ((msgs_hourly, "hour"), (msgs_daily, "day")):
+        counts = Counter()
+        for delta in deltas:
+            counts[delta._mapping[bucket], delta.receiver, delta.msg] += delta.count
+        for with_receiver in (True, False):
+            groups = [
+                {bucket: start, "receiver": receiver, "msg": msg, "count": count}
+                for (start, receiver, msg), count in counts.items()
+                if (receiver is not None) == with_receiver
+            ]
+            if not groups:
+                continue
+            insert = sqlite_insert(table)
+            await conn.execute(insert.on_conflict_do_update(
+                index_elements=["receiver", bucket, "msg"] if with_receiver else [bucket, "msg"],
+                index_where=table.c.receiver.isnot(None) if with_receiver else table.c.receiver.is_(None),
+                set_={"count": table.c.count + insert.excluded["count"]},
+            ), groups)
+
+
+class RollupMerger:
+    # Background task: merge_deltas every period seconds. Every worker runs
+    # one; with Postgres a transaction-level advisory lock lets one merge at
+    # a time and the others skip that round.
+
+    def __init__(self, engine, period=5):
+        self.engine = engine
+        self.period = period
+        self._task = None
+
+    async def run_once(self):
+        async with self.engine.begin() as conn:
+            if dialect_name(conn) == "postgresql" and not await conn.scalar(
+                    text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": ROLLUP_MERGE_LOCK}):
+                return False
+            await merge_deltas(conn)
+        return True
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.period)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Merging rollup deltas failed")
+
+
+# Bucket expressions per dialect. SQLite keeps timestamps as text, in the
+# format SQLAlchemy writes them.
+TRUNCATE_HOUR = {
+    "postgresql": "date_trunc('hour', {})",
+    "sqlite": "strftime('%Y-%m-%d %H:00:00.000000', {})",
+}
+TRUNCATE_DAY = {
+    "postgresql": "date_trunc('day', {})",
+    "sqlite": "strftime('%Y-%m-%d 00:00:00.000000', {})",
+}
+
+
+async def rebuild_day(conn, day):
+    dialect = dialect_name(conn)
+    params = {"start": day, "end": day + timedelta(days=1)}
+    if dialect == "postgresql":
+        # The lock waits for inserts that already counted into these tables
+        # and holds new ones until the day is rewritten, so none is lost or
+        # doubled. SQLite only ever has one writing transaction.
+        await conn.execute(text(
+            f"LOCK TABLE {SCHEMA}.msgs_hourly, {SCHEMA}.msgs_daily, {SCHEMA}.msgs_rollup_deltas"
+            " IN SHARE ROW EXCLUSIVE MODE"))
+    # The recount covers the day's unmerged deltas too
+    await conn.execute(text(
+        f"DELETE FROM {SCHEMA}.msgs_rollup_deltas WHERE day >= :start AND day < :end"), params)
+    await conn.execute(text(
+        f"DELETE FROM {SCHEMA}.msgs_hourly WHERE hour >= :start AND hour < :end"), params)
+    await conn.execute(text(f"""
+        INSERT INTO {SCHEMA}.msgs_hourly (hour, receiver, msg, count)
+        SELECT {TRUNCATE_HOUR[dialect].format("created_at")}, receiver, msg, count(*) FROM {SCHEMA}.msgs
+        WHERE created_at >= :start AND created_at < :end AND msg IS NOT NULL
+        GROUP BY 1, 2, 3
+    """), params)
+    await conn.execute(text(
+        f"DELETE FROM {SCHEMA}.msgs_daily WHERE day >= :start AND day < :end"), params)
+    await conn.execute(text(f"""
+        INSERT INTO {SCHEMA}.msgs_daily (day, receiver, msg, count)
+        SELECT {TRUNCATE_DAY[dialect].format("hour")}, receiver, msg, sum(count) FROM {SCHEMA}.msgs_hourly
+        WHERE hour >= :start AND hour < :end
+        GROUP BY 1, 2, 3
+    """), params)
+
+
+async def rebuild(engine, since=None, until=None):
+    # Recomputes every whole day touching [since, until), one transaction per
+    # day. Defaults: from the oldest row up to today.
+    if since is None:
+        async with engine.connect() as conn:
+            since = await conn.scalar(select(func.min(msgs.c.created_at)))
+        if since is None:
+            return 0
+    if until is None:
+        until = datetime.now(timezone.utc).replace(tzinfo=None)
+    day = datetime(since.year, since.month, since.day)
+    days = 0
+    while day < until:
+        async with engine.begin() as conn:
+            await rebuild_day(conn, day)
+        logger.info("Rebuilt rollups for %s", day.date())
+        day += timedelta(days=1)
+        days += 1
+    return days
+
+
+# Buckets per /stats/ answer, above that the day table is used
+MAX_HOURLY_BUCKETS = 24 * 31
+
+
+def rollup_for(resolution):
+    return (msgs_hourly, "hour") if resolution == "hour" else (msgs_daily, "day")
+
+
+def stats_queries(resolution, since, until, receiver=None):
+    # (per bucket and receiver, per value) over buckets starting in [since, until),
+    # from the rollup table plus the deltas not merged into it yet
+    table, bucket = rollup_for(resolution)
+    counts = union_all(*(
+        select(source.c[bucket].label("start"), source.c.receiver, source.c.msg, source.c.count)
+        .where(source.c[bucket] >= since, source.c[bucket] < until)
+        .where(*([] if receiver is None else [source.c.receiver == receiver]))
+        for source in (table, msgs_rollup_deltas)
+    )).subquery()
+    total = cast(func.sum(counts.c.count), BigInteger).label("count")
+    buckets = (
+        select(counts.c.start, counts.c.receiver, total)
+        .group_by(counts.c.start, counts.c.receiver)
+        .order_by(counts.c.start, counts.c.receiver)
+    )
+    distribution = (
+        select(counts.c.msg, total)
+        .group_by(counts.c.msg)
+        .order_by(counts.c.msg)
+    )
+    return buckets, distribution
+
+
+def parse_day(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+if __name__ == "__main__":
+    # python -m app.rollups rebuild [--since 2024-01-01] [--until 2024-02-01]
+    from .main import get_engine
+
+    parser = argparse.ArgumentParser(description="Maintain the msgs rollup tables")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = commands.add_parser("rebuild", help="recompute whole days from msgs")
+    rebuild_parser.add_argument("--since", type=parse_day, help="first day (default: oldest row)")
+    rebuild_parser.add_argument("--until", type=parse_day, help="day after the last one (default: today)")
+    args = parser.parse_args()
+
+    async def run():
+        engine = get_engine()
+        days = await rebuild(engine, args.since, args.until)
+        logger.info("Rebuilt %d days", days)
+        await engine.dispose()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run())
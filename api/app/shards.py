@@ -0,0 +1,487 @@
+import argparse
+import asyncio
+import bisect
+from datetime import timedelta
+import hashlib
+import heapq
+import logging
+import os
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import operators
+
+from .db import AsyncSessionLocal, build_engine, dialect_name, get_engine
+from .ingest import IngestQueue, IngestQueueFull
+from .metrics import TimedSession
+from .models import metadata, msg_keys, msgs
+from .rollups import rebuild
+
+logger = logging.getLogger(__name__)
+
+# Optional sharding of msgs by receiver over several databases
+# (DATABASE_SHARDS). A consistent hash ring places each receiver, so a
+# receiver's rows, inbox, rollups and idempotency keys all live on one shard
+# and per-receiver requests touch only that shard. Adding a shard moves
+# about 1/N of the receivers; `python -m app.shards rebalance` copies their
+# rows over.
+#
+# Requests without a receiver (the global lists, /export/, the spatial
+# queries) run on every shard at once and ScatterSession merges the answers
+# by the query's ORDER BY, applying its LIMIT again.
+#
+# Ids stay unique and in insertion order across shards: every insert takes
+# them from the msgs sequence of DATABASE_URL, the id database, one round
+# trip per batch. That database needs to be up for any write.
+
+SCHEMA = metadata.schema
+
+# Points per shard on the ring. More spread the receivers more evenly.
+RING_VNODES = 128
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def receiver_key(receiver):
+    # Rows without a receiver are kept together on one shard
+    return "none" if receiver is None else str(receiver)
+
+
+class HashRing:
+    def __init__(self, names, vnodes=RING_VNODES):
+        if not names:
+            raise ValueError("A hash ring needs at least one shard")
+        points = sorted(
+            (ring_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.names = [name for _, name in points]
+
+    def lookup(self, key):
+        # The first point clockwise from the key's hash
+        index = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.names[index]
+
+
+def parse_shards(spec):
+    # "a=postgresql+asyncpg://...,b=..." -> [(name, url)]
+    shards = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, sep, url = entry.partition("=")
+        if not sep or not name.strip() or not url.strip():
+            raise ValueError(f"DATABASE_SHARDS entries look like name=url, got {entry!r}")
+        shards.append((name.strip(), url.strip()))
+    names = [name for name, _ in shards]
+    if len(set(names)) != len(names):
+        raise ValueError("DATABASE_SHARDS names must be unique")
+    return shards
+
+
+async def allocate_ids(engine, count):
+    # count new ids from the msgs sequence of engine's database
+    if dialect_name(engine) == "postgresql":
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+                {"table": f"{SCHEMA}.msgs", "count": count},
+            )
+            return list(result.scalars())
+    # SQLite: msgs is AUTOINCREMENT, reserve a block of its sequence
+    async with engine.begin() as conn:
+        last = await conn.scalar(text(
+            f"UPDATE {SCHEMA}.sqlite_sequence SET seq = seq + :count WHERE name = 'msgs' RETURNING seq"
+        ), {"count": count})
+        if last is None:
+            last = (await conn.scalar(select(func.max(msgs.c.id))) or 0) + count
+            await conn.execute(text(
+                f"INSERT INTO {SCHEMA}.sqlite_sequence (name, seq) VALUES ('msgs', :seq)"), {"seq": last})
+    return list(range(last - count + 1, last + 1))
+
+
+class Shard:
+    def __init__(self, name, engine, sessions=None):
+        self.name = name
+        self.engine = engine
+        self.sessions = sessions or sessionmaker(class_=TimedSession, expire_on_commit=False, bind=engine)
+
+    def __repr__(self):
+        return f"Shard({self.name!r})"
+
+
+class ShardSet:
+    def __init__(self, shards, id_engine, vnodes=RING_VNODES):
+        self.shards = {shard.name: shard for shard in shards}
+        self.ring = HashRing(list(self.shards), vnodes)
+        self.id_engine = id_engine
+        self._placement = {}
+
+    @classmethod
+    def from_env(cls):
+        # None unless DATABASE_SHARDS is set. A shard with the URL of
+        # DATABASE_URL shares its engine.
+        spec = os.getenv("DATABASE_SHARDS")
+        if not spec:
+            return None
+        home = get_engine()
+        shards = []
+        for name, url in parse_shards(spec):
+            if url == os.getenv("DATABASE_URL"):
+                shards.append(Shard(name, home, AsyncSessionLocal))
+            else:
+                shards.append(Shard(name, build_engine(url)))
+        return cls(shards, home)
+
+    def __iter__(self):
+        return iter(self.shards.values())
+
+    def __len__(self):
+        return len(self.shards)
+
+    def engines(self):
+        # Every database involved, the id database first
+        engines = [self.id_engine]
+        for shard in self:
+            if shard.engine is not self.id_engine:
+                engines.append(shard.engine)
+        return engines
+
+    def shard_for(self, receiver):
+        shard = self._placement.get(receiver)
+        if shard is None:
+            shard = self._placement[receiver] = self.shards[self.ring.lookup(receiver_key(receiver))]
+        return shard
+
+    def group(self, rows):
+        # {shard: rows}, in the order the rows came
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.shard_for(row.get("receiver")), []).append(row)
+        return groups
+
+    def scatter(self):
+        return ScatterSession(self)
+
+    def sessions_for(self, receiver):
+        # A sessionmaker: the receiver's shard, or all of them for None
+        if receiver is None:
+            return self.scatter
+        return self.shard_for(receiver).sessions
+
+    def session_factory(self, db):
+        # The sessionmaker db came from
+        if isinstance(db, ScatterSession):
+            return self.scatter
+        for shard in self:
+            if db.bind is shard.engine:
+                return shard.sessions
+        raise ValueError("Session does not belong to a shard")
+
+    async def assign_ids(self, rows):
+        ids = await allocate_ids(self.id_engine, len(rows))
+        return [dict(row, id=msg_id) for row, msg_id in zip(rows, ids)]
+
+    def stats(self):
+        return {shard.name: shard.engine.pool.stats() for shard in self}
+
+    async def dispose(self):
+        # The id database's engine belongs to app/db.py
+        for engine in self.engines()[1:]:
+            await engine.dispose()
+
+
+class _Descending:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def merge_key(query, dialect):
+    # Sort key of a result row following the query's ORDER BY. Each ordering
+    # column has to be selected. NULLs sort as the database would: above
+    # every value in Postgres, below in SQLite.
+    columns = list(query.selected_columns)
+    null_rank = 1 if dialect == "postgresql" else -1
+    positions = []
+    for clause in query._order_by_clauses:
+        descending = getattr(clause, "modifier", None) is operators.desc_op
+        if getattr(clause, "modifier", None) in (operators.desc_op, operators.asc_op):
+            clause = clause.element
+        # A label ordered by name, order_by(distance) for distance.label(...)
+        targets = {id(clause), id(getattr(clause, "element", clause))}
+        for index, column in enumerate(columns):
+            if id(column) in targets or id(getattr(column, "element", column)) in targets:
+                positions.append((index, descending))
+                break
+        else:
+            raise ValueError(f"Can't merge shard results on {clause}, it isn't selected")
+
+    def key(row):
+        parts = []
+        for index, descending in positions:
+            value = row[index]
+            part = (null_rank, 0) if value is None else (0, value)
+            parts.append(_Descending(part) if descending else part)
+        return tuple(parts)
+
+    return key
+
+
+class MergedResult:
+    # The part of Result the handlers use, over rows already merged
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return list(self.rows)
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+    def scalar(self):
+        row = self.first()
+        return None if row is None else row[0]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+async def _next_or_none(iterator):
+    # Like anext(iterator, None), which needs Python 3.10
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+class MergedStream:
+    # k-way merge of server-side cursors, one per shard, for streamed reads
+
+    def __init__(self, results, key, limit=None, partition_size=100):
+        self.results = results
+        self.key = key
+        self.limit = limit
+        self.partition_size = partition_size
+
+    async def __aiter__(self):
+        iterators = [result.__aiter__() for result in self.results]
+        heap = []
+        for index, iterator in enumerate(iterators):
+            row = await _next_or_none(iterator)
+            if row is not None:
+                heap.append((self.key(row), index, row))
+        heapq.heapify(heap)
+        emitted = 0
+        while heap and (self.limit is None or emitted < self.limit):
+            _, index, row = heap[0]
+            yield row
+            emitted += 1
+            following = await _next_or_none(iterators[index])
+            if following is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (self.key(following), index, following))
+
+    async def partitions(self, size=None):
+        size = size or self.partition_size
+        partition = []
+        async for row in self:
+            partition.append(row)
+            if len(partition) == size:
+                yield partition
+                partition = []
+        if partition:
+            yield partition
+
+
+class ScatterSession:
+    # Read-only stand-in for an AsyncSession covering every shard. Each
+    # shard gets a session of its own, connected on first use.
+
+    def __init__(self, shard_set):
+        self.shard_set = shard_set
+        self.sessions = [shard.sessions() for shard in shard_set]
+        self.dialect = dialect_name(next(iter(shard_set)).engine)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _check(self, query):
+        if not query.is_select:
+            raise ValueError("Only reads can run on every shard")
+        if query._offset is not None:
+            raise ValueError("OFFSET can't be applied across shards")
+        return merge_key(query, self.dialect)
+
+    async def execute(self, query):
+        key = self._check(query)
+        results = await asyncio.gather(*(session.execute(query) for session in self.sessions))
+        rows = [row for result in results for row in result.all()]
+        if query._order_by_clauses:
+            rows.sort(key=key)
+        if query._limit is not None:
+            rows = rows[:query._limit]
+        return MergedResult(rows)
+
+    async def scalar(self, query):
+        return (await self.execute(query)).scalar()
+
+    async def stream(self, query):
+        key = self._check(query)
+        results = await asyncio.gather(*(session.stream(query) for session in self.sessions))
+        yield_per = query.get_execution_options().get("yield_per")
+        return MergedStream(results, key, query._limit, yield_per or 100)
+
+    async def close(self):
+        for session in self.sessions:
+            await session.close()
+
+
+class ShardedIngestQueue:
+    # IngestQueue per shard behind the same interface
+
+    def __init__(self, shard_set, table, **options):
+        self.shard_set = shard_set
+        self.queues = {
+            shard: IngestQueue(shard.engine, table, assign_ids=shard_set.assign_ids, **options)
+            for shard in shard_set
+        }
+
+    def submit(self, row):
+        self.queues[self.shard_set.shard_for(row.get("receiver"))].submit(row)
+
+    def submit_many(self, rows):
+        # All or nothing across shards too
+        groups = self.shard_set.group(rows)
+        for shard, group in groups.items():
+            if self.queues[shard].room() < len(group):
+                raise IngestQueueFull("Ingest queue is full")
+        for shard, group in groups.items():
+            self.queues[shard].submit_many(group)
+
+    def start(self):
+        for queue in self.queues.values():
+            queue.start()
+
+    async def stop(self):
+        await asyncio.gather(*(queue.stop() for queue in self.queues.values()))
+
+
+def receiver_is(receiver):
+    return msgs.c.receiver.is_(None) if receiver is None else msgs.c.receiver == receiver
+
+
+def insert_ignoring_duplicates(conn, table):
+    insert = pg_insert(table) if dialect_name(conn) == "postgresql" else sqlite_insert(table)
+    return insert.on_conflict_do_nothing()
+
+
+async def receivers_on(shard):
+    async with shard.engine.connect() as conn:
+        return list((await conn.execute(select(msgs.c.receiver).distinct())).scalars())
+
+
+async def misplaced(shard_set):
+    # [(receiver, source shard, target shard)] for rows not on their ring shard
+    moves = []
+    for shard in shard_set:
+        for receiver in await receivers_on(shard):
+            target = shard_set.shard_for(receiver)
+            if target is not shard:
+                moves.append((receiver, shard, target))
+    return moves
+
+
+async def move_receiver(source, target, receiver, batch=1000):
+    # Copies the receiver's rows and idempotency keys in id order, batch by
+    # batch, and deletes each batch from the source once the target has
+    # committed it. Safe to interrupt and run again: rows already copied are
+    # skipped. Returns (rows moved, oldest and newest created_at).
+    moved, oldest, newest = 0, None, None
+    while True:
+        async with source.engine.connect() as conn:
+            rows = [dict(row._mapping) for row in await conn.execute(
+                select(*msgs.c).where(receiver_is(receiver)).order_by(msgs.c.id).limit(batch))]
+            if not rows:
+                break
+            ids = [row["id"] for row in rows]
+            keys = [dict(row._mapping) for row in await conn.execute(
+                select(*msg_keys.c).where(msg_keys.c.msg_id.in_(ids)))]
+        async with target.engine.begin() as conn:
+            await conn.execute(insert_ignoring_duplicates(conn, msgs), rows)
+            if keys:
+                await conn.execute(insert_ignoring_duplicates(conn, msg_keys), keys)
+        async with source.engine.begin() as conn:
+            await conn.execute(msg_keys.delete().where(msg_keys.c.msg_id.in_(ids)))
+            await conn.execute(msgs.delete().where(msgs.c.id.in_(ids)))
+        moved += len(rows)
+        created = [row["created_at"] for row in rows]
+        oldest = min(created) if oldest is None else min(oldest, *created)
+        newest = max(created) if newest is None else max(newest, *created)
+    return moved, oldest, newest
+
+
+async def rebalance(shard_set, batch=1000, dry_run=False):
+    # Moves every receiver to the shard the ring gives it, then recounts the
+    # rollups of the days that changed on either side. Returns the moves.
+    moves = await misplaced(shard_set)
+    if dry_run:
+        return moves
+    touched = {}
+    for receiver, source, target in moves:
+        moved, oldest, newest = await move_receiver(source, target, receiver, batch)
+        logger.info("Moved %d rows of receiver %s from %s to %s", moved, receiver, source.name, target.name)
+        if oldest is None:
+            continue
+        for shard in (source, target):
+            since, until = touched.get(shard, (oldest, newest))
+            touched[shard] = (min(since, oldest), max(until, newest))
+    for shard, (since, until) in touched.items():
+        await rebuild(shard.engine, since, until + timedelta(seconds=1))
+    return moves
+
+
+if __name__ == "__main__":
+    # python -m app.shards rebalance [--dry-run] [--batch 1000]
+    from .main import MSGS_PARTITIONING
+    from .migrations import migrate
+
+    parser = argparse.ArgumentParser(description="Maintain the msgs shards (DATABASE_SHARDS)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebalance_parser = commands.add_parser("rebalance", help="move receivers to the shard the ring gives them")
+    rebalance_parser.add_argument("--dry-run", action="store_true", help="only list the receivers to move")
+    rebalance_parser.add_argument("--batch", type=int, default=1000, help="rows per copy transaction")
+    args = parser.parse_args()
+
+    async def run():
+        shard_set = ShardSet.from_env()
+        if shard_set is None:
+            raise SystemExit("DATABASE_SHARDS is not set")
+        for engine in shard_set.engines():
+            await migrate(engine, MSGS_PARTITIONING)
+        moves = await rebalance(shard_set, args.batch, args.dry_run)
+        for receiver, source, target in moves:
+            logger.info("Receiver %s: %s -> %s", receiver, source.name, target.name)
+        logger.info("%d receivers %s", len(moves), "to move" if args.dry_run else "moved")
+        await shard_set.dispose()
+        await get_engine().dispose()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run())
@@ -0,0 +1,8 @@
+from uvicorn.workers import UvicornWorker
+
+
+class UvloopWorker(UvicornWorker):
+    # Gunicorn worker for gunicorn.conf.py. Asks for uvloop and httptools
+    # outright (uvicorn[standard] installs both) instead of "auto", so a
+    # missing one fails at startup rather than silently running slower.
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
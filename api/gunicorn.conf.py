@@ -0,0 +1,41 @@
+# Multi-process serving: gunicorn -c gunicorn.conf.py app.main:app
+#
+# Gunicorn only supervises; each worker is a uvicorn event loop with its own
+# engine and connection pool, in-process caches and /metrics counters (see
+# "Running several workers" in README.md). Reload gracefully with
+# kill -HUP <master pid>: new workers start, old ones finish what they are
+# serving and drain their ingest queue, within graceful_timeout.
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+# Same .env as the app, so WEB_CONCURRENCY and friends can live there too
+load_dotenv()
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '80')}")
+# Default one worker per core; the database pool is per worker, so
+# connections to Postgres add up to workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+workers = int(os.getenv("WEB_CONCURRENCY") or multiprocessing.cpu_count())
+worker_class = "app.workers.UvloopWorker"
+
+# Workers import the app themselves, after the fork: asyncpg connections and
+# event loops must not be shared between processes
+preload_app = False
+
+# Seconds a worker gets to finish on reload or shutdown. Long-polls and SSE
+# streams still open after that are cut; clients reconnect (SSE resumes from
+# Last-Event-ID).
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# A worker whose event loop doesn't check in for this long is restarted
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+
+# Restart each worker after about this many requests, 0 never
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+# The app logs JSON itself (app/logs.py), gunicorn only reports on workers
+accesslog = None
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
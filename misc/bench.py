@@ -0,0 +1,408 @@
+"""Load test the API with a device-like mixed workload.
+
+Starts the app under uvicorn against DATABASE_URL, seeds msgs through
+/post-msgs/batch, then runs for a fixed time:
+
+  * polling readers: devices asking /latest-text-msg/ with If-None-Match,
+    and dashboards paging through /all-msgs/
+  * bursty writers: idle for a while, then a burst of /post-msg/ and
+    /post-text-msg/ requests back to back
+
+Client-side req/s and p50/p95/p99 are reported per route, together with the
+server-side DB time per request, taken from the difference between two
+/metrics scrapes. Results are JSON so runs on different commits can be
+compared:
+
+    python misc/bench.py --rows 100000 --output before.json
+    python misc/bench.py --rows 0 --output after.json --compare before.json
+
+--workers N serves with gunicorn and N workers (api/gunicorn.conf.py) instead
+of a single uvicorn process. --scaling repeats the run for several worker
+counts and reports throughput per worker; use a short --poll-interval so the
+server rather than the clients' think time is the limit, and keep in mind
+that this script is one process too:
+
+    python misc/bench.py --scaling 1,2,4 --poll-interval 0.05 --output scaling.json
+
+The cost of admission control (app/ratelimit.py) is the difference between a
+run without it and one with limits too high to turn anything away; with
+real limits, 429s are counted as "rejected" rather than as errors. Writers
+post as senders of their own. misc/bench_ratelimit.py measures the
+per-request bookkeeping in isolation.
+
+    python misc/bench.py --output plain.json
+    python misc/bench.py --env RATE_LIMIT_PER_SECOND=1000000 \
+        --env DB_CONCURRENCY_LIMIT=100000 --compare plain.json
+
+Without a Postgres server, --database-url sqlite+aiosqlite:///tmp/bench.db
+gives a quick offline run (numbers are not comparable with Postgres ones).
+"""
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+RECEIVERS = 100
+SEED_BATCH = 5000
+
+
+def percentile(ordered, fraction):
+    # Nearest rank on a sorted list
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=API_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(args, port):
+    env = dict(os.environ, DATABASE_URL=args.database_url, LOG_LEVEL="WARNING")
+    for setting in args.env:
+        key, _, value = setting.partition("=")
+        env[key] = value
+    if args.workers:
+        command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+                   "--bind", f"127.0.0.1:{port}", "--workers", str(args.workers), "app.main:app"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "app.main:app",
+                   "--host", "127.0.0.1", "--port", str(port), "--no-access-log"]
+    return subprocess.Popen(command, cwd=API_DIR, env=env)
+
+
+async def wait_ready(client, server, started, timeout=60):
+    # Seconds from spawning the server (time.monotonic() at `started`) to its
+    # first answer, migrations included
+    while time.monotonic() - started < timeout:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"server exited with {server.returncode}")
+        try:
+            if (await client.get("/metrics")).status_code == 200:
+                return time.monotonic() - started
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("server did not become ready")
+
+
+def seed_record(i):
+    # One text message in ten, the rest readings
+    record = {"receiver": i % RECEIVERS, "sender": (i * 7) % RECEIVERS}
+    if i % 10 == 0:
+        record["text_msg"] = f"seed message {i}"
+    else:
+        record["msg"] = i % 1000
+    return record
+
+
+async def seed(client, rows, concurrency=4):
+    started = time.perf_counter()
+    batches = iter(range(0, rows, SEED_BATCH))
+
+    async def worker():
+        for start in batches:
+            records = [seed_record(i) for i in range(start, min(start + SEED_BATCH, rows))]
+            response = await client.post("/post-msgs/batch", json=records, timeout=120)
+            response.raise_for_status()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {"rows": rows, "seconds": round(elapsed, 3),
+            "rows_per_second": round(rows / elapsed) if rows and elapsed > 0 else 0}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.rejected = {}
+
+    async def request(self, client, name, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        if response.status_code == 429:
+            self.rejected[name] = self.rejected.get(name, 0) + 1
+        elif response.status_code >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        return response
+
+
+async def device_reader(client, recorder, stop, interval):
+    receiver = random.randrange(RECEIVERS)
+    etag = None
+    await asyncio.sleep(random.uniform(0, interval))
+    while not stop.is_set():
+        headers = {"If-None-Match": etag} if etag else {}
+        response = await recorder.request(
+            client, "GET /latest-text-msg/", "GET", "/latest-text-msg/",
+            params={"receiver": receiver}, headers=headers)
+        if response is not None and response.status_code == 200:
+            etag = response.headers.get("etag")
+        await asyncio.sleep(random.uniform(0.5, 1.5) * interval)
+
+
+async def dashboard_reader(client, recorder, stop, interval):
+    await asyncio.sleep(random.uniform(0, interval))
+    while not stop.is_set():
+        params = {"limit": 100}
+        if random.random() < 0.5:
+            params["receiver"] = random.randrange(RECEIVERS)
+        response = await recorder.request(client, "GET /all-msgs/", "GET", "/all-msgs/", params=params)
+        # Sometimes look at the next page too
+        if response is not None and response.status_code == 200 and random.random() < 0.3:
+            cursor = response.json().get("next_cursor")
+            if cursor:
+                await recorder.request(client, "GET /all-msgs/", "GET", "/all-msgs/",
+                                       params=dict(params, before_id=cursor))
+        await asyncio.sleep(random.uniform(0.5, 1.5) * interval)
+
+
+async def bursty_writer(client, recorder, stop, burst_size, burst_interval, sender):
+    while not stop.is_set():
+        await asyncio.sleep(random.expovariate(1 / burst_interval))
+        for _ in range(random.randint(1, burst_size)):
+            receiver = random.randrange(RECEIVERS)
+            if random.random() < 0.1:
+                await recorder.request(client, "POST /post-text-msg/", "POST", "/post-text-msg/",
+                                       json={"receiver": receiver, "sender": sender, "text_msg": "bench"})
+            else:
+                await recorder.request(client, "POST /post-msg/", "POST", "/post-msg/",
+                                       json={"receiver": receiver, "sender": sender, "msg": random.randrange(1000)})
+
+
+METRIC_LINE = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+
+
+def parse_metrics(body):
+    # {(name, method, route): value} for the series the report uses
+    samples = {}
+    for line in body.splitlines():
+        match = METRIC_LINE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        if name not in ("http_request_db_seconds_sum", "http_request_db_seconds_count",
+                        "http_request_duration_seconds_sum", "http_request_duration_seconds_count"):
+            continue
+        labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels))
+        key = (name, labels.get("method"), labels["route"])
+        # Summed over status codes
+        samples[key] = samples.get(key, 0) + float(value)
+    return samples
+
+
+def server_times(before, after):
+    # "METHOD route" -> mean server time and mean DB time per request over the run
+    def delta(name, method, route):
+        return after.get((name, method, route), 0) - before.get((name, method, route), 0)
+
+    result = {}
+    for name, method, route in after:
+        if name != "http_request_duration_seconds_count":
+            continue
+        count = delta(name, method, route)
+        if count <= 0:
+            continue
+        db_count = delta("http_request_db_seconds_count", None, route)
+        result[f"{method} {route}"] = {
+            "server_ms_mean": round(delta("http_request_duration_seconds_sum", method, route) / count * 1000, 3),
+            "db_ms_mean": round(delta("http_request_db_seconds_sum", None, route) / db_count * 1000, 3)
+            if db_count > 0 else None,
+        }
+    return result
+
+
+def summarize(recorder, elapsed, server):
+    routes = {}
+    total = []
+    for name, latencies in sorted(recorder.latencies.items()):
+        latencies.sort()
+        total.extend(latencies)
+        routes[name] = {
+            "requests": len(latencies),
+            "errors": recorder.errors.get(name, 0),
+            "rejected": recorder.rejected.get(name, 0),
+            "rps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "max_ms": round(latencies[-1] * 1000, 3),
+            **server.get(name, {"server_ms_mean": None, "db_ms_mean": None}),
+        }
+    total.sort()
+    overall = {
+        "requests": len(total),
+        "errors": sum(recorder.errors.values()),
+        "rejected": sum(recorder.rejected.values()),
+        "rps": round(len(total) / elapsed, 1),
+        "p50_ms": round(percentile(total, 0.50) * 1000, 3) if total else None,
+        "p95_ms": round(percentile(total, 0.95) * 1000, 3) if total else None,
+        "p99_ms": round(percentile(total, 0.99) * 1000, 3) if total else None,
+    }
+    return routes, overall
+
+
+async def run(args):
+    port = args.port or free_port()
+    base_url = args.url or f"http://127.0.0.1:{port}"
+    spawned = time.monotonic()
+    server = None if args.url else start_server(args, port)
+    limits = httpx.Limits(max_connections=args.readers + args.dashboards + args.writers + 8)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+            startup = await wait_ready(client, server, spawned)
+            seeded = await seed(client, args.rows) if args.rows else None
+
+            before = parse_metrics((await client.get("/metrics")).text)
+            recorder = Recorder()
+            stop = asyncio.Event()
+            tasks = (
+                [device_reader(client, recorder, stop, args.poll_interval) for _ in range(args.readers)]
+                + [dashboard_reader(client, recorder, stop, args.poll_interval * 5) for _ in range(args.dashboards)]
+                + [bursty_writer(client, recorder, stop, args.burst_size, args.burst_interval, sender)
+                   for sender in range(args.writers)]
+            )
+            started = time.perf_counter()
+            running = [asyncio.create_task(task) for task in tasks]
+            await asyncio.sleep(args.duration)
+            stop.set()
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            elapsed = time.perf_counter() - started
+            after = parse_metrics((await client.get("/metrics")).text)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    routes, overall = summarize(recorder, elapsed, server_times(before, after))
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "database": args.database_url.split("://", 1)[0] if args.database_url else None,
+            "workers": args.workers or 1,
+            "server": "gunicorn" if args.workers else "uvicorn",
+            "startup_seconds": round(startup, 3),
+            "duration_seconds": round(elapsed, 3),
+            "readers": args.readers,
+            "dashboards": args.dashboards,
+            "writers": args.writers,
+            "env": args.env,
+        },
+        "seed": seeded,
+        "routes": routes,
+        "total": overall,
+    }
+
+
+def compare(current, baseline):
+    # Relative change of the headline numbers, positive p99 change is worse
+    lines = [f"compared with {baseline['meta'].get('commit')}:"]
+    for name, route in current["routes"].items():
+        old = baseline["routes"].get(name)
+        if not old:
+            continue
+        rps = (route["rps"] - old["rps"]) / old["rps"] * 100 if old["rps"] else 0
+        p99 = (route["p99_ms"] - old["p99_ms"]) / old["p99_ms"] * 100 if old["p99_ms"] else 0
+        lines.append(f"  {name:24} rps {rps:+6.1f}%  p99 {p99:+6.1f}%")
+    return "\n".join(lines)
+
+
+def scaling(runs):
+    # Throughput per worker count, relative to the first (smallest) one
+    base = runs[0][1]["total"]["rps"]
+    return [{
+        "workers": workers,
+        "startup_seconds": result["meta"]["startup_seconds"],
+        "rps": result["total"]["rps"],
+        "rps_per_worker": round(result["total"]["rps"] / workers, 1),
+        "speedup": round(result["total"]["rps"] / base, 2) if base else None,
+        "p99_ms": result["total"]["p99_ms"],
+        "errors": result["total"]["errors"],
+    } for workers, result in runs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"),
+                        help="database for the server (default: $DATABASE_URL)")
+    parser.add_argument("--url", help="benchmark a server that is already running instead")
+    parser.add_argument("--port", type=int, help="port for the server started by the benchmark")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra server setting, e.g. --env INGEST_MODE=queue (repeatable)")
+    parser.add_argument("--rows", type=int, default=10000, help="rows to seed before the run, 0 to skip")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--readers", type=int, default=200, help="polling devices")
+    parser.add_argument("--dashboards", type=int, default=10, help="dashboards paging through /all-msgs/")
+    parser.add_argument("--writers", type=int, default=20, help="bursty writers")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between device polls")
+    parser.add_argument("--burst-size", type=int, default=20, help="most requests in one write burst")
+    parser.add_argument("--burst-interval", type=float, default=2.0, help="mean seconds between bursts")
+    parser.add_argument("--workers", type=int, help="serve with gunicorn and this many workers")
+    parser.add_argument("--scaling", help="comma-separated worker counts to run one after another, e.g. 1,2,4")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to compare against")
+    args = parser.parse_args()
+    if not args.url and not args.database_url:
+        parser.error("set DATABASE_URL or pass --database-url or --url")
+
+    if args.scaling:
+        if args.url:
+            parser.error("--scaling starts its own servers, it can't be used with --url")
+        runs = []
+        for workers in (int(count) for count in args.scaling.split(",")):
+            args.workers = workers
+            runs.append((workers, asyncio.run(run(args))))
+            # Seed once, the later runs reuse the rows
+            args.rows = 0
+        results = {"meta": runs[0][1]["meta"], "scaling": scaling(runs),
+                   "runs": {str(workers): result for workers, result in runs}}
+    else:
+        results = asyncio.run(run(args))
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    if args.compare and "routes" in results:
+        with open(args.compare) as f:
+            print(compare(results, json.load(f)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Compare the JSON and binary ingest formats.
+
+Reports bytes on the wire for one Pico reading (body plus the headers
+sim7080_driver.py sets for each format) and the server-side parse cost
+per record.
+
+    python misc/bench_codec.py [--records 1000] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from app.codec import BINARY_CONTENT_TYPE, decode_msgs, encode_msg, parse_msg_record  # noqa: E402
+
+# Headers added by set_http_content() for each format
+JSON_HEADERS = [
+    ("Content-Type", "application/json"),
+    ("Cache-control", "no-cache"),
+    ("Connection", "keep-alive"),
+    ("Accept", "*/*"),
+]
+BINARY_HEADERS = [("Content-Type", BINARY_CONTENT_TYPE)]
+
+JSON_RESPONSE = b'{"status":"ok"}'
+
+
+def header_bytes(headers, body_length):
+    lines = [f"{name}: {value}\r\n" for name, value in headers]
+    if body_length:
+        lines.append(f"Content-Length: {body_length}\r\n")
+    return len("".join(lines).encode())
+
+
+def wire_sizes():
+    json_body = json.dumps({"msg": "23"}).encode()
+    binary_body = encode_msg(23)
+    return {
+        "json": {
+            "body": len(json_body),
+            "request_headers": header_bytes(JSON_HEADERS, len(json_body)),
+            "response_body": len(JSON_RESPONSE),
+        },
+        "binary": {
+            "body": len(binary_body),
+            "request_headers": header_bytes(BINARY_HEADERS, len(binary_body)),
+            "response_body": 0,
+        },
+    }
+
+
+def parse_costs(records):
+    readings = [{"receiver": i % 100, "msg": str(i % 56)} for i in range(records)]
+    json_batch = json.dumps(readings).encode()
+    binary_batch = b"".join(encode_msg(int(r["msg"]), receiver=r["receiver"]) for r in readings)
+    json_single = json.dumps(readings[0]).encode()
+    binary_single = encode_msg(int(readings[0]["msg"]), receiver=readings[0]["receiver"])
+
+    def per_record_us(stmt, count, number):
+        best = min(timeit.repeat(stmt, number=number, repeat=5))
+        return round(best / number / count * 1e6, 3)
+
+    return {
+        "single_json_us": per_record_us(lambda: parse_msg_record(json.loads(json_single)), 1, 20000),
+        "single_binary_us": per_record_us(lambda: decode_msgs(binary_single), 1, 20000),
+        "batch_json_us": per_record_us(lambda: [parse_msg_record(r) for r in json.loads(json_batch)], records, 20),
+        "batch_binary_us": per_record_us(lambda: decode_msgs(binary_batch), records, 20),
+        "batch_json_bytes": len(json_batch),
+        "batch_binary_bytes": len(binary_batch),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1000, help="records per batch")
+    parser.add_argument("--json", action="store_true", help="print machine-readable output")
+    args = parser.parse_args()
+
+    results = {"wire": wire_sizes(), "parse": parse_costs(args.records)}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for fmt, sizes in results["wire"].items():
+        total = sum(sizes.values())
+        print(f"{fmt:7} body {sizes['body']:3} B  headers {sizes['request_headers']:3} B  "
+              f"response {sizes['response_body']:2} B  total {total:3} B")
+    parse = results["parse"]
+    print(f"parse, one record:   json {parse['single_json_us']} us  binary {parse['single_binary_us']} us")
+    print(f"parse, {args.records} records: json {parse['batch_json_us']} us/record ({parse['batch_json_bytes']} B)  "
+          f"binary {parse['batch_binary_us']} us/record ({parse['batch_binary_bytes']} B)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Time bounding-box and nearest queries against millions of positions.
+
+Seeds lithings.msgs in DATABASE_URL with random positions over Europe,
+timestamped in insertion order over the last 30 days, then times the queries behind /msgs-in-bbox/
+and /nearest-msgs/, with and without a "last hour" bound. --scan repeats
+each query with index scans disabled for comparison. Use a scratch database.
+
+    python misc/bench_geo.py --points 5000000 [--queries 200] [--scan] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.ext.asyncio import create_async_engine  # noqa: E402
+
+from app.geo import bbox_query, nearest  # noqa: E402
+from app.migrations import migrate  # noqa: E402
+
+SOUTH, WEST, NORTH, EAST = 35.0, -10.0, 70.0, 40.0
+SEED_CHUNK = 500000
+
+# Same numbering as app/geo.py
+SEED_SQL = text(f"""
+    INSERT INTO lithings.msgs (receiver, msg, latitude, longitude, geocell, created_at)
+    SELECT (random() * 1000)::int, (random() * 55)::int, lat, lon,
+           LEAST(floor((lat + 90) * 100)::int, 17999) * 36000 + LEAST(floor((lon + 180) * 100)::int, 35999),
+           LOCALTIMESTAMP - interval '30 days' * (1 - n / CAST(:total AS float))
+    FROM (
+        SELECT n, {SOUTH} + random() * {NORTH - SOUTH} AS lat, {WEST} + random() * {EAST - WEST} AS lon
+        FROM generate_series(CAST(:first AS int), :last) AS n
+    ) AS points
+""")
+
+
+async def seed(engine, points):
+    started = time.perf_counter()
+    for offset in range(0, points, SEED_CHUNK):
+        async with engine.begin() as conn:
+            await conn.execute(SEED_SQL, {
+                "first": offset + 1, "last": min(offset + SEED_CHUNK, points), "total": points})
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ANALYZE lithings.msgs"))
+    return round(time.perf_counter() - started, 3)
+
+
+def random_bbox(size):
+    south = random.uniform(SOUTH, NORTH - size)
+    west = random.uniform(WEST, EAST - size)
+    return south, west, south + size, west + size
+
+
+def summary(timings):
+    timings.sort()
+    return {
+        "queries": len(timings),
+        "p50_ms": round(timings[len(timings) // 2] * 1000, 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1] * 1000, 3),
+        "max_ms": round(timings[-1] * 1000, 3),
+    }
+
+
+async def time_queries(engine, count, scan):
+    last_hour = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=1)
+    cases = {
+        "bbox_0.1deg": lambda conn: conn.execute(bbox_query(*random_bbox(0.1), limit=100)),
+        "bbox_1deg": lambda conn: conn.execute(bbox_query(*random_bbox(1.0), limit=100)),
+        "bbox_1deg_last_hour": lambda conn: conn.execute(bbox_query(*random_bbox(1.0), since=last_hour, limit=100)),
+        "nearest_10": lambda conn: nearest(conn, *random_bbox(0)[:2], 10),
+        "nearest_10_last_hour": lambda conn: nearest(conn, *random_bbox(0)[:2], 10, since=last_hour),
+    }
+    results = {}
+    async with engine.connect() as conn:
+        if scan:
+            await conn.execute(text("SET enable_indexscan = off"))
+            await conn.execute(text("SET enable_bitmapscan = off"))
+        for name, run in cases.items():
+            timings = []
+            for _ in range(count):
+                started = time.perf_counter()
+                await run(conn)
+                timings.append(time.perf_counter() - started)
+            results[name] = summary(timings)
+    return results
+
+
+async def run(args):
+    engine = create_async_engine(args.database_url)
+    try:
+        await migrate(engine)
+        seeded = await seed(engine, args.points) if args.points else None
+        async with engine.connect() as conn:
+            total = await conn.scalar(text("SELECT count(*) FROM lithings.msgs WHERE geocell IS NOT NULL"))
+        results = {
+            "positions": total,
+            "seed_seconds": seeded,
+            "indexed": await time_queries(engine, args.queries, scan=False),
+        }
+        if args.scan:
+            results["scan"] = await time_queries(engine, max(args.queries // 20, 3), scan=True)
+        return results
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"),
+                        help="scratch database (default: $DATABASE_URL)")
+    parser.add_argument("--points", type=int, default=1000000, help="positions to add, 0 to reuse what is there")
+    parser.add_argument("--queries", type=int, default=200, help="queries per case")
+    parser.add_argument("--scan", action="store_true", help="also time the queries without indexes")
+    parser.add_argument("--json", action="store_true", help="print machine-readable output")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("set DATABASE_URL or pass --database-url")
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{results['positions']} positions (seeded in {results['seed_seconds']} s)")
+    for mode in ("indexed", "scan"):
+        for name, timing in results.get(mode, {}).items():
+            print(f"{mode:8} {name:22} p50 {timing['p50_ms']:8.3f} ms  p95 {timing['p95_ms']:8.3f} ms  "
+                  f"max {timing['max_ms']:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
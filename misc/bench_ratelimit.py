@@ -0,0 +1,105 @@
+"""Measure the per-request cost of admission control (app/ratelimit.py).
+
+Reports the time one token bucket check takes, for a device posting again
+and again (one hot bucket) and for many devices (a bucket per client
+address, up to max_keys), and for a concurrency slot taken and given back. With
+--redis-url, also the round trip of the shared Redis bucket.
+
+    python misc/bench_ratelimit.py [--keys 100000] [--redis-url redis://localhost] [--json]
+
+misc/bench.py shows what this adds to request latency under load.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from app.ratelimit import ConcurrencyLimiter, RateLimiter, RedisRateLimiter  # noqa: E402
+
+
+def per_call_us(stmt, number):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    return round(best / number * 1e6, 3)
+
+
+def local_costs(keys):
+    # Rates high enough that nothing is turned away: the cost of an
+    # accepted request
+    hot = RateLimiter(rate=1e9, burst=1e9)
+    many = RateLimiter(rate=1e9, burst=1e9, max_keys=keys)
+    names = [f"ip:{i}" for i in range(keys)]
+    position = iter(range(10 ** 9))
+
+    def take_many():
+        many.take(names[next(position) % keys])
+
+    # Fill the buckets first so the timing includes lookups, not inserts
+    for name in names:
+        many.take(name)
+
+    limiter = ConcurrencyLimiter(1)
+
+    def slot():
+        limiter.try_acquire()
+        limiter.release()
+
+    rejecting = RateLimiter(rate=1e-9, burst=1)
+    rejecting.take("ip:0")
+    return {
+        "take_hot_us": per_call_us(lambda: hot.take("ip:0"), 200000),
+        "take_many_keys_us": per_call_us(take_many, 200000),
+        "take_rejected_us": per_call_us(lambda: rejecting.take("ip:0"), 200000),
+        "concurrency_slot_us": per_call_us(slot, 200000),
+        "keys": keys,
+    }
+
+
+async def redis_costs(url, requests):
+    limiter = RedisRateLimiter(url, rate=1e9, burst=1e9, prefix="lithings:bench:")
+    try:
+        await limiter.acquire("ip:0")  # loads the script
+        started = time.perf_counter()
+        for i in range(requests):
+            await limiter.acquire(f"ip:{i % 1000}")
+        elapsed = time.perf_counter() - started
+    finally:
+        await limiter.close()
+    return {"acquire_us": round(elapsed / requests * 1e6, 3), "requests": requests,
+            "redis_failures": limiter.failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, default=100000, help="client addresses with a bucket of their own")
+    parser.add_argument("--redis-url", help="also time the Redis backend (pip install redis)")
+    parser.add_argument("--redis-requests", type=int, default=5000)
+    parser.add_argument("--json", action="store_true", help="print machine-readable output")
+    args = parser.parse_args()
+
+    results = {"memory": local_costs(args.keys)}
+    if args.redis_url:
+        results["redis"] = asyncio.run(redis_costs(args.redis_url, args.redis_requests))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    memory = results["memory"]
+    rows = [
+        ("token bucket, one address", memory["take_hot_us"]),
+        (f"token bucket, {memory['keys']} addresses", memory["take_many_keys_us"]),
+        ("token bucket, rejecting", memory["take_rejected_us"]),
+        ("concurrency slot", memory["concurrency_slot_us"]),
+    ]
+    if "redis" in results:
+        rows.append(("redis bucket round trip", results["redis"]["acquire_us"]))
+    for label, us in rows:
+        print(f"{label + ':':34} {us} us")
+
+
+if __name__ == "__main__":
+    main()
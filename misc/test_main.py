@@ -1,18 +1,49 @@
+import asyncio
+import csv
+import io
+import json
 import pytest
 import os
+import tempfile
+from contextlib import asynccontextmanager
 from fastapi.testclient import TestClient
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker
-from app.main import app, get_db, msgs, metadata, ssl_context
+from sqlalchemy.pool import NullPool
+from datetime import datetime, timedelta
+from sqlalchemy import MetaData, select, func, text
+from sqlalchemy.exc import DBAPIError
+from app import main
+from app.db import build_engine, configure_engine, configure_read_engine
+from app.codec import BINARY_CONTENT_TYPE, decode_msgs, encode_msg
+from app.export import export_query, parquet_available, stream_export
+from app.geo import bbox_query, cell_ranges, geocell
+from app.ingest import IngestQueue, IngestQueueFull
+from app.locks import MIGRATIONS_LOCK, advisory_lock, try_advisory_lock
+from app.metrics import TimedSession
+from app.models import msg_keys, msgs_rollup_deltas
+from app.partitions import drop_expired, ensure_partitions, is_partitioned, list_partitions, partition_msgs
+from app.rollups import RollupMerger, rebuild
+from app.pubsub import MissedMsgs, MsgBroker, PgNotifyListener
+from app.ratelimit import ConcurrencyLimiter, RateLimiter
+from app.cache import IdempotencyCache, LatestMsgCache
+from app.shards import HashRing, Shard, ShardSet, misplaced, rebalance
+from app.replica import ReplicaMonitor
+from app.migrations import migrate
+from app.main import (
+    app, get_db, msgs, metadata, idempotency_cache,
+    latest_text_query, text_msgs_query, msgs_query, inbox_query, sse_text_msgs,
+)
 
-# Setup test database
-TEST_DATABASE_URL = os.getenv("DATABASE_URL")
+# Setup test database: DATABASE_URL for Postgres, otherwise a throwaway
+# SQLite file, which needs no server or network
+TEST_DATABASE_URL = os.getenv("DATABASE_URL") or f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/test.db"
 
-engine = create_async_engine(
-    TEST_DATABASE_URL,
-    connect_args={"ssl": ssl_context}
-)
-TestingSessionLocal = sessionmaker(class_=AsyncSession, expire_on_commit=False, bind=engine)
+configure_engine(TEST_DATABASE_URL)
+# The tests' own connections, opened by whichever event loop a test runs on
+engine = build_engine(TEST_DATABASE_URL, poolclass=NullPool)
+postgres_only = pytest.mark.skipif(engine.dialect.name != "postgresql", reason="needs Postgres")
+TestingSessionLocal = sessionmaker(class_=TimedSession, expire_on_commit=False, bind=engine)
 
 @pytest.fixture(scope="module")
 async def test_db():
@@ -21,6 +52,7 @@ async def test_db():
     yield
     async with engine.begin() as conn:
         await conn.run_sync(metadata.drop_all)
+    await engine.dispose()
 
 @pytest.fixture(scope="module")
 def test_client(test_db):
@@ -42,7 +74,8 @@ async def test_post_and_get_text_msg(test_client):
     # Get the latest text message
     response = test_client.get("/latest-text-msg/")
     assert response.status_code == 200
-    assert response.json() == {"text_msg": "Hello, World!"}
+    assert response.json()["text_msg"] == "Hello, World!"
+    assert response.headers["etag"] == f'"{response.json()["id"]}"'
 
 @pytest.mark.asyncio
 async def test_get_all_text_msgs(test_client):
@@ -98,4 +131,1005 @@ async def test_database_error_handling(test_client, monkeypatch):
 
     response = test_client.post("/post-msg/", json={"receiver": 1, "msg": 42})
     assert response.status_code == 500
-    assert "Database error" in response.json()["detail"]
\ No newline at end of file
+    assert "Database error" in response.json()["detail"]
+
+@pytest.mark.asyncio
+async def test_all_text_msgs_pagination(test_client):
+    for i in range(5):
+        test_client.post("/post-text-msg/", json={"receiver": 3, "text_msg": f"Page message {i}"})
+
+    response = test_client.get("/all-text-msgs/", params={"limit": 2})
+    assert response.status_code == 200
+    first_page = response.json()
+    assert first_page["text_msgs"] == ["Page message 4", "Page message 3"]
+    assert first_page["next_cursor"] is not None
+
+    response = test_client.get("/all-text-msgs/", params={"limit": 2, "before_id": first_page["next_cursor"]})
+    assert response.json()["text_msgs"] == ["Page message 2", "Page message 1"]
+
+    # Requests above the hard page size limit are rejected
+    response = test_client.get("/all-msgs/", params={"limit": 100000})
+    assert response.status_code == 422
+
+@pytest.mark.asyncio
+async def test_get_all_messages_html_escapes_and_pages(test_client):
+    test_client.post("/post-text-msg/", json={"receiver": 2, "text_msg": "<b>bold</b>"})
+
+    response = test_client.get("/all-messages/", params={"limit": 1})
+    assert response.status_code == 200
+    assert "<td>&lt;b&gt;bold&lt;/b&gt;</td>" in response.text
+    assert response.text.count("<tr>") == 2  # header row plus one message
+    assert "data-next-cursor" in response.text
+
+@pytest.mark.asyncio
+async def test_post_msgs_batch(test_client):
+    records = [
+        {"receiver": 4, "msg": "23"},
+        {"receiver": 4, "text_msg": "Batch text"},
+        {"receiver": 4},
+        {"receiver": 4, "msg": 99999},
+    ]
+    response = test_client.post("/post-msgs/batch", json=records)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["inserted"] == 2
+    assert body["rejected"] == 2
+    assert [r["status"] for r in body["records"]] == ["ok", "ok", "error", "error"]
+
+    response = test_client.get("/all-msgs/")
+    assert 23 in response.json()["msgs"]
+
+@pytest.mark.asyncio
+async def test_post_msgs_batch_ndjson(test_client):
+    body = '{"receiver": 5, "msg": 11}\nnot json\n{"receiver": 5, "text_msg": "NDJSON text"}\n'
+    response = test_client.post(
+        "/post-msgs/batch",
+        content=body,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert [r["status"] for r in response.json()["records"]] == ["ok", "error", "ok"]
+
+    # Invalid UTF-8, raw or as an escaped lone surrogate, is the client's fault
+    body = b'{"receiver": 5, "text_msg": "\xff"}\n{"receiver": 5, "text_msg": "\\ud800"}\n'
+    response = test_client.post(
+        "/post-msgs/batch",
+        content=body,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert [r["status"] for r in response.json()["records"]] == ["error", "error"]
+    response = test_client.post(
+        "/post-text-msg/", content=b'{"receiver": 5, "text_msg": "\xff"}',
+        headers={"Content-Type": "application/json"})
+    assert response.status_code == 400
+
+    # Single posts take records without a value, as they always have
+    response = test_client.post("/post-msg/", json={"receiver": 5})
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_ingest_queue_drains_on_stop(test_db):
+    queue = IngestQueue(engine, msgs, max_size=10, batch_size=4, flush_interval=0.01)
+    queue.start()
+    for i in range(6):
+        queue.submit({"receiver": 6, "sender": None, "msg": i, "text_msg": None})
+    await queue.stop()
+
+    async with engine.connect() as conn:
+        count = await conn.scalar(select(func.count()).where(msgs.c.receiver == 6))
+    assert count == 6
+
+@pytest.mark.asyncio
+async def test_ingest_queue_keeps_retrying(test_db):
+    class Flaky:
+        # The database is down for the first few flushes
+        failures = 4
+
+        def begin(self):
+            if self.failures:
+                self.failures -= 1
+                raise OSError("connection refused")
+            return engine.begin()
+
+    queue = IngestQueue(Flaky(), msgs, max_size=2, batch_size=2, flush_interval=0.01, max_backoff=0.01)
+    queue.start()
+    queue.submit_many([{"receiver": 31, "sender": None, "msg": i, "text_msg": None} for i in range(2)])
+    await asyncio.sleep(0.02)
+    # The batch is out of the queue but not written: new rows wait their turn
+    queue.submit({"receiver": 31, "sender": None, "msg": 2, "text_msg": None})
+    with pytest.raises(IngestQueueFull):
+        queue.submit_many([{"receiver": 31, "sender": None, "msg": 3, "text_msg": None}] * 2)
+    await queue.stop()
+    assert queue.failed_flushes == 4
+
+    async with engine.connect() as conn:
+        count = await conn.scalar(select(func.count()).where(msgs.c.receiver == 31))
+    assert count == 3
+
+    def on_flush(rows):
+        raise RuntimeError("subscriber failed")
+
+    # Nor does an error after the commit stop the writer
+    queue = IngestQueue(engine, msgs, batch_size=1, flush_interval=0.01, on_flush=on_flush)
+    queue.start()
+    queue.submit_many([{"receiver": 31, "sender": None, "msg": i, "text_msg": None} for i in (4, 5)])
+    await queue.stop()
+    async with engine.connect() as conn:
+        count = await conn.scalar(select(func.count()).where(msgs.c.receiver == 31))
+    assert count == 5
+
+@pytest.mark.asyncio
+async def test_post_msg_queue_full(test_client, monkeypatch):
+    # Flusher not started, so the single slot stays taken
+    monkeypatch.setattr(main, "ingest_queue", IngestQueue(engine, msgs, max_size=1))
+
+    response = test_client.post("/post-msg/", json={"receiver": 1, "msg": 42})
+    assert response.status_code == 200
+    assert response.json() == {"status": "queued"}
+
+    response = test_client.post("/post-msg/", json={"receiver": 1, "msg": 43})
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "1"
+
+@pytest.mark.asyncio
+async def test_latest_text_msg_per_receiver_and_cache(test_client):
+    test_client.post("/post-text-msg/", json={"receiver": 10, "text_msg": "For ten"})
+    test_client.post("/post-text-msg/", json={"receiver": 11, "text_msg": "For eleven"})
+    # A numeric reading doesn't hide the latest text message
+    test_client.post("/post-msg/", json={"receiver": 10, "msg": 5})
+
+    hits_before = test_client.get("/cache-stats/").json()["hits"]
+
+    response = test_client.get("/latest-text-msg/", params={"receiver": 10})
+    assert response.json()["text_msg"] == "For ten"
+    response = test_client.get("/latest-text-msg/")
+    assert response.json()["text_msg"] == "For eleven"
+
+    # Both answers were written through by the POST handler
+    assert test_client.get("/cache-stats/").json()["hits"] == hits_before + 2
+
+    response = test_client.get("/latest-text-msg/", params={"receiver": 12})
+    assert response.json() == {"text_msg": "No messages found"}
+
+def test_latest_cache_is_bounded():
+    now = [0.0]
+    cache = LatestMsgCache(ttl=5, max_size=2, clock=lambda: now[0])
+    cache.put(1, 10, "a")
+    cache.put(2, 20, "b")
+    assert cache.get(1) == (10, "a")
+    # Receiver 2 is the least recently used
+    cache.put(3, 30, "c")
+    assert cache.get(2) is None
+    assert cache.stats()["entries"] == 2
+    # Expired entries are dropped when looked up
+    now[0] = 10
+    assert cache.get(1) is None
+    assert cache.stats()["entries"] == 1
+
+@pytest.mark.asyncio
+async def test_wait_text_msg(test_client):
+    test_client.post("/post-text-msg/", json={"receiver": 13, "text_msg": "Wake up"})
+
+    response = test_client.get("/wait-text-msg/", params={"receiver": 13})
+    assert response.status_code == 200
+    latest = response.json()
+    assert latest["text_msg"] == "Wake up"
+
+    # Nothing newer than what the client already has
+    response = test_client.get("/wait-text-msg/", params={"receiver": 13, "after_id": latest["id"], "timeout": 0.1})
+    assert response.status_code == 204
+
+@pytest.mark.asyncio
+async def test_broker_wakes_waiters():
+    broker = MsgBroker()
+    waiters = [asyncio.create_task(broker.wait(0, receiver, timeout=5)) for receiver in (1, 2)]
+    await asyncio.sleep(0)
+    broker.publish({"id": 1, "receiver": 1, "text_msg": "one"})
+
+    found = await waiters[0]
+    assert [m["text_msg"] for m in found] == ["one"]
+    # The receiver 2 waiter is still parked
+    assert not waiters[1].done()
+    waiters[1].cancel()
+
+@pytest.mark.asyncio
+async def test_broker_reports_missed_msgs():
+    broker = MsgBroker(history=2)
+    for msg_id in (1, 2, 3):
+        broker.publish({"id": msg_id, "receiver": 1, "text_msg": str(msg_id)})
+    # Message 1 was pushed out: a cursor before it can't be served
+    with pytest.raises(MissedMsgs):
+        broker.newer(0)
+    assert [m["id"] for m in broker.newer(1)] == [2, 3]
+
+    waiter = asyncio.create_task(broker.wait(3, timeout=5))
+    await asyncio.sleep(0)
+    broker.resync()
+    with pytest.raises(MissedMsgs):
+        await waiter
+    # A wait that starts after the resync is unaffected
+    assert await broker.wait(3, timeout=0.01) == []
+
+def test_long_poll_behind_the_broker(test_client, monkeypatch):
+    broker = MsgBroker(history=1)
+    monkeypatch.setattr(main, "broker", broker)
+    test_client.post("/post-text-msg/", json={"receiver": 32, "text_msg": "mine"})
+    latest = test_client.get("/latest-text-msg/", params={"receiver": 32}).json()["id"]
+    test_client.post("/post-text-msg/", json={"receiver": 33, "text_msg": "a"})
+    test_client.post("/post-text-msg/", json={"receiver": 33, "text_msg": "b"})
+    assert broker.evicted_id > latest
+    # The cursor is older than the history: checked against the database,
+    # then waited out instead of answered over and over
+    response = test_client.get("/wait-text-msg/", params={"receiver": 32, "after_id": latest, "timeout": 0.1})
+    assert response.status_code == 204
+
+@pytest.mark.asyncio
+async def test_stream_replays_more_than_a_page(test_db, monkeypatch):
+    monkeypatch.setattr(main, "SSE_REPLAY_PAGE", 10)
+    backlog = 25
+    async with engine.begin() as conn:
+        start = await conn.scalar(select(func.coalesce(func.max(msgs.c.id), 0)))
+        await conn.execute(msgs.insert(), [{"receiver": 34, "text_msg": str(i)} for i in range(backlog)])
+    # A fresh broker knows nothing of the backlog, only of what follows
+    broker = MsgBroker()
+    monkeypatch.setattr(main, "broker", broker)
+    monkeypatch.setattr(main, "receiver_sessions", lambda receiver: TestingSessionLocal)
+    broker.publish({"id": 10 ** 9, "receiver": 34, "text_msg": "live"})
+
+    stream = sse_text_msgs(34, start)
+    texts = []
+    try:
+        async for event in stream:
+            if event.startswith("id: "):
+                texts.append(json.loads(event.split("data: ", 1)[1])["text_msg"])
+                if texts[-1] == "live":
+                    break
+    finally:
+        await stream.aclose()
+    assert texts == [str(i) for i in range(backlog)] + ["live"]
+
+@postgres_only
+@pytest.mark.asyncio
+async def test_notify_listener_reconnects(test_db):
+    received, reconnects = [], []
+    listener = PgNotifyListener(engine, received.append, channel="lithings_test",
+                                retry_delay=0.05, keepalive=0.05, on_reconnect=lambda: reconnects.append(1))
+    listener.start()
+
+    async def notify(payload):
+        for _ in range(100):
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT pg_notify('lithings_test', :payload)"), {"payload": payload})
+                await conn.commit()
+            await asyncio.sleep(0.02)
+            if received and received[-1] == json.loads(payload):
+                return
+
+    try:
+        await notify('{"id": 1}')
+        async with engine.connect() as conn:
+            # Its own connection, not one of the pool's
+            pids = (await conn.execute(text(
+                "SELECT pid FROM pg_stat_activity WHERE (query LIKE 'LISTEN%' OR query = 'SELECT 1')"
+                " AND pid <> pg_backend_pid()"))).scalars().all()
+            assert pids
+            await conn.execute(text("SELECT pg_terminate_backend(pid) FROM unnest(CAST(:pids AS int[])) AS pid"),
+                               {"pids": pids})
+        await notify('{"id": 2}')
+        assert received[-1] == {"id": 2}
+        assert reconnects and listener.reconnects == len(reconnects)
+    finally:
+        await listener.stop()
+
+@pytest.mark.asyncio
+async def test_receiver_and_sender_scoped_lists(test_client):
+    test_client.post("/post-msgs/batch", json=[
+        {"receiver": 14, "sender": 1, "text_msg": "From one"},
+        {"receiver": 14, "sender": 2, "text_msg": "From two"},
+        {"receiver": 15, "sender": 1, "msg": 31},
+    ])
+
+    response = test_client.get("/all-text-msgs/", params={"receiver": 14})
+    assert response.json()["text_msgs"] == ["From two", "From one"]
+    response = test_client.get("/all-text-msgs/", params={"receiver": 14, "sender": 1})
+    assert response.json()["text_msgs"] == ["From one"]
+    response = test_client.get("/all-msgs/", params={"sender": 1})
+    assert response.json()["msgs"] == [31]
+    response = test_client.get("/latest-text-msg/", params={"sender": 2})
+    assert response.json()["text_msg"] == "From two"
+
+    # The columns are smallints: anything wider is the client's mistake
+    for path in ("/latest-text-msg/", "/all-text-msgs/", "/all-msgs/", "/inbox/"):
+        assert test_client.get(path, params={"receiver": 99999999}).status_code == 422
+    assert test_client.get("/all-msgs/", params={"sender": -40000}).status_code == 422
+
+async def explain(query):
+    async with engine.connect() as conn:
+        # The test table is tiny, make the planner show the index it would use
+        await conn.execute(text("SET enable_seqscan = off"))
+        sql = query.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+        result = await conn.execute(text(f"EXPLAIN {sql}"))
+        return "\n".join(result.scalars())
+
+@postgres_only
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query, index", [
+    (latest_text_query(), "msgs_text_id_idx"),
+    (latest_text_query(receiver=1), "msgs_text_receiver_id_idx"),
+    (text_msgs_query(receiver=1, before_id=1000), "msgs_text_receiver_id_idx"),
+    (msgs_query(receiver=1), "msgs_receiver_id_idx"),
+    (msgs_query(sender=1), "msgs_sender_id_idx"),
+    (select(msgs.c.id).where(msgs.c.created_at >= datetime(2024, 1, 1)), "msgs_created_at_brin"),
+    (bbox_query(52.3, 4.8, 52.4, 4.95, since=datetime(2024, 1, 1)), "msgs_geocell_created_at_idx"),
+    (inbox_query(receiver=1, after_id=10), "msgs_undelivered_idx"),
+])
+async def test_hot_queries_use_indexes(test_client, query, index):
+    plan = await explain(query)
+    assert index in plan
+    assert "Seq Scan" not in plan
+
+def test_binary_codec_round_trip():
+    body = encode_msg(23, receiver=1) + encode_msg(
+        -5, receiver=2, sender=3, latitude=60.17, longitude=24.94, timestamp=1700000000
+    )
+    assert len(encode_msg(23, receiver=1)) == 5
+
+    first, second = decode_msgs(body)
+    assert first["receiver"] == 1 and first["msg"] == 23 and "created_at" not in first
+    assert second["sender"] == 3 and second["msg"] == -5
+    assert second["latitude"] == pytest.approx(60.17, abs=1e-5)
+    assert second["created_at"] == datetime(2023, 11, 14, 22, 13, 20)
+
+    with pytest.raises(ValueError):
+        decode_msgs(body[:-1])
+
+@pytest.mark.asyncio
+async def test_post_binary_msg(test_client):
+    body = encode_msg(44, receiver=16) + encode_msg(45, receiver=16, timestamp=1700000000)
+    response = test_client.post("/post-msg/", content=body, headers={"Content-Type": BINARY_CONTENT_TYPE})
+    assert response.status_code == 204
+    assert response.content == b""
+
+    response = test_client.get("/all-msgs/", params={"receiver": 16})
+    assert sorted(response.json()["msgs"]) == [44, 45]
+
+    response = test_client.post("/post-msg/", content=b"\xff", headers={"Content-Type": BINARY_CONTENT_TYPE})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_conditional_get(test_client):
+    test_client.post("/post-text-msg/", json={"receiver": 17, "text_msg": "Unchanged"})
+    response = test_client.get("/latest-text-msg/", params={"receiver": 17})
+    etag = response.headers["etag"]
+
+    response = test_client.get("/latest-text-msg/", params={"receiver": 17}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    # Devices send the tag without quotes
+    response = test_client.get("/latest-text-msg/", params={"receiver": 17}, headers={"If-None-Match": etag.strip('"')})
+    assert response.status_code == 304
+
+    response = test_client.get("/all-msgs/", params={"receiver": 17})
+    list_etag = response.headers["etag"]
+    test_client.post("/post-msg/", json={"receiver": 17, "msg": 1})
+    response = test_client.get("/all-msgs/", params={"receiver": 17}, headers={"If-None-Match": list_etag})
+    assert response.status_code == 200
+    assert response.json()["msgs"] == [1]
+
+    test_client.post("/post-text-msg/", json={"receiver": 17, "text_msg": "Changed"})
+    response = test_client.get("/latest-text-msg/", params={"receiver": 17}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["text_msg"] == "Changed"
+
+@pytest.mark.asyncio
+async def test_pool_stats(test_client):
+    test_client.get("/latest-text-msg/", params={"receiver": 18})
+
+    stats = test_client.get("/pool-stats/").json()
+    assert stats["checked_out"] >= 0
+    assert stats["idle"] >= 1
+    assert stats["wait_seconds"]["count"] >= 1
+    assert stats["wait_seconds"]["buckets"]["+Inf"] == stats["wait_seconds"]["count"]
+    assert stats["connect_seconds"]["count"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_metrics(test_client):
+    test_client.post("/post-text-msg/", json={"receiver": 19, "text_msg": "metered"})
+    test_client.get("/all-text-msgs/", params={"receiver": 19})
+    test_client.request("FROBNICATE", "/all-text-msgs/")
+
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    # Labelled by route template and status, not the raw URL
+    assert 'http_request_duration_seconds_count{method="GET",route="/all-text-msgs/",status="200"}' in body
+    assert 'db_operation_duration_seconds_count{route="/post-text-msg/",op="commit"}' in body
+    assert 'http_request_db_seconds_count{route="/all-text-msgs/"}' in body
+    assert 'db_rows_returned_total{route="/all-text-msgs/"}' in body
+    assert 'method="OTHER"' in body and "FROBNICATE" not in body
+    assert "db_pool_checked_out " in body
+
+
+PARTITION_TEST_SCHEMA = "lithings_partition_test"
+
+@postgres_only
+@pytest.mark.asyncio
+async def test_partition_msgs():
+    schema = PARTITION_TEST_SCHEMA
+    scratch = MetaData()
+    msgs.to_metadata(scratch, schema=schema)
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+        await conn.execute(text(f"CREATE SCHEMA {schema}"))
+        try:
+            await conn.run_sync(scratch.create_all)
+            await conn.execute(text(f"""
+                INSERT INTO {schema}.msgs (receiver, msg, created_at)
+                VALUES (1, 1, LOCALTIMESTAMP - interval '40 days'), (1, 2, LOCALTIMESTAMP)
+            """))
+
+            # A failed swap leaves no bound behind on the old table
+            await conn.execute(text(f"CREATE TABLE {schema}.msgs_legacy (id int)"))
+            with pytest.raises(DBAPIError):
+                await partition_msgs(conn, "daily", schema)
+            await conn.execute(text(f"DROP TABLE {schema}.msgs_legacy"))
+            assert not await is_partitioned(conn, schema)
+            assert not await conn.scalar(text(
+                "SELECT count(*) FROM pg_constraint WHERE conname = 'msgs_legacy_bound'"))
+
+            await partition_msgs(conn, "daily", schema)
+            await partition_msgs(conn, "daily", schema)  # idempotent
+            today = datetime.combine(await conn.scalar(text("SELECT CURRENT_DATE")), datetime.min.time())
+            assert await list_partitions(conn, schema) == [
+                ("msgs_legacy", today + timedelta(days=1)), ("msgs_default", None)]
+
+            created = await ensure_partitions(conn, "daily", 2, schema)
+            assert created == [f"msgs_p{(today + timedelta(days=n)):%Y%m%d}" for n in (1, 2)]
+            assert await ensure_partitions(conn, "daily", 2, schema) == []
+
+            # Rows go to the partition for their created_at, ids keep counting
+            day2 = today + timedelta(days=2, hours=12)
+            await conn.execute(text(f"""
+                INSERT INTO {schema}.msgs (receiver, text_msg, created_at)
+                VALUES (1, 'later', :day2), (1, 'far future', :far)
+            """), {"day2": day2, "far": today + timedelta(days=400)})
+            rows = await conn.execute(text(
+                f"SELECT id, tableoid::regclass::text FROM {schema}.msgs ORDER BY id"))
+            assert [(row[0], row[1].split(".")[-1]) for row in rows] == [
+                (1, "msgs_legacy"), (2, "msgs_legacy"),
+                (3, created[1]), (4, "msgs_default")]
+
+            # A created_at bound prunes the older partitions
+            query = latest_text_query(receiver=1, since=day2)
+            sql = str(query.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+            sql = sql.replace("lithings.", f"{schema}.")
+            plan = "\n".join((await conn.execute(text(f"EXPLAIN {sql}"))).scalars())
+            assert created[1] in plan
+            assert "msgs_legacy" not in plan and created[0] not in plan
+
+            # A negative retention puts the cutoff after the legacy partition's bound
+            assert await drop_expired(conn, timedelta(days=-1), schema) == ["msgs_legacy"]
+            assert await conn.scalar(text(f"SELECT count(*) FROM {schema}.msgs")) == 2
+            new_id = await conn.scalar(text(
+                f"INSERT INTO {schema}.msgs (receiver, msg) VALUES (1, 3) RETURNING id"))
+            assert new_id == 5
+        finally:
+            await conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+
+
+@pytest.mark.asyncio
+async def test_stats_rollups(test_client):
+    start = datetime(2024, 3, 1, 10, 15)
+    unix = lambda moment: (moment - datetime(1970, 1, 1)).total_seconds()
+    body = b"".join([
+        encode_msg(5, receiver=21, timestamp=unix(start)),
+        encode_msg(5, receiver=21, timestamp=unix(start + timedelta(minutes=10))),
+        encode_msg(7, receiver=21, timestamp=unix(start + timedelta(hours=1))),
+        encode_msg(7, receiver=22, timestamp=unix(start)),
+    ])
+    response = test_client.post("/post-msgs/batch", content=body, headers={"Content-Type": BINARY_CONTENT_TYPE})
+    assert response.status_code == 200
+
+    params = {"receiver": 21, "since": "2024-03-01T00:00:00", "until": "2024-03-02T00:00:00"}
+    expected = {
+        "resolution": "hour",
+        "since": "2024-03-01T00:00:00",
+        "until": "2024-03-02T00:00:00",
+        "receiver": 21,
+        "total": 3,
+        "buckets": [
+            {"start": "2024-03-01T10:00:00", "receiver": 21, "count": 2},
+            {"start": "2024-03-01T11:00:00", "receiver": 21, "count": 1},
+        ],
+        "distribution": [{"msg": 5, "count": 2}, {"msg": 7, "count": 1}],
+    }
+    assert test_client.get("/stats/", params=params).json() == expected
+
+    daily = test_client.get("/stats/", params={"since": params["since"], "until": params["until"], "resolution": "day"}).json()
+    assert daily["buckets"] == [
+        {"start": "2024-03-01T00:00:00", "receiver": 21, "count": 3},
+        {"start": "2024-03-01T00:00:00", "receiver": 22, "count": 1},
+    ]
+
+    # Inserts only append deltas; merged into the rollups, the numbers stay the same
+    async with engine.connect() as conn:
+        assert await conn.scalar(select(func.count()).select_from(msgs_rollup_deltas)) > 0
+    assert await RollupMerger(engine).run_once()
+    async with engine.connect() as conn:
+        assert await conn.scalar(select(func.count()).select_from(msgs_rollup_deltas)) == 0
+    assert test_client.get("/stats/", params=params).json() == expected
+    # Merged counts and new deltas add up
+    test_client.post("/post-msgs/batch", content=encode_msg(7, receiver=22, timestamp=unix(start)),
+                     headers={"Content-Type": BINARY_CONTENT_TYPE})
+    params_22 = dict(params, receiver=22)
+    assert test_client.get("/stats/", params=params_22).json()["buckets"] == [
+        {"start": "2024-03-01T10:00:00", "receiver": 22, "count": 2}]
+
+    # A rebuild recomputes the same numbers from msgs
+    async with engine.begin() as conn:
+        await conn.execute(text("DELETE FROM lithings.msgs_hourly WHERE hour >= '2024-03-01' AND hour < '2024-03-02'"))
+    assert await rebuild(engine, datetime(2024, 3, 1), datetime(2024, 3, 2)) == 1
+    assert test_client.get("/stats/", params=params).json() == expected
+
+    assert test_client.get("/stats/", params={"since": "2024-03-02", "until": "2024-03-01"}).status_code == 400
+
+
+def test_geocell_ranges():
+    assert geocell(-90, -180) == 0
+    assert geocell(90, 180) == 180 * 100 * 360 * 100 - 1
+    # One range per row of cells
+    assert len(cell_ranges(52.0, 4.0, 52.025, 4.03)) == 3
+    # Across the antimeridian: both ends of the row
+    row = geocell(10, -180)
+    assert cell_ranges(10, 179.99, 10.005, -179.99) == [(row + 35999, row + 35999), (row, row)]
+    # The whole globe is a single range
+    assert cell_ranges(-90, -180, 90, 180) == [(0, geocell(90, 180))]
+
+@pytest.mark.asyncio
+async def test_spatial_queries(test_client):
+    points = [
+        ("dam", 52.3731, 4.8926),
+        ("centraal", 52.3791, 4.9003),
+        ("zuid", 52.3389, 4.8730),
+        ("utrecht", 52.0907, 5.1214),
+        ("tokyo", 35.6762, 139.6503),
+        ("fiji", -17.0, 179.995),
+    ]
+    for name, latitude, longitude in points:
+        response = test_client.post("/post-text-msg/", json={
+            "receiver": 23, "text_msg": name, "latitude": latitude, "longitude": longitude})
+        assert response.status_code == 200
+    # Binary records carry positions too
+    body = encode_msg(9, receiver=23, latitude=-17.0, longitude=-179.995)
+    response = test_client.post("/post-msg/", content=body, headers={"Content-Type": BINARY_CONTENT_TYPE})
+    assert response.status_code == 204
+
+    response = test_client.get("/msgs-in-bbox/", params={"south": 52.3, "west": 4.8, "north": 52.4, "east": 4.95})
+    assert [m["text_msg"] for m in response.json()["msgs"]] == ["zuid", "centraal", "dam"]
+    assert response.json()["msgs"][0]["latitude"] == 52.3389
+
+    response = test_client.get("/msgs-in-bbox/", params={"south": -18, "west": 179.9, "north": -16, "east": -179.9})
+    assert [(m["text_msg"], m["msg"]) for m in response.json()["msgs"]] == [(None, 9), ("fiji", None)]
+
+    response = test_client.get("/nearest-msgs/", params={"latitude": 52.37, "longitude": 4.89, "limit": 4})
+    nearest = response.json()["msgs"]
+    assert [m["text_msg"] for m in nearest] == ["dam", "centraal", "zuid", "utrecht"]
+    assert 0 < nearest[0]["distance_m"] < 500
+    assert 30000 < nearest[3]["distance_m"] < 40000
+
+    # Only what is recent, and never farther than NEAREST_MAX_DEGREES
+    response = test_client.get("/nearest-msgs/", params={"latitude": 52.37, "longitude": 4.89, "minutes": 60})
+    assert len(response.json()["msgs"]) == 4
+    response = test_client.get("/nearest-msgs/", params={"latitude": 0, "longitude": -30})
+    assert response.json()["msgs"] == []
+    response = test_client.get("/msgs-in-bbox/", params={
+        "south": 52.3, "west": 4.8, "north": 52.4, "east": 4.95, "since": "2100-01-01T00:00:00"})
+    assert response.json()["msgs"] == []
+
+    response = test_client.post("/post-text-msg/", json={"receiver": 23, "text_msg": "x", "latitude": 91, "longitude": 0})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_inbox_and_ack(test_client):
+    for text_msg in ("one", "two", "three"):
+        test_client.post("/post-text-msg/", json={"receiver": 24, "text_msg": text_msg})
+    test_client.post("/post-msg/", json={"receiver": 24, "msg": 5})
+    test_client.post("/post-text-msg/", json={"receiver": 25, "text_msg": "elsewhere"})
+
+    response = test_client.get("/inbox/", params={"receiver": 24, "limit": 3})
+    inbox = response.json()
+    assert [m.get("text_msg") for m in inbox["msgs"]] == ["one", "two", "three"]
+    assert "msg" not in inbox["msgs"][0]
+    assert inbox["next_cursor"] == inbox["msgs"][-1]["id"]
+    response = test_client.get("/inbox/", params={"receiver": 24, "after_id": inbox["next_cursor"]})
+    assert [m.get("msg") for m in response.json()["msgs"]] == [5]
+    assert response.json()["next_cursor"] is None
+
+    ids = [m["id"] for m in inbox["msgs"]]
+    response = test_client.post("/inbox/ack", json={"receiver": 24, "ids": ids[:2]})
+    assert response.json() == {"status": "ok", "acknowledged": 2}
+    # Already delivered, and not the receiver's
+    response = test_client.post("/inbox/ack", json={"receiver": 25, "ids": ids})
+    assert response.json()["acknowledged"] == 0
+    response = test_client.get("/inbox/", params={"receiver": 24})
+    assert [m.get("text_msg") for m in response.json()["msgs"]] == ["three", None]
+
+    # A range, marking seen as well
+    response = test_client.post("/inbox/ack", json={"receiver": 24, "after_id": ids[0], "up_to_id": ids[2], "seen": True})
+    assert response.json()["acknowledged"] == 2
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            select(msgs.c.delivered, msgs.c.seen).where(msgs.c.id.in_(ids)).order_by(msgs.c.id))
+        assert [tuple(row) for row in result] == [(True, None), (True, True), (True, True)]
+    assert len(test_client.get("/inbox/", params={"receiver": 24}).json()["msgs"]) == 1
+
+    assert test_client.post("/inbox/ack", json={"receiver": 24}).status_code == 400
+    assert test_client.post("/inbox/ack", json={"receiver": 24, "ids": ["1"]}).status_code == 400
+    assert test_client.post("/inbox/ack", json={"ids": [1]}).status_code == 400
+
+@postgres_only
+@pytest.mark.asyncio
+async def test_advisory_locks(test_client):
+    async with engine.connect() as first, engine.connect() as second:
+        first = await first.execution_options(isolation_level="AUTOCOMMIT")
+        second = await second.execution_options(isolation_level="AUTOCOMMIT")
+        async with try_advisory_lock(first, 1234) as acquired:
+            assert acquired
+            async with try_advisory_lock(second, 1234) as acquired:
+                assert not acquired
+        async with try_advisory_lock(second, 1234) as acquired:
+            assert acquired
+
+        # Workers starting together: one migrates, the others wait for it
+        async with advisory_lock(first, MIGRATIONS_LOCK):
+            waiting = asyncio.ensure_future(migrate(engine))
+            await asyncio.sleep(0.2)
+            assert not waiting.done()
+        await asyncio.gather(waiting, migrate(engine), migrate(engine))
+
+@pytest.mark.asyncio
+async def test_idempotent_posts(test_client):
+    async def count(receiver):
+        async with engine.connect() as conn:
+            return await conn.scalar(select(func.count()).select_from(msgs).where(msgs.c.receiver == receiver))
+
+    headers = {"Idempotency-Key": "device-1-42"}
+    response = test_client.post("/post-text-msg/", json={"receiver": 26, "text_msg": "once"}, headers=headers)
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+    response = test_client.post("/post-text-msg/", json={"receiver": 26, "text_msg": "once"}, headers=headers)
+    assert response.json() == {"status": "ok"}
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert await count(26) == 1
+
+    # Derived from sender and seq
+    for _ in range(2):
+        response = test_client.post("/post-msg/", json={"receiver": 26, "sender": 3, "msg": 7, "seq": 1})
+        assert response.status_code == 200
+    test_client.post("/post-msg/", json={"receiver": 26, "sender": 3, "msg": 7, "seq": 2})
+    assert await count(26) == 3
+
+    # Binary posts answer 204 either way
+    body = encode_msg(8, receiver=26)
+    for _ in range(2):
+        response = test_client.post("/post-msg/", content=body, headers={
+            "Content-Type": BINARY_CONTENT_TYPE, "Idempotency-Key": "device-1-43"})
+        assert response.status_code == 204
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert await count(26) == 4
+
+    # Forgotten by the cache (another worker, or evicted): msg_keys catches it
+    idempotency_cache.entries.clear()
+    response = test_client.post("/post-text-msg/", json={"receiver": 26, "text_msg": "once"}, headers=headers)
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert await count(26) == 4
+    async with engine.connect() as conn:
+        assert await conn.scalar(select(func.count()).select_from(msg_keys)) >= 4
+
+    response = test_client.post("/post-msg/", json={"receiver": 26, "msg": 7}, headers={"Idempotency-Key": "no spaces"})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_read_replica_routing(test_client, monkeypatch):
+    # The test database stands in for the replica
+    monitor = ReplicaMonitor(configure_read_engine(TEST_DATABASE_URL, poolclass=NullPool))
+    monkeypatch.setattr(main, "replica_monitor", monitor)
+
+    # Not vouched for yet
+    test_client.get("/all-text-msgs/", params={"receiver": 27})
+    assert (monitor.replica_reads, monitor.primary_reads) == (0, 1)
+    assert await monitor.check()
+    test_client.get("/all-text-msgs/", params={"receiver": 27})
+    assert monitor.replica_reads == 1
+
+    # The poster's own reads stay on the primary until the replica has its write
+    response = test_client.post("/post-text-msg/", json={"receiver": 27, "text_msg": "mine"})
+    written_id = int(response.headers["Written-Id"])
+    response = test_client.get("/all-text-msgs/", params={"receiver": 27, "min_id": written_id + 1})
+    assert (monitor.replica_reads, monitor.primary_reads) == (1, 2)
+    response = test_client.get("/all-text-msgs/", params={"receiver": 27, "min_id": written_id})
+    assert response.json()["text_msgs"] == ["mine"]
+    assert (monitor.replica_reads, monitor.primary_reads) == (2, 2)
+
+    # A cached latest message is answered without a session on either
+    response = test_client.get("/latest-text-msg/", params={"receiver": 27})
+    assert response.json()["text_msg"] == "mine"
+    assert (monitor.replica_reads, monitor.primary_reads) == (2, 2)
+
+    # The replica's ETag comes from the replica, not from the primary's cache
+    main.high_water.put(27, written_id + 1, None)
+    response = test_client.get("/all-text-msgs/", params={"receiver": 27})
+    assert response.headers["etag"] == f'"{written_id}"'
+
+    # The HTML table streams from the replica's sessions
+    response = test_client.get("/all-messages/", params={"receiver": 27})
+    assert "mine" in response.text
+    assert monitor.replica_reads == 4
+
+    # Lagging past the threshold
+    monitor.max_lag = -1
+    assert not await monitor.check()
+    test_client.get("/all-text-msgs/")
+    assert monitor.primary_reads == 3
+    monitor.max_lag = 5
+    assert await monitor.check()
+
+    # Down since the last check: this request falls back, later ones wait
+    # for the monitor
+    unreachable = build_engine(f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/missing/replica.db", poolclass=NullPool)
+    monkeypatch.setattr(main, "ReadSessionLocal", sessionmaker(class_=TimedSession, bind=unreachable))
+    response = test_client.get("/all-text-msgs/", params={"receiver": 27})
+    assert response.status_code == 200
+    assert response.json()["text_msgs"] == ["mine"]
+    assert not monitor.available
+    assert monitor.primary_reads == 4
+
+@pytest.mark.asyncio
+async def test_replica_monitor_timeout():
+    class Unreachable:
+        # A host that never answers the connect
+        @asynccontextmanager
+        async def connect(self):
+            await asyncio.sleep(3600)
+            yield
+
+    monitor = ReplicaMonitor(Unreachable(), timeout=0.05)
+    monitor.available = True
+    assert not await asyncio.wait_for(monitor.check(), 1)
+    assert not monitor.available
+
+def test_token_bucket():
+    now = [0.0]
+    limiter = RateLimiter(rate=2, burst=3, max_keys=2, clock=lambda: now[0])
+    assert [limiter.take("a") for _ in range(3)] == [0, 0, 0]
+    assert limiter.take("a") == 0.5
+    now[0] = 0.25
+    assert limiter.take("a") == 0.25
+    now[0] = 0.5
+    assert limiter.take("a") == 0
+    # Least recently used buckets are forgotten past max_keys
+    limiter.take("b")
+    limiter.take("c")
+    assert list(limiter.buckets) == ["b", "c"]
+    assert limiter.stats()["rejected"] == 2
+
+@pytest.mark.asyncio
+async def test_admission_control(test_client, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter(rate=0.5, burst=2, clock=lambda: now[0]))
+    for _ in range(2):
+        assert test_client.post("/post-msg/", json={"receiver": 28, "sender": 9, "msg": 1}).status_code == 200
+    response = test_client.post("/post-msg/", json={"receiver": 28, "sender": 9, "msg": 1})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    # The client address is the key: naming another sender doesn't help
+    assert test_client.post("/post-text-msg/", json={"receiver": 28, "sender": 10, "text_msg": "hi"}).status_code == 429
+    body = encode_msg(1, receiver=28, sender=9)
+    response = test_client.post("/post-msg/", content=body, headers={"Content-Type": BINARY_CONTENT_TYPE})
+    assert response.status_code == 429
+    now[0] = 2
+    response = test_client.post("/post-msg/", content=body, headers={"Content-Type": BINARY_CONTENT_TYPE})
+    assert response.status_code == 204
+    assert "rate_limited_total 3" in test_client.get("/metrics").text
+    monkeypatch.setattr(main, "rate_limiter", None)
+
+    limiter = ConcurrencyLimiter(1)
+    monkeypatch.setattr(main, "db_limiter", limiter)
+    assert limiter.try_acquire()
+    response = test_client.get("/all-msgs/", params={"receiver": 28})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    limiter.release()
+    assert test_client.get("/all-msgs/", params={"receiver": 28}).status_code == 200
+    assert limiter.stats() == {"limit": 1, "in_flight": 0, "peak": 1, "rejected": 1}
+
+    # Streaming bodies hold a slot while they read, after db_slot has exited
+    async def body():
+        yield "first"
+        yield "second"
+
+    stream = main.limited(body())
+    assert await stream.__anext__() == "first"
+    assert limiter.in_flight == 1
+    assert test_client.get("/all-msgs/", params={"receiver": 28}).status_code == 429
+    assert [chunk async for chunk in stream] == ["second"]
+    assert limiter.in_flight == 0
+    assert test_client.get("/export/", params={"receiver": 28}).status_code == 200
+    assert limiter.stats()["in_flight"] == 0
+
+@pytest.mark.asyncio
+async def test_concurrency_limiter_waits():
+    limiter = ConcurrencyLimiter(1)
+    assert limiter.try_acquire()
+    waiting = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    limiter.release()
+    await waiting
+    assert limiter.in_flight == 1
+    limiter.release()
+
+@pytest.mark.asyncio
+async def test_export(test_client):
+    for i in range(5):
+        test_client.post("/post-msg/", json={"receiver": 29, "sender": i, "msg": i, "latitude": 60.1, "longitude": 24.9})
+    test_client.post("/post-text-msg/", json={"receiver": 29, "text_msg": 'a "quoted", text'})
+
+    response = test_client.get("/export/", params={"receiver": 29})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["msg"] for row in rows] == [0, 1, 2, 3, 4, None]
+    assert set(rows[0]) == {column.name for column in msgs.c}
+    assert rows[0]["latitude"] == 60.1 and rows[0]["geocell"] is not None
+    ids = [row["id"] for row in rows]
+
+    response = test_client.get("/export/", params={"format": "csv", "after_id": ids[1], "up_to_id": ids[5]})
+    records = list(csv.DictReader(io.StringIO(response.text)))
+    assert [int(r["id"]) for r in records] == ids[2:]
+    assert records[-1]["text_msg"] == 'a "quoted", text'
+    assert records[0]["text_msg"] == ""
+
+    # Batches smaller than the result
+    query = export_query(receiver=29)
+    chunks = [chunk async for chunk in stream_export(TestingSessionLocal, query, "ndjson", batch_rows=2)]
+    assert len([chunk for chunk in chunks if chunk]) == 3
+    assert b"".join(chunks).decode().count("\n") == 6
+
+    assert test_client.get("/export/", params={"format": "xml"}).status_code == 422
+    response = test_client.get("/export/", params={"format": "parquet", "receiver": 29})
+    if not parquet_available():
+        assert response.status_code == 501
+    else:
+        import pyarrow.parquet as pq
+        table = pq.read_table(io.BytesIO(response.content))
+        assert table.column("id").to_pylist() == ids
+
+@pytest.mark.asyncio
+async def test_dashboard_delta_rows(test_client):
+    test_client.post("/post-text-msg/", json={"receiver": 30, "text_msg": "first"})
+    page = test_client.get("/all-messages/", params={"receiver": 30}).text
+    assert '<tbody id="messages-body">' in page
+    assert 'hx-swap="afterbegin"' in page
+    assert "/all-messages/rows?receiver=30" in page
+    async with engine.connect() as conn:
+        newest = await conn.scalar(select(func.max(msgs.c.id)).where(msgs.c.receiver == 30))
+
+    response = test_client.get("/all-messages/rows", params={"receiver": 30, "after_id": newest})
+    assert response.status_code == 204
+    assert response.content == b""
+
+    for text_msg in ("second", "third"):
+        test_client.post("/post-text-msg/", json={"receiver": 30, "text_msg": text_msg})
+    response = test_client.get("/all-messages/rows", params={"receiver": 30, "after_id": newest})
+    assert response.status_code == 200
+    assert response.text.count("<tr>") == 2
+    assert response.text.index("third") < response.text.index("second")
+    assert "<table>" not in response.text
+
+    # Further behind than the cap: the whole table is sent instead
+    response = test_client.get("/all-messages/rows", params={"receiver": 30, "after_id": newest, "limit": 1})
+    assert response.headers["HX-Retarget"] == "#messages-table"
+    assert response.text.count("<tr>") == 4
+    assert "/all-messages/rows?receiver=30" in response.text
+
+    # Older pages don't poll
+    page = test_client.get("/all-messages/", params={"receiver": 30, "before_id": newest + 1}).text
+    assert "/all-messages/rows" not in page
+
+@pytest.mark.asyncio
+async def test_sharding(test_client, monkeypatch):
+    # Consistent placement: a new shard only takes receivers over
+    ring, grown = HashRing(["a", "b", "c"]), HashRing(["a", "b", "c", "d"])
+    placed = {receiver: ring.lookup(str(receiver)) for receiver in range(300)}
+    assert all(list(placed.values()).count(name) > 50 for name in "abc")
+    moved = [receiver for receiver in placed if grown.lookup(str(receiver)) != placed[receiver]]
+    assert moved and all(grown.lookup(str(receiver)) == "d" for receiver in moved)
+    assert len(moved) < 150
+
+    # Three SQLite databases; the first hands out the ids
+    directory = tempfile.mkdtemp()
+    engines = {name: build_engine(f"sqlite+aiosqlite:///{directory}/{name}.db", poolclass=NullPool) for name in "abcd"}
+    for shard_engine in engines.values():
+        async with shard_engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+    shard_set = ShardSet([Shard(name, engines[name]) for name in "abc"], engines["a"])
+    monkeypatch.setattr(main, "shards", shard_set)
+    monkeypatch.setattr(main, "latest_cache", LatestMsgCache(ttl=60))
+    monkeypatch.setattr(main, "high_water", LatestMsgCache(ttl=60))
+    monkeypatch.delitem(app.dependency_overrides, get_db)
+
+    response = test_client.post("/post-msgs/batch", json=[{"receiver": r, "msg": r} for r in range(1, 13)])
+    assert response.json()["inserted"] == 12
+    test_client.post("/post-text-msg/", json={"receiver": 5, "text_msg": "to five"})
+
+    # Every row sits on its receiver's shard, with ids unique across shards
+    ids = []
+    for shard in shard_set:
+        async with shard.engine.connect() as conn:
+            rows = (await conn.execute(select(msgs.c.id, msgs.c.receiver))).all()
+        assert all(shard_set.shard_for(row.receiver) is shard for row in rows)
+        ids += [row.id for row in rows]
+    assert sorted(ids) == list(range(1, 14))
+
+    # Per-receiver reads touch one shard, global ones are merged
+    assert test_client.get("/all-msgs/", params={"receiver": 7}).json()["msgs"] == [7]
+    assert test_client.get("/latest-text-msg/").json() == {"text_msg": "to five", "id": 13}
+    page = test_client.get("/all-msgs/", params={"limit": 5}).json()
+    assert page["msgs"] == [12, 11, 10, 9, 8]
+    page = test_client.get("/all-msgs/", params={"limit": 5, "before_id": page["next_cursor"]}).json()
+    assert page["msgs"] == [7, 6, 5, 4, 3]
+    lines = test_client.get("/export/").text.splitlines()
+    assert [json.loads(line)["id"] for line in lines] == list(range(1, 14))
+    assert test_client.get("/stats/").json()["total"] == 12
+    assert test_client.get("/all-messages/").text.count("<tr>") == 14
+    response = test_client.post("/inbox/ack", json={"receiver": 5, "up_to_id": 13})
+    assert response.json()["acknowledged"] == 2
+
+    # A fourth shard: rebalance moves the receivers the ring gives it
+    # Row 5 is receiver 5's, its key moves along
+    async with shard_set.shard_for(5).engine.begin() as conn:
+        await conn.execute(msg_keys.insert().values(key="k5", msg_id=5))
+    grown_set = ShardSet([Shard(name, engines[name]) for name in "abcd"], engines["a"])
+    pending = await misplaced(grown_set)
+    assert pending and all(target.name == "d" for _, _, target in pending)
+    assert await rebalance(grown_set, batch=1) == pending
+    assert await misplaced(grown_set) == []
+    monkeypatch.setattr(main, "shards", grown_set)
+    lines = test_client.get("/export/").text.splitlines()
+    assert [json.loads(line)["id"] for line in lines] == list(range(1, 14))
+    assert test_client.get("/stats/").json()["total"] == 12
+    async with grown_set.shard_for(5).engine.connect() as conn:
+        assert await conn.scalar(select(msg_keys.c.msg_id).where(msg_keys.c.key == "k5")) == 5
+
+    # A keyed post whose second shard fails: the retry inserts only what is missing
+    before_commit = main.before_commit
+    calls = []
+
+    async def failing_once(conn, rows):
+        calls.append(len(rows))
+        if len(calls) == 2:
+            raise OSError("shard down")
+        await before_commit(conn, rows)
+
+    monkeypatch.setattr(main, "before_commit", failing_once)
+    body = b"".join(encode_msg(r, receiver=r) for r in range(20, 30))
+    headers = {"Content-Type": BINARY_CONTENT_TYPE, "Idempotency-Key": "multi-1"}
+    assert len({grown_set.shard_for(r) for r in range(20, 30)}) > 2
+    assert test_client.post("/post-msg/", content=body, headers=headers).status_code == 500
+    response = test_client.post("/post-msg/", content=body, headers=headers)
+    assert response.status_code == 204
+    assert "Idempotent-Replayed" not in response.headers
+    monkeypatch.setattr(main, "idempotency_cache", IdempotencyCache())
+    response = test_client.post("/post-msg/", content=body, headers=headers)
+    assert response.headers["Idempotent-Replayed"] == "true"
+    received = []
+    for shard in grown_set:
+        async with shard.engine.connect() as conn:
+            received += (await conn.execute(select(msgs.c.receiver).where(msgs.c.receiver >= 20))).scalars()
+    assert sorted(received) == list(range(20, 30))
+    for shard_engine in engines.values():
+        await shard_engine.dispose()
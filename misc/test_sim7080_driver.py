@@ -0,0 +1,134 @@
+import os
+import sys
+
+# The Pico driver, run on CPython against a fake modem
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pico"))
+
+import sim7080_driver as driver  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def ticks_ms(self):
+        return self.now
+
+    def ticks_diff(self, new, old):
+        return new - old
+
+    def sleep_ms(self, ms):
+        self.now += ms
+
+
+class FakeModem:
+    # A UART whose replies arrive in chunks, each after a delay in ms. Every
+    # AT command gets its echo, then the scripted reply or OK; so does a
+    # raw body.
+
+    def __init__(self, clock, replies=None):
+        self.clock = clock
+        self.replies = replies or {}
+        self.pending = []
+        self.rx = bytearray()
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        chunks = None
+        for prefix, scripted in self.replies.items():
+            if data.startswith(prefix):
+                chunks = scripted
+                break
+        if data.endswith(b"\r\n"):
+            self.pending.append((self.clock.now, data[:-2] + b"\r\r\n"))
+        for delay, chunk in chunks or [(1, b"OK\r\n")]:
+            self.pending.append((self.clock.now + delay, chunk))
+
+    def any(self):
+        for entry in [entry for entry in self.pending if entry[0] <= self.clock.now]:
+            self.rx += entry[1]
+            self.pending.remove(entry)
+        return len(self.rx)
+
+    def readinto(self, buf):
+        count = min(len(buf), len(self.rx))
+        buf[:count] = self.rx[:count]
+        del self.rx[:count]
+        return count
+
+
+def attach(replies=None, buffer_size=driver.RX_BUFFER_SIZE):
+    clock = FakeClock()
+    uart = FakeModem(clock, replies)
+    engine = driver.attach(uart, buffer_size=buffer_size, ticks_ms=clock.ticks_ms,
+                           ticks_diff=clock.ticks_diff, sleep_ms=clock.sleep_ms)
+    return engine, uart, clock
+
+
+def test_returns_on_final_result_code():
+    engine, uart, clock = attach({b"AT+CSQ": [(20, b"+CSQ: 20,99\r\n\r\nOK\r\n")], b"AT+BAD": [(5, b"ERROR\r\n")]})
+    assert driver.send_at("AT+CSQ", "OK", 1500) == 1
+    assert clock.now == 20
+    response = engine.command("AT+BAD", "OK", 1500)
+    assert response.error and not response.matched
+    assert response.lines == [b"ERROR"]
+    assert clock.now == 25
+    # A query's answer is complete at OK even without the token
+    engine.command("AT+CGATT?", "1")
+    assert clock.now == 26
+    assert driver.send_at("AT+SILENT", "NEVER", 100) == 0
+    assert engine.latency_stats()["AT+CSQ"] == {"count": 1, "mean_ms": 20, "max_ms": 20, "timeouts": 0}
+    assert engine.latency_stats()["AT+SILENT"]["max_ms"] == 100
+
+
+def test_urcs_are_kept_apart():
+    engine, uart, clock = attach({
+        b"AT+SHREQ": [
+            (3, b"OK\r\n"),
+            (10, b"\r\n+APP PDP: 0,DEAC"),
+            (12, b"TIVE\r\n"),
+            (300, b'\r\n+SHREQ: "POST",200,15\r\n'),
+        ],
+    })
+    uart.rx += b"\r\nSMS Ready\r\n"
+    response = engine.command('AT+SHREQ="/post-msg/",3', "+SHREQ:", 8000)
+    assert response.matched
+    assert response.lines == [b"OK", b'+SHREQ: "POST",200,15']
+    assert response.latency_ms == 300
+    assert driver.parse_shreq(response.text()) == (200, 15)
+    assert engine.take_urcs() == [("SMS Ready", ""), ("+APP PDP", "0,DEACTIVE")]
+
+
+def test_prompt_and_data():
+    body = b'{"id": 7,\r\n"x": 1}'
+    engine, uart, clock = attach({
+        b"AT+SHBOD": [(2, b"\r\n> ")],
+        b"AT+SHREAD": [(1, b"OK\r\n\r\n+SHREAD: 19\r\n"), (40, body[:5]), (41, body[5:] + b"\r\n")],
+    }, buffer_size=64)
+    assert driver.send_at("AT+SHBOD=5,10000", ">") == 1
+    assert clock.now == 2
+    assert driver.http_read(len(body)) == body
+    assert clock.now == 43
+    assert engine.length == 2
+
+
+def test_http_post():
+    shreq = [(1, b"OK\r\n"), (150, b'\r\n+SHREQ: "POST",204,0\r\n')]
+    engine, uart, clock = attach({
+        b"AT+SHSTATE?": [(1, b"+SHSTATE: 1\r\n\r\nOK\r\n")],
+        b"AT+SHBOD": [(1, b"\r\n> ")],
+        b"AT+SHREQ": shreq,
+    })
+    body = driver.encode_msg(42, receiver=1)
+    assert driver.http_post("http://example", "/post-msg/", body, driver.BINARY_CONTENT_TYPE, "k-1") == "OK"
+    assert body in uart.written
+    assert b'AT+SHAHEAD="Idempotency-Key","k-1"\r\n' in uart.written
+    # Far below the old fixed waits of 1.5 s per command and 8 s for the request
+    assert clock.now < 300
+
+    # Anything but a 2xx is retried with the same key
+    shreq[1] = (150, b'\r\n+SHREQ: "POST",503,0\r\n')
+    uart.written.clear()
+    assert driver.http_post("http://example", "/post-msg/", body, driver.BINARY_CONTENT_TYPE, "k-2", attempts=2) == "Error"
+    assert uart.written.count(b'AT+SHAHEAD="Idempotency-Key","k-2"\r\n') == 2
@@ -36,7 +36,10 @@ def wait_for_interrupt(seconds, button):
     return False
 
 def main():
-    from sim7080_driver import send_at, check_start, set_network, check_network, http_get, http_post
+    from sim7080_driver import (
+        send_at, check_start, set_network, check_network, http_get, http_post,
+        encode_msg, new_idempotency_key, BINARY_CONTENT_TYPE, NOT_MODIFIED
+    )
     from ssd1306 import SSD1306_I2C
     import json
     import utime
@@ -52,6 +55,11 @@ def main():
     display = SSD1306_I2C(128, 64, i2c)
 
     last_http_get_time = time.time()  # Initialize the timer
+    last_msg_etag = None  # id of the message on screen, sent as If-None-Match
+    # A message that failed to send keeps its key, so pressing again to
+    # resend it can't store it twice
+    unsent_message = None
+    unsent_key = None
 
     # LED indicator on Raspberry Pi Pico
     led_pin = 25  # Onboard LED
@@ -153,16 +161,24 @@ def main():
                 display.text("Sending, wait", 0, 48)
                 display.show()
 
-                http_post_message = json.dumps({"msg": normalized_reading})
-                http_post_response = http_post('http://109.204.233.119:8000', '/post-msg/', http_post_message)
+                # Compact binary record, see encode_msg in sim7080_driver.py
+                http_post_message = encode_msg(int(normalized_reading))
+                if http_post_message == unsent_message:
+                    key = unsent_key
+                else:
+                    key = new_idempotency_key()
+                http_post_response = http_post('http://109.204.233.119:8000', '/post-msg/',
+                                               http_post_message, BINARY_CONTENT_TYPE, key)
 
                 if http_post_response == 'OK':
+                    unsent_message = None
                     display.fill(0)
                     display.text("Send mode:", 0, 0)
                     display.text(f"Value: {normalized_reading}", 0, 24)
                     display.text("Message sent", 0, 48)
                     display.show()
                 else:
+                    unsent_message, unsent_key = http_post_message, key
                     display.fill(0)
                     display.text("Send mode:", 0, 0)
                     display.text(f"Value: {normalized_reading}", 0, 24)
@@ -176,9 +192,11 @@ def main():
 
             # Check if 30 seconds have passed since the last http_get call
             if current_time - last_http_get_time >= 30:
-                response_body = http_get('http://109.204.233.119:8000', '/latest-text-msg/')
+                response_body = http_get('http://109.204.233.119:8000', '/latest-text-msg/', last_msg_etag)
 
-                if response_body:
+                if response_body == NOT_MODIFIED:
+                    print("no change")
+                elif response_body:
                     # Process and display the received message
                     start_index = response_body.decode().find('{')
                     end_index = response_body.decode().rfind('}')
@@ -187,6 +205,8 @@ def main():
                     try:
                         response_json = json.loads(json_part)
                         message = response_json.get("text_msg")
+                        if response_json.get("id") is not None:
+                            last_msg_etag = str(response_json.get("id"))
                         display.fill(0)
                         display.text("Receive mode", 0, 0)
                         display.text(f"Message: {message}", 0, 24)
@@ -1,65 +1,360 @@
 # sim7080_driver.py
-import machine
-import utime
 import json
-from machine import Pin
+import struct
+
+try:
+    import machine
+    import utime
+except ImportError:
+    # CPython, e.g. tests driving the engine through a fake UART (attach())
+    machine = None
+    utime = None
+
+if utime is not None:
+    ticks_ms, ticks_diff, sleep_ms = utime.ticks_ms, utime.ticks_diff, utime.sleep_ms
+else:
+    import time
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(new, old):
+        return new - old
+
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
 
 # Global variables
 uart_port = 0
 uart_baudrate = 115200
-Pico_SIM7080G = machine.UART(uart_port, uart_baudrate)
+# Bytes the UART driver buffers between polls; 1024 is about 90 ms at 115200
+uart_rxbuf = 1024
+
+# Compact binary ingest format, must match api/app/codec.py
+BINARY_CONTENT_TYPE = "application/vnd.lithings.msg"
+FLAG_RECEIVER = 0x01
+FLAG_SENDER = 0x02
+FLAG_MSG = 0x04
+FLAG_POSITION = 0x08
+FLAG_TIMESTAMP = 0x10
+
+def encode_msg(msg, receiver=None, sender=None, latitude=None, longitude=None, timestamp=None):
+    # 5 bytes for a reading with a receiver, versus ~20 for the JSON body
+    flags = FLAG_MSG
+    fmt = '<B'
+    values = []
+    if receiver is not None:
+        flags |= FLAG_RECEIVER
+        fmt += 'h'
+        values.append(receiver)
+    if sender is not None:
+        flags |= FLAG_SENDER
+        fmt += 'h'
+        values.append(sender)
+    fmt += 'h'
+    values.append(msg)
+    if latitude is not None and longitude is not None:
+        flags |= FLAG_POSITION
+        fmt += 'ff'
+        values.append(latitude)
+        values.append(longitude)
+    if timestamp is not None:
+        flags |= FLAG_TIMESTAMP
+        fmt += 'I'
+        values.append(int(timestamp))
+    return struct.pack(fmt, flags, *values)
+
+# AT command engine. Replies are read in bulk into one preallocated buffer
+# and a command returns as soon as its answer is complete: the expected
+# token, or ERROR. Unsolicited result codes (URCs) that arrive between or
+# during commands are taken out of the answer and kept in ATEngine.urcs.
+# Each command's latency is recorded per command name.
+
+RX_BUFFER_SIZE = 4096
+# Most URCs kept for take_urcs(), older ones are dropped
+URC_BACKLOG = 16
+
+PROMPT = b">"
+FINAL_CODES = (b"OK", b"ERROR")
+ERROR_PREFIXES = (b"ERROR", b"+CME ERROR", b"+CMS ERROR")
+URC_PREFIXES = (
+    b"+APP PDP:", b"+SHSTATE:", b"+SHREQ:", b"+CPIN:", b"+CFUN:", b"+CGREG:",
+    b"+CEREG:", b"*PSUTTZ:", b"+PSUTTZ:", b"DST:", b"RDY", b"SMS Ready",
+    b"NORMAL POWER DOWN",
+)
+
+def to_text(data):
+    try:
+        return data.decode()
+    except UnicodeError:
+        return str(data)
+
+def command_name(echo):
+    # b'AT+SHREQ="/x",3' -> b'AT+SHREQ'
+    end = len(echo)
+    for separator in (b"=", b"?"):
+        index = echo.find(separator)
+        if 0 <= index < end:
+            end = index
+    return echo[:end]
+
+def parse_urc(line):
+    # b'+APP PDP: 0,ACTIVE' -> ('+APP PDP', '0,ACTIVE'); ('RDY', '') without a colon
+    name, _, value = to_text(line).partition(':')
+    return name.strip(), value.strip()
+
+class ATResponse:
+    # lines: the answer without the echo and without URCs
+    def __init__(self, name):
+        self.name = name
+        self.lines = []
+        self.matched = False
+        self.error = False
+        self.timed_out = False
+        self.data = None
+        self.latency_ms = 0
+
+    def raw(self):
+        return b"\r\n".join(self.lines)
+
+    def text(self):
+        return to_text(self.raw())
+
+class ATEngine:
+    def __init__(self, uart, buffer_size=RX_BUFFER_SIZE, ticks_ms=ticks_ms,
+                 ticks_diff=ticks_diff, sleep_ms=sleep_ms):
+        self.uart = uart
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # Received bytes are buffer[start:length]; scan is where the search
+        # for the next line end resumes
+        self.start = 0
+        self.scan = 0
+        self.length = 0
+        self.ticks_ms = ticks_ms
+        self.ticks_diff = ticks_diff
+        self.sleep_ms = sleep_ms
+        self.urcs = []
+        self.on_urc = None
+        # name -> [count, total ms, max ms, timeouts]
+        self.latency = {}
+
+    def command(self, cmd, expect="OK", timeout=1500, data_length=None):
+        # With data_length, that many raw bytes follow the expected line
+        # (AT+SHREAD) and end up in response.data
+        echo = cmd.encode()
+        return self._exchange(echo + b"\r\n", echo, command_name(echo), expect, timeout, data_length)
+
+    def write(self, data, expect="OK", timeout=1500):
+        # Raw bytes, e.g. the body after the AT+SHBOD prompt
+        return self._exchange(data, None, b"data", expect, timeout, None)
+
+    def poll(self):
+        # Takes in whatever arrived since the last command; between
+        # commands every complete line is unsolicited
+        self._fill()
+        while True:
+            line = self._next_line()
+            if line is None:
+                break
+            if line and self._is_urc(line, None):
+                self._urc(line)
+        self._compact()
+
+    def take_urcs(self):
+        self.poll()
+        urcs, self.urcs = self.urcs, []
+        return urcs
+
+    def latency_stats(self):
+        return {
+            to_text(name): {
+                "count": count,
+                "mean_ms": total // count,
+                "max_ms": longest,
+                "timeouts": timeouts,
+            }
+            for name, (count, total, longest, timeouts) in self.latency.items()
+        }
+
+    def _exchange(self, out, echo, name, expect, timeout, data_length):
+        if isinstance(expect, str):
+            expect = expect.encode()
+        self.poll()
+        response = ATResponse(name)
+        own = name[2:] if name.startswith(b"AT+") else None
+        # A query's answer comes before its OK
+        query = echo is not None and echo.endswith(b"?")
+        started = self.ticks_ms()
+        self.uart.write(out)
+        while True:
+            self._fill()
+            if self._advance(response, echo, own, expect, query, data_length):
+                break
+            if self.ticks_diff(self.ticks_ms(), started) >= timeout:
+                response.timed_out = True
+                break
+            if self.length == len(self.buffer):
+                self._compact()
+                if self.length == len(self.buffer):
+                    # A single line as long as the buffer: drop it
+                    self.start = self.scan = self.length = 0
+            elif not self.uart.any():
+                self.sleep_ms(1)
+        response.latency_ms = self.ticks_diff(self.ticks_ms(), started)
+        self._compact()
+        self._record(response)
+        return response
+
+    def _fill(self):
+        available = self.uart.any()
+        space = len(self.buffer) - self.length
+        if not available or not space:
+            return
+        count = self.uart.readinto(self.view[self.length:self.length + min(available, space)])
+        if count:
+            self.length += count
+
+    def _next_line(self):
+        # The next complete line without CR/LF, None if there is none yet
+        index = bytes(self.view[self.scan:self.length]).find(b"\n")
+        if index < 0:
+            self.scan = self.length
+            return None
+        end = self.scan + index
+        line = bytes(self.view[self.start:end]).strip(b"\r")
+        self.start = self.scan = end + 1
+        return line
+
+    def _advance(self, response, echo, own, expect, query, data_length):
+        # Whether the response is complete
+        if response.matched:
+            return self._take_data(response, data_length)
+        while True:
+            line = self._next_line()
+            if line is None:
+                break
+            if not line or line == echo:
+                continue
+            if line == expect if expect in FINAL_CODES else expect in line:
+                response.lines.append(line)
+                response.matched = True
+                return self._take_data(response, data_length)
+            if self._is_urc(line, own):
+                self._urc(line)
+                continue
+            response.lines.append(line)
+            for prefix in ERROR_PREFIXES:
+                if line.startswith(prefix):
+                    response.error = True
+                    return True
+            # Otherwise OK doesn't end the wait for another token: commands
+            # like AT+CNACT and AT+SHREQ report their result in a later URC
+            if line == b"OK" and query:
+                return True
+        if expect == PROMPT:
+            # "> " comes without a line end
+            if bytes(self.view[self.start:self.length]).strip().startswith(PROMPT):
+                self.start = self.scan = self.length
+                response.matched = True
+                return True
+        return False
+
+    def _take_data(self, response, data_length):
+        if data_length is None:
+            return True
+        if self.length - self.start < data_length:
+            return False
+        response.data = bytes(self.view[self.start:self.start + data_length])
+        self.start = self.scan = self.start + data_length
+        return True
+
+    def _is_urc(self, line, own):
+        if own is not None and line.startswith(own):
+            return False
+        for prefix in URC_PREFIXES:
+            if line.startswith(prefix):
+                return True
+        return False
+
+    def _urc(self, line):
+        urc = parse_urc(line)
+        self.urcs.append(urc)
+        if len(self.urcs) > URC_BACKLOG:
+            self.urcs.pop(0)
+        if self.on_urc is not None:
+            self.on_urc(urc)
+
+    def _compact(self):
+        # Moves unread bytes to the front of the buffer
+        if self.start == 0:
+            return
+        remaining = self.length - self.start
+        if remaining:
+            self.buffer[0:remaining] = bytes(self.view[self.start:self.length])
+        self.scan -= self.start
+        self.length = remaining
+        self.start = 0
+
+    def _record(self, response):
+        entry = self.latency.get(response.name)
+        if entry is None:
+            entry = self.latency[response.name] = [0, 0, 0, 0]
+        entry[0] += 1
+        entry[1] += response.latency_ms
+        entry[2] = max(entry[2], response.latency_ms)
+        if response.timed_out:
+            entry[3] += 1
+
+_engine = None
+
+def attach(uart, **options):
+    # Runs the driver on uart instead of the Pico's UART0, e.g. a fake one
+    # in tests. options go to ATEngine: buffer_size, and ticks_ms, ticks_diff
+    # and sleep_ms to replace the clock.
+    global _engine
+    _engine = ATEngine(uart, **options)
+    return _engine
+
+def modem():
+    if _engine is None:
+        attach(machine.UART(uart_port, uart_baudrate, rxbuf=uart_rxbuf))
+    return _engine
+
+# Print every answer with its latency
+VERBOSE = False
+
+def _report(cmd, response):
+    if VERBOSE:
+        print('%s (%d ms):\t%s' % (cmd, response.latency_ms, response.text()))
+    elif not response.matched:
+        print(cmd + ' back:\t' + response.text())
 
 def send_at(cmd, back="OK", timeout=1500):
-    rec_buff = b''
-    Pico_SIM7080G.write((cmd + '\r\n').encode())
-    prvmills = utime.ticks_ms()
-    while (utime.ticks_ms() - prvmills) < timeout:
-        if Pico_SIM7080G.any():
-            rec_buff = b"".join([rec_buff, Pico_SIM7080G.read(1)])
-    if rec_buff!= '':
-        if back not in rec_buff.decode():
-            if 'ERROR' in rec_buff.decode():
-                print(cmd + 'back:\t' + rec_buff.decode())
-                return 0
-            else:
-                rec_buff = b''
-                rec_buff = send_at_wait_resp(cmd, back, timeout)
-                if back not in rec_buff.decode():
-                    print(cmd + 'back:\t' + rec_buff.decode())
-                    return 0
-                else:
-                    return 1
-        else:
-            print(rec_buff.decode())
-            return 1
-    else:
-        print(cmd + 'no response\n')
-        rec_buff = send_at_wait_resp(cmd, back, timeout)
-        if back not in rec_buff.decode():
-            print(cmd + 'back:\t' + rec_buff.decode())
-            return 0
-        else:
-            return 1
+    # 1 once the answer contains back, 0 on ERROR or timeout
+    response = modem().command(cmd, back, timeout)
+    if response.timed_out and not response.lines:
+        # Silent, e.g. still starting up: once more
+        print(cmd + ' no response')
+        response = modem().command(cmd, back, timeout)
+    _report(cmd, response)
+    return 1 if response.matched else 0
+
+def send_bytes(data, back="OK", timeout=1500):
+    # Raw body for AT+SHBOD, no line ending appended
+    response = modem().write(data, back, timeout)
+    _report('body', response)
+    return 1 if response.matched else 0
 
 def send_at_wait_resp(cmd, back, timeout=2000):
-    rec_buff = b''
-    Pico_SIM7080G.write((cmd + '\r\n').encode())
-    prvmills = utime.ticks_ms()
-    while (utime.ticks_ms() - prvmills) < timeout:
-        if Pico_SIM7080G.any():
-            rec_buff = b"".join([rec_buff, Pico_SIM7080G.read(1)])
-    if rec_buff!= '':
-        if back not in rec_buff.decode():
-            print(cmd + 'back:\t' + rec_buff.decode())
-        else:
-            print(rec_buff.decode())
-    else:
-        print(cmd + 'no response')
-    return rec_buff
+    # The answer's lines, whether or not back came
+    response = modem().command(cmd, back, timeout)
+    _report(cmd, response)
+    return response.raw()
 
 def check_start():
     send_at("AT", "OK")
-    utime.sleep(1)
+    sleep_ms(1000)
     for i in range(1, 4):
         if send_at("AT", "OK") == 1:
             print('------SIM7080G is ready------\r\n')
@@ -68,12 +363,12 @@ def check_start():
         else:
             module_power()
             print('------SIM7080G is starting up, please wait------\r\n')
-            utime.sleep(5)
+            sleep_ms(5000)
 
 def module_power():
     pwr_key = machine.Pin(14, machine.Pin.OUT)
     pwr_key.value(1)
-    utime.sleep(2)
+    sleep_ms(2000)
     pwr_key.value(0)
 
 def set_network():
@@ -94,15 +389,16 @@ def check_network():
             break
         else:
             print('------SIM7080G is offline, please wait...------\r\n')
-            utime.sleep(5)
+            sleep_ms(5000)
             continue
     send_at("AT+CSQ", "OK")
     send_at("AT+CPSI?", "OK")
     send_at("AT+COPS?", "OK")
-    get_resp_info = str(send_at_wait_resp("AT+CGNAPN", "OK"))
+    get_resp_info = to_text(send_at_wait_resp("AT+CGNAPN", "OK"))
     getapn1 = get_resp_info[get_resp_info.find('\"') + 1:get_resp_info.rfind('\"')]
     send_at("AT+CNCFG=0,1,\"" + getapn1 + "\"", "OK")
-    if send_at('AT+CNACT=0,1', 'ACTIVE'):
+    # Answers OK at once, then "+APP PDP: 0,ACTIVE" once attached
+    if send_at('AT+CNACT=0,1', 'ACTIVE', 5000):
         print("Network activation is successful\n")
     else:
         print("Please check the network and try again!\n")
@@ -111,75 +407,142 @@ def set_http_length(body_length):
     send_at(f'AT+SHCONF="BODYLEN",{body_length}', 'OK')
     send_at('AT+SHCONF="HEADERLEN",350', 'OK')
 
-def set_http_content():
+def set_http_content(content_type="application/json"):
     send_at('AT+SHCHEAD', 'OK')
-    send_at('AT+SHAHEAD="Content-Type","application/json"', 'OK')
+    send_at('AT+SHAHEAD="Content-Type","' + content_type + '"', 'OK')
+    if content_type == BINARY_CONTENT_TYPE:
+        # Every header is paid for on the metered link
+        return
     send_at('AT+SHAHEAD="Cache-control","no-cache"', 'OK')
     send_at('AT+SHAHEAD="Connection","keep-alive"', 'OK')
     send_at('AT+SHAHEAD="Accept","*/*"', 'OK')
 
-def http_get(server_url, server_path):
+def parse_shreq(resp):
+    # '+SHREQ: "POST",200,15' -> (200, 15), (None, None) if not found
+    start = resp.find('+SHREQ:')
+    if start < 0:
+        return None, None
+    parts = resp[start:].split(',')
+    if len(parts) < 3:
+        return None, None
+    digits = ''
+    for ch in parts[2]:
+        if not ch.isdigit():
+            break
+        digits += ch
+    try:
+        return int(parts[1]), int(digits)
+    except ValueError:
+        return None, None
+
+# Returned by http_get when the server answered 304 to If-None-Match
+NOT_MODIFIED = "not modified"
+
+def http_read(length, timeout=5000):
+    # Body of the last AT+SHREQ answer, None unless it arrived whole. At most
+    # what fits the receive buffer.
+    length = min(length, RX_BUFFER_SIZE - 64)
+    response = modem().command('AT+SHREAD=0,' + str(length), '+SHREAD:', timeout, data_length=length)
+    _report('AT+SHREAD', response)
+    return response.data
+
+def http_get(server_url, server_path, etag=None):
     send_at('AT+SHDISC', 'OK')
     send_at('AT+SHCONF="URL","' + server_url + '"', 'OK')
     set_http_length(len(server_path.encode('utf-8')))
     send_at('AT+SHCONN', 'OK', 3000)
-    send_at('AT+SHSTATE?')
     if send_at('AT+SHSTATE?', '1'):
         set_http_content()
-        resp = str(send_at_wait_resp('AT+SHREQ="' + server_path + '",1', 'OK', 8000))
-        try:
-            get_pack_len = int(resp[resp.rfind(',') + 1:-5])
-            if get_pack_len > 0:
-                response_body = send_at_wait_resp('AT+SHREAD=0,' + str(get_pack_len), 'OK', 5000)
-                print("Response body:", response_body)
-           #     send_at_wait_resp('AT+SHREAD=0,' + str(get_pack_len), 'OK', 5000)
-                send_at('AT+SHDISC', 'OK')
-                return response_body  # Return the decoded response body
-            else:
-                print("HTTP Get failed!\n")
-                return "error"
-        except ValueError:
-            print("ValueError!\n")
+        if etag is not None:
+            # Sent unquoted, the API accepts bare tags
+            send_at('AT+SHAHEAD="If-None-Match","' + etag + '"', 'OK')
+        # OK comes at once, '+SHREQ: "GET",<status>,<length>' once the server answered
+        resp = to_text(send_at_wait_resp('AT+SHREQ="' + server_path + '",1', '+SHREQ:', 8000))
+        status, get_pack_len = parse_shreq(resp)
+        if status == 304:
+            # Nothing new, skip the AT+SHREAD download
+            send_at('AT+SHDISC', 'OK')
+            return NOT_MODIFIED
+        if get_pack_len is None:
+            print("No HTTP status in:", resp)
             return None
+        if get_pack_len > 0:
+            response_body = http_read(get_pack_len)
+            print("Response body:", response_body)
+            send_at('AT+SHDISC', 'OK')
+            return response_body
+        print("HTTP Get failed!\n")
+        return "error"
     else:
         print("HTTP connection disconnected, please check and try again\n")
         return None
 
-def http_post(server_url, server_path, post_data):
+# A retried post carries the same key, so a message the server already
+# committed is not stored twice (see api/app/idempotency.py)
+_key_prefix = None
+_key_counter = 0
+
+def new_idempotency_key():
+    # Random per boot, counting up within it
+    global _key_prefix, _key_counter
+    if _key_prefix is None:
+        import os
+        _key_prefix = ''.join('%02x' % b for b in os.urandom(6))
+    _key_counter += 1
+    return '%s-%d' % (_key_prefix, _key_counter)
+
+POST_ATTEMPTS = 3
+POST_RETRY_DELAY_MS = 500
+
+def http_post(server_url, server_path, post_data, content_type="application/json",
+              idempotency_key=None, attempts=POST_ATTEMPTS):
+    # post_data is a str for JSON or bytes for BINARY_CONTENT_TYPE. Failed
+    # attempts are retried at once with the same key.
+    if isinstance(post_data, str):
+        post_data = post_data.encode('utf-8')
+    if idempotency_key is None:
+        idempotency_key = new_idempotency_key()
+
+    result = 'Error'
+    for attempt in range(attempts):
+        if attempt:
+            print(f"Retrying ({attempt + 1}/{attempts})...")
+            sleep_ms(POST_RETRY_DELAY_MS * attempt)
+        result = http_post_once(server_url, server_path, post_data, content_type, idempotency_key)
+        if result == 'OK':
+            return result
+    return result
+
+def http_post_once(server_url, server_path, post_data, content_type, idempotency_key):
     print("Disconnecting any existing HTTP connection...")
     send_at('AT+SHDISC', 'OK')
     print("Setting the URL...")
     send_at('AT+SHCONF="URL","' + server_url + '"', 'OK')
     print("Setting the HTTP body length...")
-    set_http_length(len(post_data.encode('utf-8')))
-    send_at('AT+SHSTATE?')
+    set_http_length(len(post_data))
 
     print("Establishing a connection...")
     send_at('AT+SHCONN', 'OK', 5000)
     if send_at('AT+SHSTATE?', '1'):
         print("Setting the HTTP headers...")
-        set_http_content()
-        body_length = len(post_data.encode('utf-8'))
+        set_http_content(content_type)
+        send_at('AT+SHAHEAD="Idempotency-Key","' + idempotency_key + '"', 'OK')
+        body_length = len(post_data)
         print(f"Preparing to send the body with length: {body_length}...")
         send_at(f'AT+SHBOD={body_length},10000', '>')
-        print("Sending the JSON data...")
-        send_at(post_data, 'OK')
-        resp = str(send_at_wait_resp('AT+SHREQ="' + server_path + '",3', 'OK', 8000))
+        print("Sending the body...")
+        send_bytes(post_data, 'OK')
+        resp = to_text(send_at_wait_resp('AT+SHREQ="' + server_path + '",3', '+SHREQ:', 8000))
         print(f"Response received: {resp}")
+        send_at('AT+SHDISC', 'OK')
 
-        try:
-            get_pack_len = int(resp[resp.rfind(',') + 1:-5])
-            if get_pack_len > 0:
-                print(f"Reading response data of length: {get_pack_len}...")
-                send_at_wait_resp('AT+SHREAD=0,' + str(get_pack_len), 'OK', 3000)
-                print("Disconnecting after sending the request...")
-                send_at('AT+SHDISC', 'OK')
-                return 'OK'
-            else:
-                print("HTTP Post failed!\n")
-                return 'Error'
-        except ValueError:
-            print("Failed to extract packet length from response:", resp)
+        # The answer's body ({"status": "ok"}, or none for binary ingest)
+        # isn't needed, so it isn't downloaded. Anything but a 2xx, e.g. a
+        # 429, is retried with the same key.
+        status, _ = parse_shreq(resp)
+        if status is not None and 200 <= status < 300:
+            return 'OK'
+        print("HTTP Post failed with status:", status)
     else:
         print("HTTP connection disconnected, please check and try again\n")
-
+    return 'Error'